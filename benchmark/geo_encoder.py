@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Measures the time necessary to prepare the geometry encoding of a
+subdomain (GeoEncoderConst.prepare_encode).
+
+The synthetic geometry is a cube filled with fluid, with walls, velocity and
+density boundary conditions, a field velocity condition and nodes requiring
+scratch space scattered throughout it.  Usage:
+
+    ./benchmark/geo_encoder.py [number of nodes, default: 10^8]
+"""
+from __future__ import print_function
+
+import sys
+import time
+import numpy as np
+
+from sailfish import geo_encoder
+from sailfish import node_type as nt
+from sailfish.sym import D3Q19
+
+
+class DummyLogger(object):
+    def debug(self, *args):
+        pass
+
+
+class DummyConfig(object):
+    use_link_tags = True
+    geometry_threads = 1
+    logger = DummyLogger()
+
+
+class DummyRunner(object):
+    config = DummyConfig()
+
+
+class DummySpec(object):
+    runner = DummyRunner()
+
+
+class DummySubdomain(object):
+    dim = 3
+    grid = D3Q19
+    spec = DummySpec()
+
+
+def make_geometry(num_nodes, boundary_fraction=0.1, seed=0):
+    n = int(round(num_nodes ** (1.0 / 3.0)))
+    shape = (n, n, n)
+    rng = np.random.RandomState(seed)
+
+    type_map = np.zeros(shape, dtype=np.uint32)
+    param_map = np.zeros(shape, dtype=np.int_)
+    orientation = np.zeros(shape, dtype=np.uint32)
+    params = {}
+
+    choice = rng.randint(0, int(5 / boundary_fraction), size=shape).astype(np.uint8)
+    vals = rng.randint(0, 16, size=np.count_nonzero(choice == 5)) * 0.001
+    node_types = [
+        nt.NTFullBBWall(),
+        nt.NTEquilibriumVelocity((0.01, 0.0, 0.0)),
+        nt.NTEquilibriumDensity(1.0),
+        nt.NTGradFreeflow(),
+        nt.NTEquilibriumVelocity(nt.multifield((vals, 0.0, 0.0))),
+    ]
+
+    for i, node in enumerate(node_types):
+        mask = choice == i + 1
+        key = hash((node.id, i))
+        type_map[mask] = node.id
+        param_map[mask] = key
+        orientation[mask] = 1
+        params[key] = node
+
+    return type_map, param_map, params, orientation
+
+
+def run_benchmark(num_nodes):
+    print('Preparing a geometry with {0:.2e} nodes...'.format(num_nodes))
+    type_map, param_map, params, orientation = make_geometry(num_nodes)
+    encoder = geo_encoder.GeoEncoderConst(DummySubdomain())
+
+    t0 = time.time()
+    encoder.prepare_encode(type_map, param_map, params, orientation, True)
+    t1 = time.time()
+    print('prepare_encode: {0:.2f} s ({1:.2f} Mnodes/s)'.format(
+        t1 - t0, type_map.size / (t1 - t0) * 1e-6))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        num_nodes = int(float(sys.argv[1]))
+    else:
+        num_nodes = 10**8
+    run_benchmark(num_nodes)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""Measures the host time spent on exchanging distributions between two
+subdomains in a single simulation step (SubdomainRunner._send_dists and
+_recv_dists).
+
+The subdomains are periodic along the X axis, so that every pair is
+connected through two faces and the halo messages consist of multiple
+connection buffers.  The time is compared with that of aggregating the
+buffers into a single message (the approach used previously).  The data is
+exchanged through 0MQ IPC sockets, without any GPU.  Usage:
+
+    ./benchmark/halo_exchange.py [subdomain size, default: 128] [steps, default: 100]
+"""
+from __future__ import print_function
+
+import ctypes
+import os
+import sys
+import time
+
+import numpy as np
+import zmq
+
+from sailfish.backend_dummy import DummyBackend
+from sailfish.config import LBConfig
+from sailfish.connector import ZMQSubdomainConnector
+from sailfish.controller import LBGeometryProcessor
+from sailfish.io import LBOutput
+from sailfish.lb_single import LBFluidSim
+from sailfish.subdomain import SubdomainSpec3D
+from sailfish.subdomain_runner import SubdomainRunner
+
+
+class DummyLogger(object):
+    def debug(self, *args):
+        pass
+
+    def info(self, *args):
+        pass
+
+
+class DummyEvent(object):
+    def is_set(self):
+        return False
+
+
+def make_config(n):
+    config = LBConfig()
+    config.init_iters = 0
+    config.seed = 0
+    config.access_pattern = 'AB'
+    config.node_addressing = 'direct'
+    config.precision = 'single'
+    config.block_size = 64
+    config.mem_alignment = 32
+    config.mode = 'batch'
+    config.bulk_boundary_split = True
+    config.output = ''
+    config.benchmark_sample_from = 0
+    config.benchmark_minibatch = 50
+    config.grid = 'D3Q19'
+    config.lat_nx, config.lat_ny, config.lat_nz = 2 * n, n, n
+    config.periodic_x = True
+    config.periodic_y = False
+    config.periodic_z = False
+    config.logger = DummyLogger()
+    return config
+
+
+def make_runners(config, ctx):
+    n = config.lat_ny
+    specs = [SubdomainSpec3D((0, 0, 0), (n, n, n)),
+             SubdomainSpec3D((n, 0, 0), (n, n, n))]
+    for spec in specs:
+        spec.set_actual_size(envelope_size=1)
+    specs = LBGeometryProcessor(specs, 3, (2 * n, n, n)).transform(config)
+
+    b1, b2 = specs
+    c1, c2 = ZMQSubdomainConnector.make_ipc_pair(ctypes.c_float, (0, 0),
+                                                 (b1.id, b2.id))
+    b1.add_connector(b2.id, c1)
+    b2.add_connector(b1.id, c2)
+
+    runners = []
+    backend = DummyBackend()
+    for spec in specs:
+        sim = LBFluidSim(config)
+        runner = SubdomainRunner(sim, spec, output=LBOutput(config, spec.id),
+                                 backend=backend, quit_event=DummyEvent())
+        runner._init_shape()
+        sim.init_fields(runner)
+        runner._init_buffers()
+        runner._init_streams()
+        runners.append(runner)
+
+    c1.init_runner(ctx)
+    c2.init_runner(ctx)
+    return runners, c1.ipc_file
+
+
+def exchange_multipart(runners):
+    for runner in runners:
+        runner._send_dists()
+    for runner in runners:
+        runner._recv_dists()
+
+
+def exchange_aggregated(runners):
+    for runner in runners:
+        for b_id, connector in runner._spec._connectors.items():
+            conn_bufs = runner._block_to_connbuf[b_id]
+            connector.send(np.hstack([np.ravel(x.coll_buf.host) for x in
+                                      conn_bufs]))
+    for runner in runners:
+        for b_id, connector in runner._spec._connectors.items():
+            conn_bufs = runner._recv_block_to_connbuf[b_id]
+            dest = np.hstack([np.ravel(x.recv_buf) for x in conn_bufs])
+            connector.recv(dest, runner._quit_event)
+            i = 0
+            for cbuf in conn_bufs:
+                l = cbuf.recv_buf.size
+                cbuf.recv_buf[:] = dest[i:i+l].reshape(cbuf.recv_buf.shape)
+                i += l
+                cbuf.distribute(runner.backend, runner._data_stream)
+
+
+def measure(func, runners, steps):
+    # Warm-up.
+    func(runners)
+    t0 = time.time()
+    for _ in range(steps):
+        func(runners)
+    return (time.time() - t0) / steps
+
+
+def run_benchmark(n, steps):
+    config = make_config(n)
+    ctx = zmq.Context()
+    runners, ipc_file = make_runners(config, ctx)
+    try:
+        halo_bytes = sum(sent for sent, _ in
+                         runners[0].halo_traffic().values())
+        print('Subdomain size: {0}^3, halo data per subdomain: {1:.2f} MiB'.format(
+            n, halo_bytes / 1024.0 / 1024.0))
+        t_agg = measure(exchange_aggregated, runners, steps)
+        t_multi = measure(exchange_multipart, runners, steps)
+        print('aggregated: {0:.2f} ms/step'.format(t_agg * 1e3))
+        print('multipart:  {0:.2f} ms/step ({1:+.1f}%)'.format(
+            t_multi * 1e3, (t_multi / t_agg - 1.0) * 100.0))
+    finally:
+        ctx.destroy()
+        os.unlink(ipc_file)
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 128
+    steps = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    run_benchmark(n, steps)
@@ -0,0 +1,224 @@
+"""Autotuning of the launch configuration of the compute kernels.
+
+The autotuner runs short simulations of a fully periodic box (the cost of
+which is dominated by the CollideAndPropagate kernel) for a number of
+candidate values of --block_size and --mem_alignment, and stores the fastest
+configuration in a tuning database.  The database is keyed by the compute
+device, grid, model, precision and access pattern, and is consulted
+automatically by subdomain runners at startup for launch parameters that
+were not set explicitly.
+"""
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+import errno
+import json
+import os
+import tempfile
+
+from sailfish import util
+
+#: Candidate values of --block_size and --mem_alignment.
+BLOCK_SIZES = (32, 64, 128, 256)
+MEM_ALIGNMENTS = (8, 16, 32, 64)
+
+#: Size of the lattice used for benchmarking, indexed by dimensionality.
+LATTICE_SIZES = {2: (256, 256), 3: (64, 64, 64)}
+
+
+class TuningDB(object):
+    """Persistent database of tuned launch configurations, stored as a JSON
+    file.  Updates are serialized between processes with a lock file."""
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    @staticmethod
+    def key(device, config):
+        """Returns the database key for a simulation.
+
+        :param device: string identifying the compute device
+        :param config: LBConfig object
+        """
+        return '|'.join([device, config.grid, getattr(config, 'model', ''),
+                         config.precision, config.access_pattern])
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        """Returns a dict with the tuned parameters for key, or None."""
+        return self._load().get(key)
+
+    def put(self, key, entry):
+        dirname = os.path.dirname(self.path) or '.'
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        with util.file_lock(self.path + '.lock'):
+            data = self._load()
+            data[key] = entry
+            fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+            os.rename(tmp_path, self.path)
+
+
+def apply_tuned_params(config, backend):
+    """Updates the launch configuration in config with the values stored in
+    the tuning database for the device used by backend, if available.
+
+    Only parameters which were not set explicitly are modified."""
+    if not config.tuning_db:
+        return
+
+    entry = TuningDB(config.tuning_db).get(TuningDB.key(backend.info, config))
+    if entry is None:
+        return
+
+    tuned = [name for name in ('block_size', 'mem_alignment')
+             if not config.is_explicit(name)]
+    if not tuned:
+        return
+
+    for name in tuned:
+        setattr(config, name, entry[name])
+    config.logger.info('Using tuned launch configuration: block size {0}, '
+                       'memory alignment {1}.'.format(config.block_size,
+                                                      config.mem_alignment))
+
+
+def _make_sim_class(dim):
+    # Imported here to avoid circular imports.
+    from sailfish.lb_single import LBFluidSim
+    from sailfish.subdomain import Subdomain2D, Subdomain3D
+
+    if dim == 2:
+        class TuningSubdomain(Subdomain2D):
+            def boundary_conditions(self, hx, hy):
+                pass
+
+            def initial_conditions(self, sim, hx, hy):
+                sim.rho[:] = 1.0
+                sim.vx[:] = 0.01
+    else:
+        class TuningSubdomain(Subdomain3D):
+            def boundary_conditions(self, hx, hy, hz):
+                pass
+
+            def initial_conditions(self, sim, hx, hy, hz):
+                sim.rho[:] = 1.0
+                sim.vx[:] = 0.01
+
+    class TuningSim(LBFluidSim):
+        subdomain = TuningSubdomain
+
+        @classmethod
+        def modify_config(cls, config):
+            # Make sure the candidate launch configuration is not replaced
+            # with a device-specific or a previously tuned one.
+            config.opencl_cpu_launch_tuning = False
+            config.tuning_db = ''
+
+    return TuningSim
+
+
+def _benchmark(sim_class, config, size, block_size, mem_alignment, iters):
+    """Runs a short simulation and returns a (device, MLUPS) tuple."""
+    # Imported here to avoid circular imports.
+    from sailfish.controller import LBSimulationController
+
+    settings = {
+        'debug_single_process': True,
+        'quiet': True,
+        'backends': config.backends,
+        'grid': config.grid,
+        'precision': config.precision,
+        'access_pattern': config.access_pattern,
+        'node_addressing': 'direct',
+        'block_size': block_size,
+        'mem_alignment': mem_alignment,
+        'max_iters': iters,
+        'every': iters,
+    }
+    if hasattr(config, 'model'):
+        settings['model'] = config.model
+
+    for name, n in zip(('lat_nx', 'lat_ny', 'lat_nz'), size):
+        settings[name] = n
+    for name in ('periodic_x', 'periodic_y', 'periodic_z')[:len(size)]:
+        settings[name] = True
+
+    ctrl = LBSimulationController(sim_class, default_config=settings)
+    ctrl.run(ignore_cmdline=True)
+    runner = ctrl.master.runner
+    profile = runner.time_profile
+    nodes = 1
+    for n in size:
+        nodes *= n
+    mlups = (nodes * ctrl.master.sim.iteration /
+             (profile.t_end - profile.t_start) * 1e-6)
+    return runner.backend.info, mlups
+
+
+def autotune(config, dim, block_sizes=BLOCK_SIZES,
+             mem_alignments=MEM_ALIGNMENTS, size=None):
+    """Finds the fastest launch configuration for the simulation described
+    by config, stores it in the tuning database and applies it to config.
+
+    :param config: LBConfig object
+    :param dim: dimensionality of the simulation
+    :param block_sizes: iterable of --block_size values to try
+    :param mem_alignments: iterable of --mem_alignment values to try
+    :param size: size of the lattice to use for benchmarking
+
+    :rvalue: dict with the best launch configuration or None if none of the
+        candidates could be run
+    """
+    if size is None:
+        size = LATTICE_SIZES[dim]
+    sim_class = _make_sim_class(dim)
+
+    best = None
+    device = None
+    for block_size in block_sizes:
+        for mem_alignment in mem_alignments:
+            if mem_alignment > block_size:
+                continue
+            try:
+                device, mlups = _benchmark(sim_class, config, size, block_size,
+                                           mem_alignment, config.autotune_iters)
+            except Exception as e:
+                config.logger.warning(
+                    'Autotuning: block size {0}, memory alignment {1}: '
+                    'failed ({2})'.format(block_size, mem_alignment, e))
+                continue
+
+            config.logger.info(
+                'Autotuning: block size {0}, memory alignment {1}: '
+                '{2:.2f} MLUPS'.format(block_size, mem_alignment, mlups))
+            if best is None or mlups > best['mlups']:
+                best = {'block_size': block_size,
+                        'mem_alignment': mem_alignment,
+                        'mlups': mlups}
+
+    if best is None:
+        return None
+
+    if config.tuning_db:
+        TuningDB(config.tuning_db).put(TuningDB.key(device, config), best)
+    config.block_size = best['block_size']
+    config.mem_alignment = best['mem_alignment']
+
+    config.logger.info(
+        'Autotuning: selected block size {0}, memory alignment {1} for '
+        '{2}'.format(best['block_size'], best['mem_alignment'], device))
+    return best
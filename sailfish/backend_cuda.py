@@ -13,6 +13,8 @@ import pycuda.gpuarray as cudaarray
 import pycuda.reduction as reduction
 from functools import reduce
 
+from sailfish.kernel_cache import KernelCache, get_kernel_cache
+
 
 def _expand_block(block):
     if type(block) is int:
@@ -101,6 +103,7 @@ class CUDABackend(object):
         self._total_memory_bytes = 0
 
         self._iteration_kernels = []
+        self._kernel_cache = get_kernel_cache(options)
 
     def __del__(self):
         self._ctx.detach()
@@ -109,6 +112,10 @@ class CUDABackend(object):
     def supports_printf(self):
         return self._device.compute_capability()[0] >= 2
 
+    @property
+    def runs_on_host(self):
+        return False
+
     @property
     def info(self):
         return '{0} / CC {1} / MEM {2}'.format(
@@ -213,9 +220,28 @@ class CUDABackend(object):
         else:
             cache = False
 
-        return pycuda.compiler.SourceModule(source, options=options,
+        if self._kernel_cache is None:
+            return pycuda.compiler.SourceModule(source, options=options,
+                    nvcc=self.options.cuda_nvcc,
+                    keep=self.options.cuda_keep_temp, cache_dir=cache)
+
+        device = '{0} / CC {1} / driver {2}'.format(self._device.name(),
+                self._device.compute_capability(), cuda.get_driver_version())
+        key = KernelCache.make_key(source, self.name, device,
+                                   options + [self.options.cuda_nvcc])
+        cubin = self._kernel_cache.get(key)
+        if cubin is not None:
+            try:
+                return cuda.module_from_buffer(cubin)
+            except cuda.Error:
+                # Corrupted or otherwise unusable entry -- rebuild it.
+                pass
+
+        cubin = pycuda.compiler.compile(source, options=options,
                 nvcc=self.options.cuda_nvcc, keep=self.options.cuda_keep_temp,
-                cache_dir=cache)
+                cache_dir=False)
+        self._kernel_cache.put(key, cubin)
+        return cuda.module_from_buffer(cubin)
 
     def get_kernel(self, prog, name, block, args, args_format, shared=0,
             needs_iteration=False, more_shared=False):
@@ -329,4 +355,14 @@ class CUDABackend(object):
             for s in streams:
                 s.synchronize()
 
+    def sync_event(self, event):
+        event.synchronize()
+
+    def attach_thread(self):
+        """Makes the backend usable from the calling thread."""
+        self._ctx.push()
+
+    def detach_thread(self):
+        cuda.Context.pop()
+
 backend=CUDABackend
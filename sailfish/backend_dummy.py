@@ -16,6 +16,10 @@ class DummyBackend(object):
         self.buffers = {}
         self.arrays = {}
 
+    @property
+    def runs_on_host(self):
+        return False
+
     def alloc_buf(self, size=None, like=None, wrap_in_array=True):
         return like
 
@@ -71,6 +75,15 @@ class DummyBackend(object):
     def sync_stream(self, *streams):
         pass
 
+    def sync_event(self, event):
+        pass
+
+    def attach_thread(self):
+        pass
+
+    def detach_thread(self):
+        pass
+
 class DummyStream(object):
     def synchronize(self):
         pass
@@ -0,0 +1,507 @@
+"""Sailfish NumPy backend.
+
+Executes the simulation on the host CPU.  Instead of compiling the generated
+source code, the kernels are implemented as batched operations on NumPy arrays
+that process the whole subdomain at once.
+
+Currently supported are single fluid simulations (LBFluidSim) using the BGK
+and MRT collision models with the AB and AA access patterns, direct node
+addressing, fluid, full bounce-back wall, ghost and unused nodes, and periodic
+boundary conditions within a single subdomain.
+"""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+import platform
+import re
+import time
+from functools import partial
+
+import numpy as np
+import sympy
+
+from sailfish import sym, sym_equilibrium
+import sailfish.node_type as nt
+
+
+# Kernel options, see kernel_common.mako.
+OPTION_SAVE_MACRO_FIELDS = 1
+OPTION_BULK = 2
+
+
+class NumpyBackend(object):
+    name = 'numpy'
+
+    @classmethod
+    def add_options(cls, group):
+        return 0
+
+    def __init__(self, options=None, gpu_id=0):
+        """Initializes the NumPy backend.
+
+        :param gpu_id: ignored; present for compatibility with the GPU
+            backends
+        """
+        self.config = options
+        if options is not None and options.precision == 'double':
+            self.float = np.float64
+        else:
+            self.float = np.float32
+        self.FatalError = FloatingPointError
+        self._iteration = 0
+
+    @property
+    def info(self):
+        return 'NumPy {0} on {1}'.format(np.__version__,
+                                         platform.processor() or
+                                         platform.machine())
+
+    @property
+    def supports_printf(self):
+        return False
+
+    @property
+    def runs_on_host(self):
+        """The kernels are run directly by the host, without any compiled
+        code."""
+        return True
+
+    def set_iteration(self, it):
+        self._iteration = it
+
+    def alloc_buf(self, size=None, like=None, wrap_in_array=True):
+        # Host and "device" memory are the same, so buffers allocated for
+        # existing arrays simply alias them.
+        if like is not None:
+            return like
+        return np.zeros(size // np.dtype(self.float).itemsize,
+                        dtype=self.float)
+
+    def alloc_async_host_buf(self, shape, dtype):
+        return np.zeros(shape, dtype=dtype)
+
+    def to_buf(self, buf, source=None):
+        if source is not None and source is not buf:
+            buf.reshape(source.shape)[:] = source
+
+    def from_buf(self, buf, target=None):
+        if target is not None and target is not buf:
+            target[:] = buf.reshape(target.shape)
+
+    def to_buf_async(self, buf, stream=None):
+        pass
+
+    def from_buf_async(self, buf, stream=None):
+        pass
+
+    def build(self, source):
+        """Prepares the kernels.
+
+        :param source: code generation context (a dict), as returned by
+            BlockCodeGenerator.get_context()
+        """
+        return NumpyProgram(self, source)
+
+    def get_kernel(self, prog, name, block, args, args_format, shared=0,
+            needs_iteration=False, more_shared=False):
+        try:
+            func = getattr(prog, name)
+        except AttributeError:
+            raise NotImplementedError('Kernel {0} is not supported by the '
+                                      'numpy backend.'.format(name))
+        return partial(func, *args)
+
+    def run_kernel(self, kernel, grid_size, stream=None):
+        # Kernels always process the whole subdomain, so the grid size is not
+        # used.
+        kernel()
+
+    def get_reduction_kernel(self, reduce_expr, map_expr, neutral, *args):
+        """Returns a reduction function.
+
+        :param reduce_expr: expression used to reduce two values into one,
+            e.g. 'a+b'; sums, products, minima and maxima are supported
+        :param map_expr: expression used to map value from input arrays,
+            e.g. 'x0[i]*x1[i]'
+        :param neutral: neutral value in reduce_expr (unused)
+        :param args: buffers on which to calculate the reduction
+        """
+        reducers = {
+            'a+b': np.sum,
+            'a*b': np.prod,
+            'max(a,b)': np.max,
+            'fmax(a,b)': np.max,
+            'min(a,b)': np.min,
+            'fmin(a,b)': np.min,
+        }
+        try:
+            reducer = reducers[reduce_expr.replace(' ', '')]
+        except KeyError:
+            raise NotImplementedError('Unsupported reduction: {0}'.format(
+                reduce_expr))
+
+        expr = re.sub(r'x(\d+)\[i\]', r'x\1', map_expr)
+        arrays = dict(('x{0}'.format(i), arg) for i, arg in enumerate(args))
+        arrays.update(np.__dict__)
+        return lambda: reducer(eval(expr, arrays))
+
+    def sync(self):
+        pass
+
+    def make_stream(self):
+        return NumpyStream()
+
+    def make_event(self, stream, timing=False):
+        return NumpyEvent()
+
+    def get_defines(self):
+        return {
+            'warp_size': 1,
+            'backend': 'numpy',
+            'supports_shuffle': False,
+            'supports_printf': False,
+            'shared_var': '',
+            'kernel': '',
+            'global_ptr': '',
+            'const_ptr': '',
+            'device_func': '',
+            'const_var': '',
+        }
+
+    def sync_stream(self, *streams):
+        pass
+
+    def sync_event(self, event):
+        pass
+
+    def attach_thread(self):
+        pass
+
+    def detach_thread(self):
+        pass
+
+
+class NumpyStream(object):
+    """All operations are executed synchronously, so streams are trivial."""
+
+    def wait_for_event(self, event):
+        pass
+
+    def synchronize(self):
+        pass
+
+
+class NumpyEvent(object):
+    def __init__(self):
+        self.time = time.time()
+
+    def time_since(self, other):
+        """Returns the time elapsed since the 'other' event, in ms."""
+        return (self.time - other.time) * 1e3
+
+
+class NumpyProgram(object):
+    """Host implementations of the kernels used by single fluid LB models.
+
+    All kernels operate on views of the buffers shaped as the lattice
+    (excluding padding), with the distribution index as the first axis.
+    """
+
+    def __init__(self, backend, ctx):
+        self._backend = backend
+        self._check_support(ctx)
+
+        grid = ctx['grid']
+        self.grid = grid
+        self.dim = grid.dim
+        self.float = backend.float
+        self.initialization = ctx.get('initialization', False)
+        self.relaxation_enabled = ctx['relaxation_enabled']
+        self.propagation_enabled = ctx['propagation_enabled']
+        self.access_pattern = ctx['access_pattern']
+        self.incompressible = ctx['incompressible']
+
+        # Lattice and array sizes, in the natural order: [nz], ny, nx.
+        if self.dim == 2:
+            self.lat_shape = (ctx['lat_ny'], ctx['lat_nx'])
+            self.arr_shape = (ctx['arr_ny'], ctx['arr_nx'])
+        else:
+            self.lat_shape = (ctx['lat_nz'], ctx['lat_ny'], ctx['lat_nx'])
+            self.arr_shape = (ctx['arr_nz'], ctx['arr_ny'], ctx['arr_nx'])
+        self.lat_slice = tuple(slice(0, n) for n in self.lat_shape)
+
+        # Basis vectors in the natural order of array axes.
+        self.basis = np.array([[int(c) for c in reversed(list(ei))]
+                               for ei in grid.basis], dtype=np.int32)
+        self.weights = np.array([float(w) for w in grid.weights],
+                                dtype=self.float)
+        self.opposite = np.array(grid.idx_opposite, dtype=np.int32)
+        # Shifts for all directions.  Each item is a pair of slices: the
+        # source and destination of data moved by the direction vector.
+        self.shifts = [self._shift_slices(ei) for ei in self.basis]
+
+        # Node type IDs.
+        remap = ctx['type_id_remap']
+        self.type_mask = ctx['nt_type_mask']
+        node_types = ctx['node_types']
+        self.wet_ids = [remap[t.id] for t in node_types if t.wet_node]
+        self.excluded_ids = [remap[t.id] for t in node_types if t.excluded or
+                             t.propagation_only]
+        self.bb_ids = [remap[t.id] for t in node_types if
+                       t is nt.NTFullBBWall]
+
+        self.tau = ctx['tau']
+        if ctx['model'] == 'mrt':
+            self._init_mrt(ctx['visc'])
+            self._relaxate = self._relaxate_mrt
+        else:
+            self._relaxate = self._relaxate_bgk
+
+    def _check_support(self, ctx):
+        unsupported = []
+        if ctx.get('simtype') != 'lbm':
+            unsupported.append('simulation type {0}'.format(
+                ctx.get('simtype')))
+        if len(ctx['grids']) != 1:
+            unsupported.append('multiple lattices')
+        if ctx['equilibria'][0] is not sym_equilibrium.bgk_equilibrium:
+            unsupported.append('non-BGK equilibrium')
+        if ctx['model'] not in ('bgk', 'mrt'):
+            unsupported.append('{0} model'.format(ctx['model']))
+        if ctx['node_addressing'] != 'direct':
+            unsupported.append('indirect node addressing')
+        if ctx['propagate_on_read']:
+            unsupported.append('propagate-on-read')
+        if ctx['config'].minimize_roundoff:
+            unsupported.append('round-off minimization')
+        if ctx.get('subgrid', 'none') != 'none':
+            unsupported.append('subgrid models')
+        if ctx.get('regularized'):
+            unsupported.append('regularized collisions')
+        forces = ctx.get('forces')
+        if forces is not None and (forces.numeric or forces.symbolic):
+            unsupported.append('body forces')
+
+        supported_types = (nt._NTFluid, nt._NTGhost, nt._NTUnused,
+                           nt._NTPropagationOnly, nt.NTFullBBWall)
+        for node_type in ctx['node_types']:
+            if node_type not in supported_types:
+                unsupported.append('{0} nodes'.format(node_type.__name__))
+
+        if unsupported:
+            raise NotImplementedError('The numpy backend does not support: '
+                                      '{0}'.format(', '.join(unsupported)))
+
+    def _init_mrt(self, visc):
+        grid = self.grid
+        mrt_matrix = np.array(grid.mrt_matrix.tolist(), dtype=np.float64)
+        self.mrt_matrix = mrt_matrix.astype(self.float)
+        self.mrt_matrix_inv = np.linalg.inv(mrt_matrix).astype(self.float)
+
+        rho0 = 1 if self.incompressible else sym.S.rho
+        subs = [(sym.S.visc, visc), (sym.S.rho0, rho0)]
+        for eq in grid.mrt_eq_symbols:
+            subs.append((eq.lhs, eq.rhs.subs(subs)))
+
+        rates = []
+        self.mrt_eq = []
+        args = (sym.S.rho, grid.mx, grid.my, grid.mz)
+        for coll, eq in zip(grid.mrt_collision, grid.mrt_equilibrium):
+            rate = float(sympy.sympify(coll).subs(subs))
+            rates.append(rate)
+            if rate != 0:
+                self.mrt_eq.append(sympy.lambdify(
+                    args, sympy.sympify(eq).subs(subs), 'numpy'))
+            else:
+                self.mrt_eq.append(None)
+        self.mrt_rates = np.array(rates, dtype=self.float)
+
+    def _shift_slices(self, vec):
+        src = []
+        dst = []
+        for c in vec:
+            if c > 0:
+                src.append(slice(0, -c))
+                dst.append(slice(c, None))
+            elif c < 0:
+                src.append(slice(-c, None))
+                dst.append(slice(0, c))
+            else:
+                src.append(slice(None))
+                dst.append(slice(None))
+        return tuple(src), tuple(dst)
+
+    def _lattice(self, buf):
+        return buf.reshape(self.arr_shape)[self.lat_slice]
+
+    def _dists(self, buf):
+        return buf.reshape((self.grid.Q,) + self.arr_shape)[
+            (slice(None),) + self.lat_slice]
+
+    def _node_masks(self, geo_map):
+        """Returns (wet, bounce-back, propagating) node masks."""
+        node_type = self._lattice(geo_map) & self.type_mask
+        wet = np.in1d(node_type, self.wet_ids).reshape(node_type.shape)
+        bb = np.in1d(node_type, self.bb_ids).reshape(node_type.shape)
+        active = np.logical_not(np.in1d(node_type, self.excluded_ids).reshape(
+            node_type.shape))
+        return wet, bb, active
+
+    def _macro(self, f):
+        rho = np.sum(f, axis=0)
+        mom = np.tensordot(self.basis.T.astype(self.float), f, axes=1)
+        return rho, mom
+
+    def _equilibrium(self, rho, v):
+        """Returns the BGK equilibrium distributions."""
+        rho0 = 1.0 if self.incompressible else rho
+        eu = np.tensordot(self.basis.astype(self.float), v, axes=1)
+        usq = np.sum(v * v, axis=0)
+        feq = eu * 4.5
+        feq += 3.0
+        feq *= eu
+        feq -= 1.5 * usq
+        feq *= rho0
+        feq += rho
+        feq *= self.weights.reshape((-1,) + (1,) * self.dim)
+        return feq
+
+    def _relaxate_bgk(self, f, rho, mom, v):
+        feq = self._equilibrium(rho, v)
+        feq -= f
+        feq *= self.float(1.0 / self.tau)
+        feq += f
+        return feq
+
+    def _relaxate_mrt(self, f, rho, mom, v):
+        m = np.tensordot(self.mrt_matrix, f, axes=1)
+        # Momentum components are in the order of array axes.
+        if self.dim == 2:
+            my, mx = mom
+            mz = 0.0
+        else:
+            mz, my, mx = mom
+        for i, eq in enumerate(self.mrt_eq):
+            if eq is None:
+                continue
+            m[i] -= self.mrt_rates[i] * (m[i] - eq(rho, mx, my, mz))
+        return np.tensordot(self.mrt_matrix_inv, m, axes=1).astype(self.float)
+
+    def _collide(self, f, wet, bb, ov, orho, options):
+        """Performs the collision and bounce-back steps.
+
+        :param f: pre-collision distributions
+        :rvalue: post-collision distributions
+        """
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            rho, mom = self._macro(f)
+            if self.incompressible:
+                v = mom
+            else:
+                v = mom / rho
+
+            if self.initialization:
+                v = np.array([self._lattice(x) for x in reversed(ov)])
+
+            if self.relaxation_enabled:
+                out = self._relaxate(f, rho, mom, v)
+                out = np.where(wet, out, f)
+            else:
+                out = f.copy()
+
+        if self.bb_ids:
+            np.copyto(out, f[self.opposite], where=bb)
+
+        if options & OPTION_SAVE_MACRO_FIELDS:
+            np.copyto(self._lattice(orho), rho, where=wet)
+            if not self.initialization:
+                for i, comp in enumerate(ov):
+                    np.copyto(self._lattice(comp), v[self.dim - 1 - i],
+                              where=wet)
+        return out
+
+    def _push(self, src, dst, active):
+        """Streams distributions from active nodes to their neighbors."""
+        if not self.propagation_enabled:
+            np.copyto(dst, src, where=active)
+            return
+
+        for i, (s, d) in enumerate(self.shifts):
+            np.copyto(dst[i][d], src[i][s], where=active[s])
+
+    def _pull_from_opposite_slots(self, f):
+        """Reads distributions streamed to the node in the AA access pattern,
+        which are stored in the slots opposite to their natural ones."""
+        out = f[self.opposite]
+        for i, (s, d) in enumerate(self.shifts):
+            out[i][d] = f[self.opposite[i]][s]
+        return out
+
+    def SetInitialConditions(self, dist, *args):
+        ov = [self._lattice(x) for x in args[:self.dim]]
+        rho = self._lattice(args[self.dim])
+        # Reverse the order of velocity components to match the order of
+        # array axes.
+        v = np.array(ov[::-1])
+        with np.errstate(invalid='ignore', over='ignore'):
+            self._dists(dist)[:] = self._equilibrium(rho, v)
+
+    def CollideAndPropagate(self, geo_map, dist_in, dist_out, orho, *args):
+        ov = args[:self.dim]
+        options = args[self.dim]
+        wet, bb, active = self._node_masks(geo_map)
+        f_in = self._dists(dist_in)
+        f_out = self._dists(dist_out)
+
+        if self.access_pattern == 'AB':
+            f = self._collide(f_in, wet, bb, ov, orho, options)
+            self._push(f, f_out, active)
+        elif self._backend._iteration & 1:
+            # AA, odd step: read from neighbors, write to neighbors.
+            f = self._pull_from_opposite_slots(f_in)
+            f = self._collide(f, wet, bb, ov, orho, options)
+            self._push(f, f_out, active)
+        else:
+            # AA, even step: read and write the local node only.
+            f = self._collide(f_in, wet, bb, ov, orho, options)
+            np.copyto(f_out, f[self.opposite], where=active)
+
+    def _periodic_axis(self, axis):
+        # Kernels use the X, Y, Z axis order, arrays the reverse one.
+        ax = self.dim - 1 - axis
+        n = self.lat_shape[ax]
+
+        def layer(idx):
+            sl = [slice(None)] * (self.dim + 1)
+            sl[ax + 1] = idx
+            return tuple(sl)
+        return ax, n, layer
+
+    def ApplyPeriodicBoundaryConditions(self, dist, axis):
+        """Moves distributions streamed into ghost nodes to their periodic
+        images.  Applying this in turn along all periodic axes also takes care
+        of distributions crossing edges and corners of the subdomain."""
+        if axis >= self.dim:
+            return
+        ax, n, layer = self._periodic_axis(axis)
+        f = self._dists(dist)
+        for i, ei in enumerate(self.basis):
+            if ei[ax] < 0:
+                f[i][layer(n - 2)[1:]] = f[i][layer(0)[1:]]
+            elif ei[ax] > 0:
+                f[i][layer(1)[1:]] = f[i][layer(n - 1)[1:]]
+
+    def ApplyPeriodicBoundaryConditionsWithSwap(self, dist, axis):
+        """Fills ghost nodes with the unpropagated distributions of their
+        periodic images (AA access pattern, after the local step)."""
+        if axis >= self.dim:
+            return
+        ax, n, layer = self._periodic_axis(axis)
+        f = self._dists(dist)
+        f[layer(0)] = f[layer(n - 2)]
+        f[layer(n - 1)] = f[layer(1)]
+
+
+backend=NumpyBackend
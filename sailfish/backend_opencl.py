@@ -12,6 +12,8 @@ import operator
 import os
 import numpy as np
 
+from sailfish.kernel_cache import KernelCache, get_kernel_cache
+
 class OpenCLBackend(object):
     name ='opencl'
 
@@ -21,6 +23,14 @@ class OpenCLBackend(object):
                 dest='opencl_interactive',
                 help='select the OpenCL device in an interactive manner',
                 action='store_true', default=False)
+        group.add_argument('--opencl_device_type', type=str, default='gpu',
+                choices=['gpu', 'cpu', 'accelerator', 'all'],
+                help='type of the OpenCL devices to use')
+        group.add_argument('--noopencl_cpu_launch_tuning',
+                dest='opencl_cpu_launch_tuning', action='store_false',
+                default=True, help='do not override --block_size and '
+                '--mem_alignment with values optimized for the device when '
+                'running on a CPU')
         return 1
 
     def __init__(self, options, gpu_id):
@@ -51,24 +61,82 @@ class OpenCLBackend(object):
                 platform_num = 0
 
             platform = cl.get_platforms()[platform_num]
-            devices = platform.get_devices(device_type=cl.device_type.GPU)
+            device_type = getattr(cl.device_type,
+                                  options.opencl_device_type.upper())
+            devices = platform.get_devices(device_type=device_type)
             devices = [devices[gpu_id]]
             self.ctx = cl.Context(devices=devices, properties=[(cl.context_properties.PLATFORM, platform)])
 
+        self._device = self.ctx.devices[0]
+        self._is_cpu = bool(self._device.type & cl.device_type.CPU)
+        if self._is_cpu and options.opencl_cpu_launch_tuning:
+            self._tune_cpu_launch(options)
+
         self.default_queue = cl.CommandQueue(self.ctx)
+        # Queues created with make_stream().
+        self._streams = []
+        # (kernel name, event) pairs used to measure per-kernel execution
+        # times in the benchmark mode.
+        if getattr(options, 'mode', None) == 'benchmark':
+            self._kernel_events = []
+        else:
+            self._kernel_events = None
         self.buffers = {}
         self.arrays = {}
         self._iteration_kernels = []
+        self._kernel_cache = get_kernel_cache(options)
         self.config = options
 
+    def _tune_cpu_launch(self, options):
+        """Adjusts the launch configuration for a CPU device.
+
+        CPU runtimes execute every work-group on a single core, vectorizing
+        the kernel across work-items.  Larger work-groups amortize the
+        scheduling overhead, and aligning rows of the lattice to cache lines
+        (instead of the GPU memory transaction size) avoids split loads.
+        Values explicitly specified by the user are not changed.
+        """
+        dev = self._device
+        float_size = 8 if options.precision == 'double' else 4
+        alignment = max(1, dev.global_mem_cacheline_size // float_size)
+        block_size = min(dev.max_work_group_size, 128)
+
+        if not options.is_explicit('mem_alignment'):
+            options.mem_alignment = alignment
+        if not options.is_explicit('block_size'):
+            options.block_size = max(options.mem_alignment,
+                                     block_size // options.mem_alignment *
+                                     options.mem_alignment)
+        options.logger.info('Using CPU launch configuration: block size {0}, '
+                            'memory alignment {1}.'.format(options.block_size,
+                                                           options.mem_alignment))
+
+    def _warp_size(self):
+        """Returns the number of work-items executed in lockstep."""
+        if self._is_cpu:
+            return 1
+
+        dev = self._device
+        for attr in ('warp_size_nv', 'wavefront_width_amd'):
+            try:
+                return getattr(dev, attr)
+            except (AttributeError, cl.Error):
+                pass
+        return 32
+
     @property
     def info(self):
-        return ''
+        return '{0} ({1})'.format(self._device.name,
+                                  self._device.platform.name)
 
     @property
     def supports_printf(self):
         return False
 
+    @property
+    def runs_on_host(self):
+        return False
+
     def set_iteration(self, it):
         self._iteration = it
         for kernel in self._iteration_kernels:
@@ -113,7 +181,35 @@ class OpenCLBackend(object):
                 size=size * dtype().nbytes)
         return host_buf.get_host_array(shape, dtype)
 
+    def _finish_streams(self):
+        """Waits for all commands enqueued in streams to complete.
+
+        Commands in different OpenCL queues are not ordered with respect to
+        each other.  Blocking transfers, which are executed in the default
+        queue, call this first so that they observe the results of all
+        previously enqueued kernels, as is the case with the CUDA backend."""
+        for stream in self._streams:
+            stream.synchronize()
+
+    def _default_queue_barrier(self):
+        """Orders the default queue with respect to the streams.
+
+        Commands enqueued in the default queue after calling this function
+        start only after all commands previously enqueued in the streams
+        have completed, like commands in the null stream of the CUDA backend."""
+        markers = [cl.enqueue_marker(s.queue) for s in self._streams]
+        if markers:
+            cl.enqueue_barrier(self.default_queue, wait_for=markers)
+
+    def _streams_barrier(self):
+        """Makes all commands subsequently enqueued in the streams wait for
+        the commands previously enqueued in the default queue."""
+        marker = cl.enqueue_marker(self.default_queue)
+        for stream in self._streams:
+            cl.enqueue_barrier(stream.queue, wait_for=[marker])
+
     def to_buf(self, cl_buf, source=None):
+        self._finish_streams()
         if source is None:
             if cl_buf in self.buffers:
                 cl.enqueue_write_buffer(self.default_queue, cl_buf,
@@ -129,6 +225,7 @@ class OpenCLBackend(object):
                         source).wait()
 
     def from_buf(self, cl_buf, target=None):
+        self._finish_streams()
         if target is None:
             if cl_buf in self.buffers:
                 cl.enqueue_read_buffer(self.default_queue, cl_buf,
@@ -144,20 +241,47 @@ class OpenCLBackend(object):
                         target).wait()
 
     def to_buf_async(self, cl_buf, stream=None):
-        queue = stream.queue if stream is not None else self.default_queue
-        cl.enqueue_write_buffer(queue, cl_buf, self.buffers[cl_buf],
-                is_blocking=False)
+        if stream is None:
+            self._default_queue_barrier()
+            cl.enqueue_write_buffer(self.default_queue, cl_buf,
+                    self.buffers[cl_buf], is_blocking=False)
+            self._streams_barrier()
+        else:
+            cl.enqueue_write_buffer(stream.queue, cl_buf, self.buffers[cl_buf],
+                    is_blocking=False)
 
     def from_buf_async(self, cl_buf, stream=None):
-        queue = stream.queue if stream is not None else self.default_queue
-        cl.enqueue_read_buffer(queue, cl_buf, self.buffers[cl_buf],
-                is_blocking=False)
+        if stream is None:
+            self._default_queue_barrier()
+            cl.enqueue_read_buffer(self.default_queue, cl_buf,
+                    self.buffers[cl_buf], is_blocking=False)
+            self._streams_barrier()
+        else:
+            cl.enqueue_read_buffer(stream.queue, cl_buf, self.buffers[cl_buf],
+                    is_blocking=False)
 
     def build(self, source):
         preamble = ''
         if self.config.precision == 'double':
             preamble += '#pragma OPENCL EXTENSION cl_khr_fp64: enable\n'
-        return cl.Program(self.ctx, preamble + source).build() #'-cl-single-precision-constant -cl-fast-relaxed-math')
+        source = preamble + source
+        if self._kernel_cache is None:
+            return cl.Program(self.ctx, source).build() #'-cl-single-precision-constant -cl-fast-relaxed-math')
+
+        device = '{0} / {1} / {2}'.format(self._device.name,
+                self._device.platform.version, self._device.driver_version)
+        key = KernelCache.make_key(source, self.name, device)
+        binary = self._kernel_cache.get(key)
+        if binary is not None:
+            try:
+                return cl.Program(self.ctx, [self._device], [binary]).build()
+            except cl.Error:
+                # Corrupted or otherwise unusable entry -- rebuild it.
+                pass
+
+        prog = cl.Program(self.ctx, source).build()
+        self._kernel_cache.put(key, prog.get_info(cl.program_info.BINARIES)[0])
+        return prog
 
     def get_kernel(self, prog, name, block, args, args_format, shared=0,
             needs_iteration=False, more_shared=False):
@@ -181,7 +305,20 @@ class OpenCLBackend(object):
         for i, dim in enumerate(grid_size):
             global_size.append(dim * kernel.block[i])
 
-        cl.enqueue_nd_range_kernel(self.default_queue, kernel, global_size, kernel.block[0:len(global_size)])
+        if stream is None:
+            # Kernels run outside of any stream are ordered with respect to
+            # all streams, as in the CUDA backend.
+            self._default_queue_barrier()
+            cl.enqueue_nd_range_kernel(self.default_queue, kernel, global_size,
+                                       kernel.block[0:len(global_size)])
+            self._streams_barrier()
+            return
+
+        event = cl.enqueue_nd_range_kernel(stream.queue, kernel, global_size,
+                                           kernel.block[0:len(global_size)])
+        # Only stream queues have profiling enabled.
+        if self._kernel_events is not None:
+            self._kernel_events.append((kernel.function_name, event))
 
     def get_reduction_kernel(self, reduce_expr, map_expr, neutral, *args):
         """Generate and return reduction kernel; see PyOpenCL documentation
@@ -205,22 +342,43 @@ class OpenCLBackend(object):
         kernel = reduction.ReductionKernel(arrays[0].dtype, neutral=neutral,
                 reduce_expr=reduce_expr, map_expr=map_expr,
                 arguments=', '.join(arguments))
-        return lambda : kernel(*arrays).get()
+
+        def _reduce():
+            # The reduction runs in the default queue and has to see the
+            # results of all kernels enqueued in the streams.
+            self._default_queue_barrier()
+            return kernel(*arrays, queue=self.default_queue).get()
+        return _reduce
+
+    def collect_kernel_timings(self):
+        """Returns a list of (kernel name, execution time in seconds) for all
+        kernels run since the last call of this function."""
+        if not self._kernel_events:
+            return []
+
+        ret = []
+        for name, event in self._kernel_events:
+            event.wait()
+            ret.append((name, (event.profile.end - event.profile.start) / 1e9))
+        self._kernel_events = []
+        return ret
 
     def sync(self):
         self.default_queue.finish()
+        self._finish_streams()
 
     def make_stream(self):
-        return StreamWrapper(cl.CommandQueue(self.ctx,
+        stream = StreamWrapper(cl.CommandQueue(self.ctx,
                 properties=cl.command_queue_properties.PROFILING_ENABLE))
+        self._streams.append(stream)
+        return stream
 
     def make_event(self, stream, timing=False):
         return EventWrapper(cl.enqueue_marker(stream.queue))
 
     def get_defines(self):
         return {
-            # FIXME
-            'warp_size': 32,
+            'warp_size': self._warp_size(),
             'backend': 'opencl',
             'supports_shuffle': False,
             'supports_printf': False,
@@ -237,14 +395,27 @@ class OpenCLBackend(object):
         for s in streams:
             s.synchronize()
 
+    def sync_event(self, event):
+        event.event.wait()
+
+    def attach_thread(self):
+        """Makes the backend usable from the calling thread."""
+        pass
+
+    def detach_thread(self):
+        pass
+
 
 class EventWrapper(object):
     def __init__(self, event):
         self.event = event
 
     def time_since(self, other):
-        return 0
-        #return self.event.profile.end - other.event.profile.start
+        """Returns the time (in ms) elapsed between the completion of the
+        'other' event and this one."""
+        other.event.wait()
+        self.event.wait()
+        return (self.event.profile.end - other.event.profile.end) / 1e6
 
 
 class StreamWrapper(object):
@@ -252,7 +423,9 @@ class StreamWrapper(object):
         self.queue = cmd_queue
 
     def wait_for_event(self, event):
-        cl.enqueue_marker(self.queue, [event.event])
+        # A barrier (unlike a marker) prevents all subsequently enqueued
+        # commands from starting before the event is complete.
+        cl.enqueue_barrier(self.queue, wait_for=[event.event])
 
     def synchronize(self):
         self.queue.finish()
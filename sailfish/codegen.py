@@ -5,17 +5,34 @@ __author__ = 'Michal Januszewski'
 __email__ = 'sailfish-cfd@googlegroups.com'
 __license__ = 'LGPL3'
 
+import copy
+import functools
+import hashlib
+import inspect
 import os
 import re
 import sys
 import tempfile
 import mako.exceptions
+import numpy as np
+import sympy
 from mako.lookup import TemplateLookup
 from mako.template import Template
 
-from sailfish.lb_base import LBMixIn
+from sailfish.config import LBConfig
+from sailfish.lb_base import LBMixIn, LBSim
+from sailfish.node_type import DynamicValue
+from sailfish.util import file_lock
 import sailfish.io
 
+# Context entries which differ between otherwise identical subdomains.  The
+# templates only insert them verbatim into the generated code, so they are
+# replaced with placeholders during rendering, which makes it possible to
+# share the rendered code between subdomains.
+_SUBDOMAIN_PARAMS = ('x_local_device_to_global_offset',
+                     'y_local_device_to_global_offset',
+                     'z_local_device_to_global_offset')
+
 def _convert_to_double(src):
     """Converts all single-precision floating point literals to double
     precision ones.
@@ -49,6 +66,86 @@ def _use_intrinsics(t):
     t = t.replace('sqrtf(', '__fsqrt_rz(')
     return t
 
+def _canonical_repr(value):
+    """Returns a string representation of a code generation context value
+    that does not depend on the identity of any of the objects it refers to
+    or on the iteration order of unordered containers."""
+    if isinstance(value, dict):
+        return '{' + ','.join(sorted('{0}:{1}'.format(_canonical_repr(k),
+                                                      _canonical_repr(v))
+                                     for k, v in value.items())) + '}'
+    elif isinstance(value, (set, frozenset)):
+        return 'set(' + ','.join(sorted(_canonical_repr(x) for x in value)) + ')'
+    elif isinstance(value, (list, tuple)):
+        return '{0}({1})'.format(type(value).__name__,
+                                 ','.join(_canonical_repr(x) for x in value))
+    elif isinstance(value, np.ndarray):
+        return 'array({0},{1},{2})'.format(value.dtype.str, value.shape,
+                hashlib.sha1(np.ascontiguousarray(value).tostring()).hexdigest())
+    elif isinstance(value, sympy.Basic):
+        return sympy.srepr(value)
+    elif isinstance(value, functools.partial):
+        return 'partial({0},{1},{2})'.format(_canonical_repr(value.func),
+                                             _canonical_repr(value.args),
+                                             _canonical_repr(value.keywords or {}))
+    elif isinstance(value, DynamicValue):
+        return 'DynamicValue' + _canonical_repr(tuple(value.params))
+    elif inspect.isclass(value) or inspect.isroutine(value):
+        return '{0}.{1}'.format(value.__module__,
+                                getattr(value, '__qualname__', value.__name__))
+    elif hasattr(value, 'codegen_signature'):
+        return '{0}{1}'.format(type(value).__name__,
+                               _canonical_repr(value.codegen_signature()))
+    elif value is None or isinstance(value, (bool, int, float, str, np.generic)):
+        return '{0}:{1!r}'.format(type(value).__name__, value)
+    elif sys.version_info[0] < 3 and isinstance(value, (long, unicode)):
+        return '{0}:{1!r}'.format(type(value).__name__, value)
+    elif isinstance(value, LBConfig):
+        # Private attributes (e.g. the codegen directory) and the logger are
+        # specific to a single run and do not affect the generated code.
+        return 'LBConfig' + _canonical_repr(dict(
+            (k, v) for k, v in vars(value).items()
+            if not k.startswith('_') and k != 'logger'))
+    elif isinstance(value, LBSim):
+        # The templates only use the simulation object to access its grid.
+        # Everything else is passed through the context explicitly.
+        return '{0}(grid={1})'.format(_canonical_repr(type(value)),
+                                      _canonical_repr(value.grid))
+    raise TypeError('Unsupported code generation context value {0!r} of '
+                    'type {1}.'.format(value, type(value).__name__))
+
+
+def context_key(ctx, *extra):
+    """Returns a hash identifying the code rendered from a code generation
+    context.
+
+    :param ctx: code generation context
+    :param extra: additional values affecting the generated code
+    """
+    h = hashlib.sha1()
+    h.update(_canonical_repr((ctx, extra)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _parametrize_context(ctx):
+    """Replaces subdomain-specific values in ctx with placeholders.
+
+    Returns a dict mapping the placeholders to the original values.
+    """
+    params = {}
+    for name in _SUBDOMAIN_PARAMS:
+        if name in ctx:
+            placeholder = '__sailfish_{0}__'.format(name)
+            params[placeholder] = ctx[name]
+            ctx[name] = placeholder
+
+    block = copy.copy(ctx['block'])
+    params['__sailfish_block_id__'] = block.id
+    block.id = '__sailfish_block_id__'
+    ctx['block'] = block
+    return params
+
+
 class BlockCodeGenerator(object):
     """Generates CUDA/OpenCL code for a simulation of a subdomain."""
 
@@ -79,6 +176,19 @@ class BlockCodeGenerator(object):
                 help='cache the generated Mako templates in '
                      '/tmp/sailfish_modules-$USER', action='store_true',
                 default=False)
+        group.add_argument('--use_kernel_cache',
+                help='cache the compiled compute device programs on disk',
+                action='store_true', default=False)
+        group.add_argument('--kernel_cache_dir', type=str, default='',
+                help='directory in which to keep the compiled programs; '
+                     'defaults to /tmp/sailfish_kernels-$USER')
+        group.add_argument('--kernel_cache_size', type=int, default=256,
+                help='maximum size of the compiled program cache, in MiB; '
+                     'least recently used programs are removed first')
+        group.add_argument('--nodedup_codegen', dest='dedup_codegen',
+                help='do not share the generated code between subdomains '
+                     'with identical code generation contexts',
+                action='store_false', default=True)
         group.add_argument('--block_size', type=int, default=64,
                 help='size of the block of threads on the compute device')
         group.add_argument('--mem_alignment', type=int, default=32,
@@ -131,14 +241,6 @@ class BlockCodeGenerator(object):
         else:
             lookup = TemplateLookup(directories=template_dirs)
 
-        code_tmpl = lookup.get_template(self._sim.kernel_file)
-        ctx = self._build_context(subdomain_runner)
-        try:
-            src = code_tmpl.render(**ctx)
-        except:
-            print(mako.exceptions.text_error_template().render())
-            return ''
-
         aux_sources = list(self._sim.aux_code)
         # Allow mixin classes to provide their own aux_code values.
         for c in self._sim.__class__.mro()[1:]:
@@ -148,6 +250,45 @@ class BlockCodeGenerator(object):
                     if fn not in aux_sources:
                         aux_sources.append(fn)
 
+        ctx = self._build_context(subdomain_runner)
+        codegen_dir = getattr(self.config, '_codegen_dir', None)
+        if codegen_dir and self.config.dedup_codegen:
+            params = _parametrize_context(ctx)
+            try:
+                key = context_key(ctx, target_type, self._sim.kernel_file,
+                                  aux_sources)
+            except TypeError as e:
+                # The context cannot be reliably compared with the contexts
+                # of other subdomains.  Render the code for this subdomain
+                # only.
+                self.config.logger.debug('Not sharing generated code: '
+                                         '{0}'.format(e))
+                src = self._render(lookup, ctx, aux_sources, target_type)
+            else:
+                src = self._render_shared(codegen_dir, key,
+                        lambda: self._render(lookup, ctx, aux_sources,
+                                             target_type))
+            for placeholder, value in params.items():
+                src = src.replace(placeholder, str(value))
+        else:
+            src = self._render(lookup, ctx, aux_sources, target_type)
+
+        if self.config.save_src:
+            self.save_code(src,
+                    sailfish.io.source_filename(self.config.save_src,
+                        subdomain_runner._spec.id),
+                    self.config.format_src)
+
+        return src
+
+    def _render(self, lookup, ctx, aux_sources, target_type):
+        code_tmpl = lookup.get_template(self._sim.kernel_file)
+        try:
+            src = code_tmpl.render(**ctx)
+        except:
+            print(mako.exceptions.text_error_template().render())
+            return ''
+
         for aux in aux_sources:
             if aux.count('\n') > 0:
                 code_tmpl = Template(aux)
@@ -170,14 +311,26 @@ class BlockCodeGenerator(object):
             src = _remove_math_function_suffix(src)
             src = _remove_printf_calls(src)
 
-        if self.config.save_src:
-            self.save_code(src,
-                    sailfish.io.source_filename(self.config.save_src,
-                        subdomain_runner._spec.id),
-                    self.config.format_src)
-
         return src
 
+    def _render_shared(self, directory, key, render):
+        """Returns the code for the context identified by key, calling render
+        only if no other subdomain runner sharing the directory has already
+        generated it."""
+        path = os.path.join(directory, key + '.src')
+        with file_lock(path + '.lock'):
+            if os.path.exists(path):
+                self.config.logger.debug('Reusing code generated for another '
+                                         'subdomain.')
+                with open(path, 'r') as f:
+                    return f.read()
+
+            src = render()
+            if src:
+                with open(path, 'w') as f:
+                    f.write(src)
+            return src
+
     def save_code(self, code, dest_path, reformat=True):
         with open(dest_path, 'w') as fsrc:
             print(code, file=fsrc)
@@ -191,6 +344,12 @@ class BlockCodeGenerator(object):
     def is_double_precision(self):
         return self.config.precision == 'double'
 
+    def get_context(self, subdomain_runner):
+        """Returns the code generation context for a subdomain runner.
+
+        Used by backends that do not compile the generated source code."""
+        return self._build_context(subdomain_runner)
+
     def _build_context(self, subdomain_runner):
         ctx = {}
         ctx['block_size'] = self.config.block_size
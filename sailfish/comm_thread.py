@@ -0,0 +1,135 @@
+"""Background thread for exchanging data between subdomains.
+
+With the thread enabled, the subdomain runner only schedules the transfer of
+the data to be sent to the host, and hands the connectors over to the thread.
+The thread waits for the transfer to complete, sends the data, and receives
+the data from the connected subdomains into the host buffers, while the
+runner keeps scheduling work on the compute device.  The runner waits for
+the exchange to complete only when the received data is needed.
+
+Data from zero-copy connectors (see SHMSubdomainConnector) can be left in the
+connector's shared memory buffer instead of being copied into the host
+buffers.  The thread then only waits for the data to arrive, and the runner
+reads it directly from shared memory and releases the connector.
+"""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+if sys.version_info[0] >= 3:
+    def _reraise(exc_info):
+        raise exc_info[1].with_traceback(exc_info[2])
+else:
+    exec('def _reraise(exc_info):\n'
+         '    raise exc_info[0], exc_info[1], exc_info[2]\n')
+
+
+class Exchange(object):
+    """A single exchange of data with connected subdomains."""
+
+    def __init__(self, event, sends, recvs, quit_ev, zero_copy=False):
+        self.event = event
+        self.sends = sends
+        self.recvs = recvs
+        self.quit_ev = quit_ev
+        self.zero_copy = zero_copy
+        #: Maps zero-copy connectors to views of the received data.
+        self.views = {}
+        self._done = threading.Event()
+        self._ok = False
+        self._exc_info = None
+
+    def wait(self):
+        """Waits for the exchange to complete.
+
+        Returns False only if the quit event is active. Exceptions raised
+        in the communication thread are re-raised here, with their original
+        traceback."""
+        self._done.wait()
+        if self._exc_info is not None:
+            _reraise(self._exc_info)
+        return self._ok
+
+
+class CommThread(threading.Thread):
+    """Exchanges data between subdomains in the background.
+
+    Once an exchange is scheduled, its connectors and buffers are owned by
+    the thread until the exchange completes."""
+
+    #: Time (in seconds) to wait for the thread to finish when stopping it.
+    stop_timeout = 1.0
+
+    def __init__(self, backend):
+        threading.Thread.__init__(self, name='CommThread')
+        # Do not block process termination if the thread is waiting for
+        # data that will never arrive.
+        self.daemon = True
+        self._backend = backend
+        self._queue = queue.Queue()
+
+    def exchange(self, event, sends, recvs, quit_ev, zero_copy=False):
+        """Schedules an exchange of data.
+
+        :param event: backend event; the data in the send buffers is valid
+            once the event is completed
+        :param sends: list of (connector, list of arrays to send) tuples
+        :param recvs: list of (connector, list of arrays to receive into)
+            tuples
+        :param quit_ev: quit event
+        :param zero_copy: if True, data received by zero-copy connectors is
+            not copied into the arrays.  Views of it are stored in
+            Exchange.views instead, and the caller has to release() these
+            connectors once it is done with the data.
+        :rvalue: Exchange object
+        """
+        ex = Exchange(event, sends, recvs, quit_ev, zero_copy)
+        self._queue.put(ex)
+        return ex
+
+    def stop(self):
+        self._queue.put(None)
+        self.join(self.stop_timeout)
+
+    def _process(self, ex):
+        self._backend.sync_event(ex.event)
+        for connector, parts in ex.sends:
+            connector.send_parts(parts)
+        for connector, parts in ex.recvs:
+            if ex.zero_copy and connector.zero_copy:
+                view = connector.recv_view(ex.quit_ev)
+                if view is None:
+                    return False
+                ex.views[connector] = view
+            # Returns false only if quit event is active.
+            elif not connector.recv_parts(parts, ex.quit_ev):
+                return False
+        # Make sure the send buffers can be safely overwritten when the
+        # exchange is complete.
+        for connector, _ in ex.sends:
+            connector.wait_sent()
+        return True
+
+    def run(self):
+        self._backend.attach_thread()
+        try:
+            while True:
+                ex = self._queue.get()
+                if ex is None:
+                    break
+                try:
+                    ex._ok = self._process(ex)
+                except Exception:
+                    ex._exc_info = sys.exc_info()
+                ex._done.set()
+        finally:
+            self._backend.detach_thread()
@@ -28,6 +28,14 @@ class LBConfig(argparse.Namespace):
     def needs_iteration_num(self):
         return self.time_dependence or self.access_pattern == 'AA'
 
+    def is_explicit(self, option):
+        """Returns True if the value of option was chosen by the user or the
+        simulation, i.e. specified on the command line, in a config file, or
+        as a simulation-specific default.  Configs not created by
+        LBConfigParser are assumed to be fully specified."""
+        explicit = getattr(self, '_explicit_options', None)
+        return explicit is None or option in explicit
+
 
 class LBConfigParser(object):
     def __init__(self, description=None):
@@ -46,6 +54,8 @@ class LBConfigParser(object):
                                   default=False)
 
         self.config = LBConfig()
+        # Options whose defaults were changed with set_defaults().
+        self._changed_defaults = set()
 
     def add_group(self, name):
         return self._parser.add_argument_group(name)
@@ -54,6 +64,7 @@ class LBConfigParser(object):
         for option in defaults.keys():
             assert self._parser.get_default(option) is not None,\
                     'Unknown option "{0}" specified in update_defaults()'.format(option)
+        self._changed_defaults.update(defaults.keys())
         return self._parser.set_defaults(**defaults)
 
     def parse(self, args, internal_defaults=None):
@@ -65,8 +76,10 @@ class LBConfigParser(object):
         # the symbolic expressions module even for LB models where this option is not
         # supported.
         self.config.incompressible = False
+        explicit = set(self._changed_defaults)
         try:
             self._parser.set_defaults(**dict(config.items('main')))
+            explicit.update(k for k, _ in config.items('main'))
         except configparser.NoSectionError:
             pass
 
@@ -75,6 +88,15 @@ class LBConfigParser(object):
 
         self._parser.parse_args(args=args, namespace=self.config)
 
+        # argparse only sets the defaults for attributes missing in the
+        # namespace, so parsing into a namespace filled with placeholders
+        # reveals the options specified on the command line.
+        unset = object()
+        cmdline = argparse.Namespace(**dict((k, unset) for k in vars(self.config)))
+        self._parser.parse_args(args=args, namespace=cmdline)
+        explicit.update(k for k, v in vars(cmdline).items() if v is not unset)
+        self.config._explicit_options = explicit
+
         # Additional internal config options, not settable via
         # command line parameters.
         self.config.relaxation_enabled = True
@@ -8,18 +8,74 @@ try:
     import blosc
 except ImportError:
     pass
+import ctypes
 import os
+import select
 import tempfile
 import sys
+import time
 if sys.version_info > (3,):
     buffer = memoryview
 
 import numpy as np
-from multiprocessing import Array, Event
+from multiprocessing import Array, Event, RawArray
+
+class SubdomainConnector(object):
+    """Base class for connectors.
+
+    A message can consist of multiple parts (e.g. data from different
+    connection buffers), which are sent with send_parts() and received
+    directly into the target buffers with recv_parts().  The default
+    implementation of these methods aggregates the parts into a single
+    message.
+    """
+
+    #: If True, the connector supports recv_view() and release().
+    zero_copy = False
+
+    def send_parts(self, parts):
+        """Sends a message consisting of a list of arrays.
+
+        The arrays must not be modified until wait_sent() returns."""
+        self.send(np.hstack([np.ravel(x) for x in parts]))
+
+    def recv_parts(self, parts, quit_ev):
+        """Receives a message sent with send_parts() into a list of arrays.
+
+        Returns False only if the quit event is set."""
+        data = np.empty(sum(x.size for x in parts), dtype=parts[0].dtype)
+        if not self.recv(data, quit_ev):
+            return False
+        i = 0
+        for x in parts:
+            x[:] = data[i:i + x.size].reshape(x.shape)
+            i += x.size
+        return True
+
+    def wait_sent(self):
+        """Waits until the arrays from previous calls to send_parts() can be
+        safely modified."""
+        pass
+
+    def stats(self):
+        """Returns a dict with statistics of the transferred data, or None
+        if the connector does not collect any."""
+        return None
+
+    def close_unused(self):
+        """Releases the resources inherited from the master process that
+        are only used by the other side of the connection.  Called from the
+        subdomain runner after init_runner()."""
+        pass
+
+    def close(self):
+        """Releases the resources used by the connector."""
+        pass
+
 
 # Note: this connector is currently slower than ZMQSubdomainConnector using
 # IPC.
-class MPSubdomainConnector(object):
+class MPSubdomainConnector(SubdomainConnector):
     """Handles directed data exchange between two subdomains using the
     multiprocessing module."""
 
@@ -70,8 +126,172 @@ class MPSubdomainConnector(object):
                 MPSubdomainConnector(array2, array1, ev2, ev1, ev4, ev3))
 
 
-class ZMQSubdomainConnector(object):
-    """Handles directed data exchange between two subdomains using 0MQ."""
+class SHMSubdomainConnector(SubdomainConnector):
+    """Handles directed data exchange between two subdomains on the same host
+    using shared memory.
+
+    Data sent in every direction goes through a double buffer, i.e. two
+    slots in shared memory used alternately.  Every slot is large enough
+    to hold the largest message, and the size of the message it actually
+    contains is stored alongside it.  The sender fills a slot and
+    signals the receiver by writing a byte to a pipe.  The receiver returns
+    the slot to the sender through another pipe once its contents are no
+    longer needed, so that the sender can fill one slot while the receiver
+    is still processing the other one.
+
+    The receiver can access the data directly in shared memory, without
+    copying it to a local buffer first (see recv_view()).
+    """
+
+    zero_copy = True
+
+    #: Interval (in seconds) at which the quit event is checked while waiting.
+    poll_interval = 0.1
+
+    def __init__(self, send_array, recv_array, send_fds, recv_fds,
+            quit_ev=None):
+        """
+        :param send_array: tuple of shared arrays: two slots for sent data,
+            and the sizes of the messages in these slots
+        :param recv_array: like send_array, for received data
+        :param send_fds: file descriptors used for sending: the read end
+            of the pipe signaling free slots and the write end of the pipe
+            signaling filled slots
+        :param recv_fds: file descriptors used for receiving: the read end
+            of the pipe signaling filled slots and the write end of the pipe
+            signaling free slots
+        :param quit_ev: if set, the sender stops waiting for a free slot
+            and drops the data
+        """
+        self._send_array = send_array
+        self._recv_array = recv_array
+        self._free_fd, self._filled_fd = send_fds
+        self._recv_filled_fd, self._recv_free_fd = recv_fds
+        # File descriptors of the other connector of the pair, set in
+        # make_pair().
+        self._peer_fds = []
+        self._closed = False
+        self._quit_ev = quit_ev
+        self._send_slot = 0
+        self._recv_slot = 0
+        self._send_slots = None
+        self._send_sizes = None
+        self._recv_slots = None
+        self._recv_sizes = None
+        self.port = None
+        self.ipc_file = None
+
+    def _wait(self, fd, quit_ev):
+        """Waits for a signal on fd. Returns False if quit_ev got set."""
+        while True:
+            if quit_ev is not None and quit_ev.is_set():
+                return False
+            ready, _, _ = select.select([fd], [], [], self.poll_interval)
+            if ready:
+                os.read(fd, 1)
+                return True
+
+    def init_runner(self, ctx):
+        """Called from the block runner of the sender block."""
+        self._send_slots = np.ctypeslib.as_array(self._send_array[0]).reshape(2, -1)
+        self._send_sizes = self._send_array[1]
+        self._recv_slots = np.ctypeslib.as_array(self._recv_array[0]).reshape(2, -1)
+        self._recv_sizes = self._recv_array[1]
+
+    def send(self, data):
+        self.send_parts([data])
+
+    def send_parts(self, parts):
+        if not self._wait(self._free_fd, self._quit_ev):
+            return
+        slot = self._send_slots[self._send_slot]
+        i = 0
+        for x in parts:
+            slot[i:i + x.size] = np.ravel(x)
+            i += x.size
+        self._send_sizes[self._send_slot] = i
+        os.write(self._filled_fd, b'\0')
+        self._send_slot ^= 1
+
+    def recv_parts(self, parts, quit_ev):
+        view = self.recv_view(quit_ev)
+        if view is None:
+            return False
+        i = 0
+        for x in parts:
+            x[:] = view[i:i + x.size].reshape(x.shape)
+            i += x.size
+        self.release()
+        return True
+
+    def recv_view(self, quit_ev):
+        """Waits for data and returns a view of it in shared memory.
+
+        The view is valid until release() is called, which needs to happen
+        before the next call to recv_view(), recv() or recv_parts().
+
+        :rvalue: numpy array, or None if the quit event is set
+        """
+        if not self._wait(self._recv_filled_fd, quit_ev):
+            return None
+        slot = self._recv_slot
+        return self._recv_slots[slot][:self._recv_sizes[slot]]
+
+    def release(self):
+        """Returns the slot obtained with recv_view() to the sender."""
+        self._recv_slot ^= 1
+        os.write(self._recv_free_fd, b'\0')
+
+    def recv(self, data, quit_ev):
+        return self.recv_parts([data], quit_ev)
+
+    def is_ready(self):
+        return True
+
+    @property
+    def fds(self):
+        """File descriptors used by this connector."""
+        return [self._free_fd, self._filled_fd, self._recv_filled_fd,
+                self._recv_free_fd]
+
+    def close_unused(self):
+        for fd in self._peer_fds:
+            os.close(fd)
+        self._peer_fds = []
+
+    def close(self):
+        if self._closed:
+            return
+        for fd in self.fds:
+            os.close(fd)
+        self._closed = True
+
+    @classmethod
+    def make_pair(self, ctype, sizes, ids, quit_ev=None):
+        array1 = RawArray(ctype, 2 * sizes[0]), RawArray(ctypes.c_long, 2)
+        array2 = RawArray(ctype, 2 * sizes[1]), RawArray(ctypes.c_long, 2)
+        # Pipes signaling filled and free slots, for data sent in both
+        # directions. Every slot is initially free.
+        filled1 = os.pipe()
+        free1 = os.pipe()
+        filled2 = os.pipe()
+        free2 = os.pipe()
+        os.write(free1[1], b'\0\0')
+        os.write(free2[1], b'\0\0')
+
+        c1 = SHMSubdomainConnector(array1, array2, (free1[0], filled1[1]),
+                                   (filled2[0], free2[1]), quit_ev)
+        c2 = SHMSubdomainConnector(array2, array1, (free2[0], filled2[1]),
+                                   (filled1[0], free1[1]), quit_ev)
+        c1._peer_fds = c2.fds
+        c2._peer_fds = c1.fds
+        return c1, c2
+
+
+class ZMQSubdomainConnector(SubdomainConnector):
+    """Handles directed data exchange between two subdomains using 0MQ.
+
+    Multipart messages are sent without copying, as one frame per part."""
 
     def __init__(self, addr, receiver=False):
         """
@@ -80,6 +300,7 @@ class ZMQSubdomainConnector(object):
         """
         self._addr = addr
         self._receiver = receiver
+        self._trackers = []
         self.port = None
 
         if addr.startswith('ipc://'):
@@ -107,6 +328,24 @@ class ZMQSubdomainConnector(object):
         data[:] = np.frombuffer(buffer(msg), dtype=data.dtype)
         return True
 
+    def send_parts(self, parts):
+        self._trackers.append(self.socket.send_multipart(
+            [np.ravel(x) for x in parts], copy=False, track=True))
+
+    def recv_parts(self, parts, quit_ev):
+        if quit_ev.is_set():
+            return False
+
+        frames = self.socket.recv_multipart(copy=False)
+        for x, frame in zip(parts, frames):
+            x[:] = np.frombuffer(buffer(frame), dtype=x.dtype).reshape(x.shape)
+        return True
+
+    def wait_sent(self):
+        for tracker in self._trackers:
+            tracker.wait()
+        self._trackers = []
+
     def is_ready(self):
         return True
 
@@ -169,3 +408,181 @@ class CompressedZMQRemoteSubdomainConnector(ZMQRemoteSubdomainConnector):
         msg = self.socket.recv(copy=False)
         data[:] = blosc.unpack_array(bytes(msg))
         return True
+
+    def send_parts(self, parts):
+        self.socket.send_multipart([blosc.pack_array(np.ravel(x)) for x in
+                                    parts], copy=False)
+
+    def recv_parts(self, parts, quit_ev):
+        if quit_ev.is_set():
+            return False
+
+        frames = self.socket.recv_multipart(copy=False)
+        for x, frame in zip(parts, frames):
+            x[:] = blosc.unpack_array(bytes(frame)).reshape(x.shape)
+        return True
+
+    def wait_sent(self):
+        pass
+
+
+class AdaptiveCompressedZMQRemoteSubdomainConnector(ZMQRemoteSubdomainConnector):
+    """Like ZMQRemoteSubdomainConnector, but compresses the data whenever this
+    is expected to shorten the transfer.
+
+    The data can be sent as is, or compressed with blosc after byte or bit
+    shuffling, or after computing the difference (XOR) with the data sent
+    in the same kind of message in the previous step.  The last option
+    works well for smooth flows, where the distributions change little
+    between steps.  Every probe_interval messages, all encodings are applied
+    to the message being sent, and the one minimizing the estimated transfer
+    time (encoding and decoding time, and the time to send the encoded data
+    at the link bandwidth) is used until the next probe.
+    """
+
+    RAW, SHUFFLE, BITSHUFFLE, DELTA = range(4)
+    encoding_names = ('raw', 'shuffle', 'bitshuffle', 'delta')
+
+    def __init__(self, addr, receiver=False, bandwidth=1250.0,
+                 probe_interval=100, encodings=None):
+        """
+        :param bandwidth: link bandwidth, in MB/s
+        :param probe_interval: number of messages after which the encodings
+            are reevaluated
+        :param encodings: list of encodings to choose from; all encodings
+            supported by the installed version of blosc if None.  blosc is
+            not necessary if only RAW is used.
+        """
+        if encodings is None:
+            # Fail early if blosc is not available.
+            import blosc
+            encodings = [self.RAW, self.SHUFFLE, self.DELTA]
+            if hasattr(blosc, 'BITSHUFFLE'):
+                encodings.append(self.BITSHUFFLE)
+        ZMQRemoteSubdomainConnector.__init__(self, addr, receiver)
+        self.bandwidth = bandwidth * 1e6
+        self.probe_interval = probe_interval
+        self.encodings = list(encodings)
+        self._encoding = self.encodings[0]
+        self._sent_messages = 0
+        # Data from the previous message with the same part sizes, for the
+        # delta encoding.  Kept separately for sent and received data.
+        self._prev_sent = {}
+        self._prev_recv = {}
+        self._stats = {
+            'raw_bytes': 0,
+            'sent_bytes': 0,
+            'encode_time': 0.0,
+            'decode_time': 0.0,
+            'messages': dict((name, 0) for name in self.encoding_names),
+        }
+
+    @staticmethod
+    def _prev(prev_map, parts):
+        key = tuple(x.size for x in parts)
+        if key not in prev_map:
+            prev_map[key] = [np.zeros(x.size, dtype=x.dtype) for x in parts]
+        return prev_map[key]
+
+    @staticmethod
+    def _as_uint(x):
+        return x.view(np.dtype('u{0}'.format(x.dtype.itemsize)))
+
+    def _encode(self, x, prev, encoding):
+        """Returns the encoded data from the contiguous array x."""
+        if encoding == self.RAW:
+            return x
+        if encoding == self.DELTA:
+            x = np.bitwise_xor(self._as_uint(x), self._as_uint(prev))
+            shuffle = blosc.SHUFFLE
+        elif encoding == self.BITSHUFFLE:
+            shuffle = blosc.BITSHUFFLE
+        else:
+            shuffle = blosc.SHUFFLE
+        return blosc.compress_ptr(x.__array_interface__['data'][0], x.size,
+                                  typesize=x.dtype.itemsize, clevel=5,
+                                  shuffle=shuffle)
+
+    def _decode(self, x, data, prev, encoding):
+        """Decodes data into the array x.
+
+        :param data: object exposing the buffer interface for RAW data,
+            bytes otherwise
+        """
+        if encoding == self.RAW:
+            x[:] = np.frombuffer(data, dtype=x.dtype).reshape(x.shape)
+            return
+        decoded = np.frombuffer(blosc.decompress(data), dtype=x.dtype)
+        if encoding == self.DELTA:
+            decoded = np.bitwise_xor(self._as_uint(decoded),
+                                     self._as_uint(prev)).view(x.dtype)
+        x[:] = decoded.reshape(x.shape)
+
+    def _probe(self, parts, prev):
+        """Selects the encoding with the shortest estimated transfer time."""
+        best = None
+        for encoding in self.encodings:
+            t0 = time.time()
+            encoded = [self._encode(x, p, encoding) for x, p in zip(parts, prev)]
+            t1 = time.time()
+            size = 0
+            for x, p, data in zip(parts, prev, encoded):
+                size += len(buffer(data)) if encoding != self.RAW else x.nbytes
+                self._decode(np.empty_like(x), data, p, encoding)
+            t2 = time.time()
+            estimate = t2 - t0 + size / self.bandwidth
+            if best is None or estimate < best[0]:
+                best = estimate, encoding
+        self._encoding = best[1]
+
+    def send_parts(self, parts):
+        parts = [np.ascontiguousarray(np.ravel(x)) for x in parts]
+        prev = self._prev(self._prev_sent, parts)
+        if (len(self.encodings) > 1 and
+                self._sent_messages % self.probe_interval == 0):
+            self._probe(parts, prev)
+        self._sent_messages += 1
+
+        encoding = self._encoding
+        t0 = time.time()
+        frames = [np.uint8([encoding])]
+        frames.extend(self._encode(x, p, encoding) for x, p in zip(parts, prev))
+        self._stats['encode_time'] += time.time() - t0
+        for x, p in zip(parts, prev):
+            p[:] = x
+
+        self._stats['messages'][self.encoding_names[encoding]] += 1
+        self._stats['raw_bytes'] += sum(x.nbytes for x in parts)
+        self._stats['sent_bytes'] += sum(
+            x.nbytes if encoding == self.RAW else len(data)
+            for x, data in zip(parts, frames[1:]))
+        # Unencoded parts are sent without copying.
+        self._trackers.append(self.socket.send_multipart(
+            frames, copy=False, track=True))
+
+    def recv_parts(self, parts, quit_ev):
+        if quit_ev.is_set():
+            return False
+
+        frames = self.socket.recv_multipart(copy=False)
+        encoding = bytearray(frames[0].bytes)[0]
+        prev = self._prev(self._prev_recv, parts)
+        t0 = time.time()
+        for x, p, frame in zip(parts, prev, frames[1:]):
+            if encoding == self.RAW:
+                data = buffer(frame)
+            else:
+                data = frame.bytes
+            self._decode(x, data, p, encoding)
+            p[:] = np.ravel(x)
+        self._stats['decode_time'] += time.time() - t0
+        return True
+
+    def send(self, data):
+        self.send_parts([data])
+
+    def recv(self, data, quit_ev):
+        return self.recv_parts([data], quit_ev)
+
+    def stats(self):
+        return self._stats
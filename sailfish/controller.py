@@ -19,6 +19,7 @@ except ImportError:
 import copy
 import math
 import imp
+import json
 import logging
 import os
 import platform
@@ -32,7 +33,9 @@ from collections import defaultdict
 from multiprocessing import Process
 
 import zmq
-from sailfish import codegen, config, io, util
+from sailfish import autotune, codegen, config, io, placement, \
+        subdomain_runner, util
+from sailfish.backend_dummy import DummyBackend
 from sailfish.geo import LBGeometry2D, LBGeometry3D
 from sailfish.lb_base import LBMixIn, LBForcedSim
 from sailfish.subdomain import SubdomainPair
@@ -124,14 +127,17 @@ class LBGeometryProcessor(object):
     Initializes logical connections between the subdomains based on their
     location."""
 
-    def __init__(self, subdomains, dim, gsize):
+    def __init__(self, subdomains, dim, gsize, sparse=False):
         """
         :param subdomains: list of SubdomainSpec objects
         :param gsize: tuple specifying the bounding box of the simulation domain
+        :param sparse: if True, the subdomains are allowed to cover only
+            a part of the domain, and not all of them need to be connected
         """
         self.subdomains = subdomains
         self.dim = dim
         self.gsize = gsize
+        self.sparse = sparse
 
     def _annotate(self):
         # Assign IDs to subdomains.  The subdomain ID corresponds to its position
@@ -251,7 +257,8 @@ class LBGeometryProcessor(object):
                     try_connect(subdomain, neighbor_candidate)
 
         # Ensure every subdomain is connected to at least one other subdomain.
-        if len(self.subdomains) > 1 and len(connected) != len(self.subdomains):
+        if (len(self.subdomains) > 1 and not self.sparse and
+                len(connected) != len(self.subdomains)):
             raise GeometryError('Not all subdomains are connected.')
 
     def transform(self, config):
@@ -316,8 +323,8 @@ class LBSimulationController(object):
                            'if the selected format supports it')
         group.add_argument('--backends',
             type=str, default='cuda,opencl',
-            help='computational backends to use; multiple backends '
-                 'can be separated by a comma')
+            help='computational backends to use (cuda, opencl, numpy); '
+                 'multiple backends can be separated by a comma')
         group.add_argument('--vis_engine',
             type=str, default='pygame',
             help='visualization engine to use')
@@ -374,6 +381,20 @@ class LBSimulationController(object):
                            default=True, dest='cluster_lsf', help='If True, '
                            'standard LSF variables will be used to run the job '
                            'in a cluster.')
+        group.add_argument('--subdomain_placement', type=str,
+                           default='contiguous', choices=['contiguous', 'graph'],
+                           help='How to assign subdomains to cluster nodes and '
+                           'GPUs.  contiguous: consecutive subdomains are '
+                           'assigned to the same node, and distributed between '
+                           'its GPUs in a round-robin fashion; graph: the '
+                           'connection graph of the subdomains is partitioned '
+                           'so that the number of active nodes per GPU is '
+                           'balanced and the amount of data exchanged between '
+                           'hosts and GPUs is minimized.')
+        group.add_argument('--placement_max_imbalance', type=float,
+                           default=0.1, help='maximum relative excess of the '
+                           'load of a node or GPU over the average allowed '
+                           'when optimizing --subdomain_placement=graph')
         group.add_argument('--nofdust', action='store_false',
                            default=True, dest='fdust', help='If True, will use '
                            'logical GPUs 0..n via libfairydust (if present).')
@@ -387,13 +408,51 @@ class LBSimulationController(object):
                 default=True, help='If True, will terminate the simulation '
                 'when invalid values (inf, nan) are detected in the domain '
                 'during the simulation.')
+        group.add_argument('--local_connector', type=str,
+                choices=['shm', 'zmq'], default='shm',
+                help='Method used to exchange data between subdomains '
+                'simulated on the same host: shm uses a double buffer in '
+                'shared memory, zmq uses 0MQ IPC sockets.')
+        group.add_argument('--comm_thread', action='store_true',
+                default=False, help='Exchanges data with other subdomains '
+                'in a background thread, so that the subdomain runner can '
+                'keep scheduling work on the GPU while waiting for data.')
+        group.add_argument('--sparse_halo', action='store_true',
+                default=False, help='Exchanges data only for nodes active on '
+                'both sides of every connection between subdomains, instead '
+                'of for the whole face of the subdomain.  Reduces the amount '
+                'of exchanged data for domains with many inactive nodes '
+                '(e.g. porous media) simulated with '
+                '--node_addressing=indirect.  Only supported with '
+                '--access_pattern=AB.')
         group.add_argument('--compress_intersubdomain_data',
                 action='store_true', default=False, help='Uses blosc to '
                 'compress data exchanged between subdomains. Can improve '
                 'performance in distributed simulations limited by bandwidth '
                 'available between computational nodes.')
+        group.add_argument('--adaptive_compression', action='store_true',
+                default=False, help='Compresses data exchanged between '
+                'subdomains on different hosts only when this is expected to '
+                'reduce the transfer time, selecting the encoding (none, '
+                'shuffle, bitshuffle, or difference from the previous step) '
+                'separately for every connection.  Requires blosc.')
+        group.add_argument('--link_bandwidth', type=float, default=1250.0,
+                help='Bandwidth (in MB/s) of the network link between hosts, '
+                'used to estimate the transfer time with '
+                '--adaptive_compression.')
+        group.add_argument('--compression_probe_interval', type=int,
+                default=100, help='Number of messages after which the '
+                'encodings are reevaluated with --adaptive_compression.')
         group.add_argument('--seed', type=int, default=int(time.time()),
                 help='PRNG seed value')
+        group.add_argument('--dry_run', action='store_true', default=False,
+                help='only decompose the domain and report the estimated '
+                'memory usage and communication volume of every subdomain '
+                '(as JSON), without running the simulation.  No computational '
+                'backend is necessary in this mode.')
+        group.add_argument('--dry_run_report', type=str, default='',
+                metavar='PATH', help='file to which to save the --dry_run '
+                'report; printed to the standard output if empty')
 
         group = self._config_parser.add_group('Checkpointing')
         group.add_argument('--checkpoint_file', type=str, help='Location of '
@@ -427,6 +486,22 @@ class LBSimulationController(object):
         group.add_argument('--benchmark_minibatch', type=int, default=50,
                            help='Number of simulation steps used for batching '
                            'for purposes of standard deviation calculation.')
+
+        group = self._config_parser.add_group('Autotuning')
+        group.add_argument('--autotune', action='store_true', default=False,
+                           help='benchmark the compute kernels with different '
+                           'values of --block_size and --mem_alignment before '
+                           'starting the simulation, and store the fastest '
+                           'configuration in the tuning database')
+        group.add_argument('--autotune_iters', type=int, default=200,
+                           metavar='N', help='number of steps to simulate '
+                           'for every candidate launch configuration')
+        group.add_argument('--tuning_db', type=str,
+                           default='~/.sailfish/tuning.json', metavar='PATH',
+                           help='tuning database; launch configurations '
+                           'stored in it are used for --block_size and '
+                           '--mem_alignment unless these are set '
+                           'explicitly. Set to an empty string to disable.')
         group = self._config_parser.add_group('Simulation-specific settings')
 
         for base in lb_class.mro():
@@ -495,7 +570,15 @@ class LBSimulationController(object):
                         os.path.expanduser('~/.sailfish/{0}'.format(self.config.cluster_spec)))
 
         self._cluster_gateways = []
-        self._node_subdomains = split_subdomains_between_nodes(cluster.nodes, subdomains)
+        if self.config.subdomain_placement == 'graph':
+            self._node_subdomains = placement.partition_subdomains(
+                subdomains, [len(node.gpus) for node in cluster.nodes],
+                self.config.placement_max_imbalance)
+            while not self._node_subdomains[-1]:
+                self._node_subdomains.pop()
+        else:
+            self._node_subdomains = split_subdomains_between_nodes(
+                cluster.nodes, subdomains)
 
         import execnet
         for _, node in zip(self._node_subdomains, cluster.nodes):
@@ -751,6 +834,60 @@ class LBSimulationController(object):
 
         return None, None
 
+    def _dry_run(self, subdomains):
+        """Estimates the resources required to simulate every subdomain.
+
+        :param subdomains: list of connected SubdomainSpec objects
+        :rvalue: report as a JSON-serializable dict
+        """
+        self.config.logger = util.setup_logger(self.config)
+        sim = self._lb_class(self.config)
+        runner_cls = sim.subdomain_runner
+        if runner_cls is None:
+            runner_cls = subdomain_runner.SubdomainRunner
+
+        report = []
+        for spec in subdomains:
+            runner = runner_cls(sim, spec, output=None,
+                                backend=DummyBackend(), quit_event=None)
+            runner._init_shape()
+            if self.config.node_addressing == 'indirect':
+                # Only needed to get the number of active nodes.
+                runner._subdomain = sim.subdomain(runner._global_size, spec,
+                                                  sim.grid)
+            if self.config.node_addressing == 'indirect':
+                active_nodes = runner._subdomain.active_nodes
+            else:
+                active_nodes = runner.num_nodes
+            report.append({
+                'id': spec.id,
+                'location': list(spec.location),
+                'size': list(spec.size),
+                'nodes': runner.num_nodes,
+                'active_nodes': active_nodes,
+                'allocated_nodes': runner.num_active_nodes,
+                'memory': runner.estimate_memory(),
+                'halo_bytes_per_step': dict(
+                    (str(block_id), {'sent': sent, 'received': received})
+                    for block_id, (sent, received) in
+                    runner.halo_traffic().items()),
+            })
+            runner._ctx.term()
+            spec.runner = None
+
+        ret = {
+            'access_pattern': self.config.access_pattern,
+            'node_addressing': self.config.node_addressing,
+            'precision': self.config.precision,
+            'subdomains': report,
+        }
+        if self.config.dry_run_report:
+            with open(self.config.dry_run_report, 'w') as f:
+                json.dump(ret, f, indent=2, sort_keys=True)
+        else:
+            print(json.dumps(ret, indent=2, sort_keys=True))
+        return ret
+
     def save_subdomain_config(self, subdomains):
         if self.config.output:
             dname = os.path.dirname(self.config.output)
@@ -787,6 +924,13 @@ class LBSimulationController(object):
         self._lb_class.modify_config(self.config)
         self.set_default_filenames()
 
+        if self.config.sparse_halo and self.config.access_pattern != 'AB':
+            raise ValueError('--sparse_halo is only supported with '
+                             '--access_pattern=AB.')
+
+        if self.config.autotune:
+            autotune.autotune(self.config, self.dim)
+
         self.geo = self._lb_geo(self.config)
 
         ctx = zmq.Context()
@@ -802,8 +946,13 @@ class LBSimulationController(object):
 
         self._init_subdomain_envelope(self._lb_class, subdomain_specs)
 
-        proc = LBGeometryProcessor(subdomain_specs, self.dim, self.geo.gsize)
+        proc = LBGeometryProcessor(subdomain_specs, self.dim, self.geo.gsize,
+                                   self.geo.sparse)
         subdomain_specs = proc.transform(self.config)
+        if self.config.dry_run:
+            summary_receiver.close()
+            ctx.term()
+            return self._dry_run(subdomain_specs)
         self.save_subdomain_config(subdomain_specs)
 
         self.config.cmdline = ' '.join(sys.argv)
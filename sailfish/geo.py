@@ -13,6 +13,10 @@ from sailfish import util
 class LBGeometry(object):
     """Describes the high-level geometry of a LB simulation."""
 
+    #: If True, the subdomains do not need to cover the whole domain and
+    #: some of them might not be connected to any other subdomain.
+    sparse = False
+
     def __init__(self, config):
         self.config = config
         self.gx = config.lat_nx
@@ -34,6 +38,33 @@ class LBGeometry2D(LBGeometry):
         group.add_argument('--periodic_y', dest='periodic_y',
                 help='make the lattice periodic in the Y direction',
                 action='store_true', default=False)
+        group.add_argument('--geometry_threads', type=int, default=1,
+                help='number of threads to use for processing the '
+                'geometry of a subdomain (link tagging, orientation '
+                'detection)')
+        group.add_argument('--sparse_coordinates', action='store_true',
+                default=False, help='pass broadcastable (np.ogrid-style) '
+                'coordinate arrays instead of full ones to '
+                'boundary_conditions() and initial_conditions(). This saves '
+                'host memory, but requires all expressions using the '
+                'coordinates to support broadcasting.')
+        group.add_argument('--geometry_slab_size', type=int, default=0,
+                help='if > 0, process the geometry of a subdomain in slabs '
+                'of this many nodes along the slowest-changing axis (Z in '
+                '3D, Y in 2D), so that the temporary host memory used '
+                'scales with the slab size instead of the subdomain volume. '
+                'boundary_conditions() is then called once per slab, with '
+                'coordinate arrays covering the slab only.')
+        group.add_argument('--geometry_cache_dir', type=str, default='',
+                help='directory in which to cache the processed and encoded '
+                'geometry of the subdomains, so that it does not need to be '
+                'computed again in later runs of the same simulation (e.g. '
+                'when restarting from a checkpoint); caching is disabled if '
+                'empty')
+        group.add_argument('--geometry_version', type=str, default='',
+                help='user-provided version of the geometry, used as part of '
+                'the geometry cache key.  Change it whenever '
+                'boundary_conditions() or any data it uses is modified.')
 
     def subdomains(self):
         """Returns a 1-element list containing a single 2D block
@@ -147,16 +178,24 @@ class WeightedSubdomainsGeometry3D(EqualSubdomainsGeometry3D):
         if not self.config.geometry_for_decomposition:
             return super(WeightedSubdomainsGeometry3D, self).subdomains()
 
-        geo = util.load_array(self.config.geometry_for_decomposition)
+        geo = util.open_array(self.config.geometry_for_decomposition)
 
         assert self.gz == geo.shape[0]
         assert self.gy == geo.shape[1]
         assert self.gx == geo.shape[2]
 
-        axes = set([0, 1, 2])
         conn_axis = 'xyz'.index(self.config.conn_axis)
-        axes.remove(conn_axis)
-        profile = np.sum(np.logical_not(geo), axis=tuple(axes))
+        # Number of active nodes in every plane orthogonal to the connection
+        # axis.  The array is processed in chunks so that it never has to be
+        # fully loaded into memory.
+        profile = np.zeros(geo.shape[2 - conn_axis], dtype=np.int64)
+        for chunk in util.chunk_slices(geo.shape):
+            active = np.logical_not(geo[chunk])
+            if conn_axis == 2:
+                profile[chunk] = np.sum(active, axis=(1, 2))
+            else:
+                profile += np.sum(active, axis=tuple(
+                    set([0, 1, 2]) - set([2 - conn_axis])))
         profile = np.cumsum(profile)
 
         start = [0, 0, 0]
@@ -174,3 +213,298 @@ class WeightedSubdomainsGeometry3D(EqualSubdomainsGeometry3D):
             size[conn_axis] = len(profile) - start[conn_axis]
             ret.append(SubdomainSpec3D(start, size))
         return ret
+
+
+class BisectedSubdomainsGeometry3D(WeightedSubdomainsGeometry3D):
+    """Divides a cuboid domain into a configurable number of subdomains
+    by recursive bisection along all three axes.
+
+    At every step, the current box is split into two parts receiving
+    floor(n/2) and ceil(n/2) of the subdomains, with the number of active
+    nodes (taken from --geometry_for_decomposition, if specified) in every
+    part proportional to its number of subdomains.  Among the splits which
+    keep the imbalance within --max_imbalance, the one with the smallest
+    cut area is selected, which minimizes the area of the faces connecting
+    the subdomains.  Compared to the decompositions along a single axis,
+    this avoids thin slabs with a large surface-to-volume ratio when
+    many subdomains are used."""
+
+    @classmethod
+    def add_options(cls, group):
+        WeightedSubdomainsGeometry3D.add_options(group)
+        group.add_argument('--max_imbalance', type=float, default=0.05,
+                           help='maximum relative excess of active nodes in '
+                           'a subdomain over the average, used when '
+                           'selecting the axis along which to split the '
+                           'domain in recursive bisection')
+
+    def _profiles(self, geo, box):
+        """Returns the number of active nodes in every plane of box
+        orthogonal to the X, Y and Z axes, respectively.
+
+        :param geo: array of inactive nodes in (z, y, x) order or None if
+            all nodes are active
+        :param box: list of (start, stop) tuples along the X, Y and Z axes
+        """
+        extents = [stop - start for start, stop in box]
+        if geo is None:
+            volume = np.prod(extents)
+            return [np.zeros(e, dtype=np.int64) + volume // e for e in extents]
+
+        (x0, x1), (y0, y1), (z0, z1) = box
+        profiles = [np.zeros(e, dtype=np.int64) for e in extents]
+        for chunk in util.chunk_slices(tuple(reversed(extents))):
+            active = np.logical_not(geo[z0 + chunk.start:z0 + chunk.stop,
+                                        y0:y1, x0:x1])
+            profiles[0] += np.sum(active, axis=(0, 1))
+            profiles[1] += np.sum(active, axis=(0, 2))
+            profiles[2][chunk] = np.sum(active, axis=(1, 2))
+        return profiles
+
+    def _bisect(self, geo, box, n, tolerance):
+        """Returns a list of boxes obtained by recursively splitting box
+        into n parts."""
+        if n == 1:
+            return [box]
+
+        n_low = n // 2
+        n_high = n - n_low
+        extents = [stop - start for start, stop in box]
+        volume = np.prod(extents)
+        profiles = self._profiles(geo, box)
+        total = np.sum(profiles[0])
+        # Boxes without any active nodes are split by volume.
+        if total == 0:
+            profiles = self._profiles(None, box)
+            total = volume
+
+        # (imbalance, cut area, axis, split position) tuples.
+        candidates = []
+        for axis, profile in enumerate(profiles):
+            area = volume // extents[axis]
+            pos = np.arange(1, extents[axis])
+            # Every part needs to contain at least one node per subdomain.
+            valid = (pos * area >= n_low) & ((extents[axis] - pos) * area >= n_high)
+            if not np.any(valid):
+                continue
+            low = np.cumsum(profile)[:-1]
+            imbalance = (np.maximum(low / n_low, (total - low) / n_high) /
+                         (total / n) - 1.0)
+            imbalance[np.logical_not(valid)] = np.inf
+            i = np.argmin(imbalance)
+            candidates.append((imbalance[i], area, axis, pos[i]))
+
+        if not candidates:
+            raise ValueError('Box {0} is too small to be split into {1} '
+                             'subdomains.'.format(box, n))
+
+        balanced = [c for c in candidates if c[0] <= tolerance]
+        if balanced:
+            _, _, axis, pos = min(balanced, key=lambda c: (c[1], c[0]))
+        else:
+            _, _, axis, pos = min(candidates)
+
+        start = box[axis][0]
+        low_box = list(box)
+        high_box = list(box)
+        low_box[axis] = (start, start + pos)
+        high_box[axis] = (start + pos, box[axis][1])
+        return (self._bisect(geo, low_box, n_low, tolerance) +
+                self._bisect(geo, high_box, n_high, tolerance))
+
+    def subdomains(self):
+        n = self.config.subdomains
+        geo = None
+        if self.config.geometry_for_decomposition:
+            geo = util.open_array(self.config.geometry_for_decomposition)
+            assert geo.shape == (self.gz, self.gy, self.gx)
+
+        # The imbalance of the final subdomains is bounded by the product
+        # of the imbalances of all bisections leading to them.
+        levels = max(int(np.ceil(np.log2(n))), 1)
+        tolerance = (1.0 + self.config.max_imbalance)**(1.0 / levels) - 1.0
+
+        boxes = self._bisect(geo, [(0, self.gx), (0, self.gy), (0, self.gz)],
+                             n, tolerance)
+        ret = []
+        for box in boxes:
+            spec = SubdomainSpec3D([start for start, _ in box],
+                                   [stop - start for start, stop in box])
+            if geo is not None:
+                spec.active_nodes = int(np.sum(self._profiles(geo, box)[0]))
+            ret.append(spec)
+        return ret
+
+
+class SparseSubdomainsGeometry3D(BisectedSubdomainsGeometry3D):
+    """Decomposes sparse domains (e.g. vascular or porous geometries) into
+    subdomains covering only the parts of the bounding box that contain
+    active nodes.
+
+    The bounding box is tiled into cubic blocks of --sparse_block_size
+    nodes.  Blocks without any active nodes (or inactive nodes adjacent
+    to active ones, which are necessary to define the boundaries) are
+    discarded.  The remaining blocks are merged into cuboid subdomains,
+    each containing about --subdomain_nodes active nodes, by recursively
+    splitting the bounding box of the used blocks until every part is
+    small and dense enough.
+
+    Subdomains of disconnected parts of the geometry are not connected to
+    each other."""
+
+    sparse = True
+
+    @classmethod
+    def add_options(cls, group):
+        BisectedSubdomainsGeometry3D.add_options(group)
+        group.add_argument('--sparse_block_size', type=int, default=16,
+                           help='size (in nodes along every axis) of the '
+                           'blocks from which sparse subdomains are built')
+        group.add_argument('--subdomain_nodes', type=int, default=0,
+                           help='target number of active nodes in a sparse '
+                           'subdomain; if 0, the active nodes are divided '
+                           'between --subdomains subdomains')
+        group.add_argument('--min_block_fill', type=float, default=0.5,
+                           help='minimum fraction of used blocks in a '
+                           'sparse subdomain; subdomains with more unused '
+                           'blocks are split further')
+
+    def _block_stats(self, geo):
+        """Returns arrays with the number of active nodes in every block and
+        with flags indicating blocks which need to be simulated."""
+        bs = self.config.sparse_block_size
+        periodic = [self.config.periodic_z, self.config.periodic_y,
+                    self.config.periodic_x]
+        shape = [int(np.ceil(n / bs)) for n in geo.shape]
+        weights = np.zeros(shape, dtype=np.int64)
+        used = np.zeros(shape, dtype=np.bool)
+
+        def _row(z):
+            if periodic[0]:
+                z %= geo.shape[0]
+            elif z < 0 or z >= geo.shape[0]:
+                return np.zeros((1,) + geo.shape[1:], dtype=np.bool)
+            return np.logical_not(geo[z:z + 1])
+
+        starts = [np.arange(0, n, bs) for n in geo.shape[1:]]
+
+        def _block_sums(mask):
+            return np.add.reduceat(np.add.reduceat(
+                np.sum(mask, axis=0, dtype=np.int64), starts[0], axis=0),
+                starts[1], axis=1)
+
+        for i in range(shape[0]):
+            z0 = i * bs
+            z1 = min(z0 + bs, geo.shape[0])
+            active = np.concatenate([_row(z0 - 1),
+                                     np.logical_not(geo[z0:z1]),
+                                     _row(z1)])
+            # Extend the active nodes by their neighbors.
+            near_active = active.copy()
+            for axis in range(3):
+                prev = near_active.copy()
+                for shift in (-1, 1):
+                    shifted = np.roll(prev, shift, axis=axis)
+                    if axis == 0 or not periodic[axis]:
+                        edge = [slice(None)] * 3
+                        edge[axis] = 0 if shift == 1 else -1
+                        shifted[tuple(edge)] = False
+                    near_active |= shifted
+
+            weights[i] = _block_sums(active[1:-1])
+            used[i] = _block_sums(near_active[1:-1]) > 0
+        return weights, used
+
+    def _merge(self, weights, used, box, target):
+        """Returns a list of boxes (in block units) covering all used blocks
+        within box, with every box covering about target active nodes and a
+        sufficient fraction of used blocks."""
+        sel = tuple(slice(start, stop) for start, stop in reversed(box))
+        box_used = used[sel]
+        if not np.any(box_used):
+            return []
+
+        # Shrink the box to the bounding box of the used blocks.
+        new_box = []
+        for axis in range(3):
+            idx = np.nonzero(np.any(box_used,
+                                    axis=tuple(set(range(3)) - set([2 - axis]))))[0]
+            new_box.append((box[axis][0] + idx[0], box[axis][0] + idx[-1] + 1))
+        box = new_box
+        sel = tuple(slice(start, stop) for start, stop in reversed(box))
+        box_used = used[sel]
+        box_weights = weights[sel]
+
+        total = np.sum(box_weights)
+        n = max(int(np.ceil(total / (target * (1.0 + self.config.max_imbalance)))), 1)
+        if box_used.size == 1 or (n == 1 and np.mean(box_used) >=
+                                  self.config.min_block_fill):
+            return [box]
+
+        extents = [stop - start for start, stop in box]
+        best = None
+        for axis in range(3):
+            for pos in range(1, extents[axis]):
+                low = [slice(None)] * 3
+                high = [slice(None)] * 3
+                low[2 - axis] = slice(0, pos)
+                high[2 - axis] = slice(pos, None)
+                if n > 1:
+                    # Balance the active nodes between the parts, preferring
+                    # small cuts.
+                    low_weight = np.sum(box_weights[tuple(low)])
+                    cost = (abs(low_weight / total - (n // 2) / n),
+                            np.prod(extents) // extents[axis])
+                else:
+                    # Remove as many unused blocks as possible.
+                    cost = (sum(self._bounding_volume(box_used[tuple(part)])
+                                for part in (low, high)), 0)
+                if best is None or cost < best[0]:
+                    best = cost, axis, pos
+
+        _, axis, pos = best
+        start = box[axis][0]
+        low_box = list(box)
+        high_box = list(box)
+        low_box[axis] = (start, start + pos)
+        high_box[axis] = (start + pos, box[axis][1])
+        return (self._merge(weights, used, low_box, target) +
+                self._merge(weights, used, high_box, target))
+
+    @staticmethod
+    def _bounding_volume(mask):
+        """Returns the volume of the bounding box of the True entries in
+        mask."""
+        if not np.any(mask):
+            return 0
+        volume = 1
+        for axis in range(mask.ndim):
+            idx = np.nonzero(np.any(mask, axis=tuple(
+                set(range(mask.ndim)) - set([axis]))))[0]
+            volume *= idx[-1] - idx[0] + 1
+        return volume
+
+    def subdomains(self):
+        if not self.config.geometry_for_decomposition:
+            return super(SparseSubdomainsGeometry3D, self).subdomains()
+
+        geo = util.open_array(self.config.geometry_for_decomposition)
+        assert geo.shape == (self.gz, self.gy, self.gx)
+        weights, used = self._block_stats(geo)
+
+        target = self.config.subdomain_nodes
+        if target <= 0:
+            target = np.sum(weights) / self.config.subdomains
+
+        bs = self.config.sparse_block_size
+        boxes = self._merge(weights, used, [(0, n) for n in
+                                            reversed(weights.shape)], target)
+        ret = []
+        for box in boxes:
+            start = [b0 * bs for b0, _ in box]
+            stop = [min(b1 * bs, size) for (_, b1), size in zip(box, self.gsize)]
+            spec = SubdomainSpec3D(start, [e - s for s, e in zip(start, stop)])
+            spec.active_nodes = int(np.sum(weights[tuple(
+                slice(b0, b1) for b0, b1 in reversed(box))]))
+            ret.append(spec)
+        return ret
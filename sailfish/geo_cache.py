@@ -0,0 +1,207 @@
+"""Persistent on-disk cache of processed subdomain geometry.
+
+Setting up the geometry of a subdomain (Subdomain.reset, encoding and, for
+indirect node addressing, load_active_node_map) can take a long time for
+complex geometries.  The results are stored on disk and reused by later runs
+of the same simulation (e.g. restarts from a checkpoint), where the arrays
+are memory-mapped or copied directly into the subdomain buffers.
+
+On a cache hit, Subdomain.boundary_conditions() is not called.  Subdomain
+classes which rely on any side effects of it other than setting node types
+and parameters should set Subdomain.cache_geometry to False.
+"""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import sailfish.node_type as nt
+
+
+def get_geometry_cache(subdomain):
+    """Returns a GeometryCache instance as configured by the command line
+    options, or None if caching of the geometry of subdomain is disabled."""
+    directory = getattr(subdomain.config, 'geometry_cache_dir', '')
+    if not directory or not subdomain.cache_geometry:
+        return None
+    return GeometryCache(os.path.expanduser(directory))
+
+
+class GeometryCache(object):
+    """Cache of processed subdomain geometry.
+
+    Every entry is a directory named after its key, holding the arrays as
+    .npy files and the remaining state of the subdomain and its geometry
+    encoder as a pickle.  Entries are written to a temporary directory which
+    is then atomically renamed, so that concurrent readers never see
+    partially written data."""
+
+    state_file = 'state.pkl'
+    mask_file = 'active_node_mask.npy'
+
+    def __init__(self, directory):
+        """
+        :param directory: path to the directory in which the cache is kept;
+            created if it does not exist
+        """
+        self.directory = directory
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @staticmethod
+    def make_key(subdomain):
+        """Returns the cache key for the geometry of a subdomain.
+
+        The key covers the subdomain spec (including connections to other
+        subdomains), the subdomain class, the grid, the registered node types,
+        the config options affecting geometry processing and the
+        user-provided --geometry_version.
+        """
+        spec = subdomain.spec
+        config = subdomain.config
+        connections = []
+        for face, cpairs in sorted(spec._connections.items()):
+            connections.append((face, [(cpair.src.src_id, cpair.dst.src_id,
+                                        cpair.src.src_slice,
+                                        cpair.src.dst_slice)
+                                       for cpair in cpairs]))
+        cls = type(subdomain)
+        parts = [
+            getattr(config, 'geometry_version', ''),
+            '{0}.{1}'.format(cls.__module__, cls.__name__),
+            subdomain.grid.__name__,
+            subdomain.grid_shape,
+            spec.id, spec.location, spec.size, spec.envelope_size,
+            spec.actual_size, spec._periodicity, connections,
+            sorted((k, v.__name__) for k, v in nt._NODE_TYPES.items()),
+        ]
+        for option in ('periodic_x', 'periodic_y', 'periodic_z',
+                       'use_link_tags', 'node_addressing', 'mem_alignment',
+                       'max_const_node_params'):
+            parts.append((option, getattr(config, option, None)))
+
+        h = hashlib.sha1()
+        for part in parts:
+            h.update(repr(part).encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _path(self, key, name=''):
+        return os.path.join(self.directory, key, name)
+
+    def load_active_node_mask(self, subdomain):
+        """Returns the cached active node mask of subdomain, or None if it is
+        not in the cache."""
+        try:
+            return np.load(self._path(self.make_key(subdomain),
+                                      self.mask_file), mmap_mode='c')
+        except (IOError, OSError, ValueError):
+            return None
+
+    def load(self, subdomain):
+        """Restores the processed and encoded geometry of subdomain from the
+        cache.
+
+        :param subdomain: allocated, but not reset, Subdomain instance
+        :rvalue: True if the geometry was found in the cache
+        """
+        key = self.make_key(subdomain)
+        try:
+            with open(self._path(key, self.state_file), 'rb') as f:
+                state = pickle.load(f)
+            arrays = dict((name, np.load(self._path(key, name + '.npy'),
+                                         mmap_mode='c'))
+                          for name in ('type_map', 'orientation', 'vis_map',
+                                       'param_map'))
+        except (IOError, OSError, ValueError, EOFError, pickle.UnpicklingError):
+            return False
+
+        if (arrays['type_map'].shape != subdomain._type_map_base.shape or
+                arrays['vis_map'].shape != subdomain._type_vis_map.shape):
+            subdomain.config.logger.warning(
+                'Ignoring geometry cache entry {0} with mismatched '
+                'shape.'.format(key))
+            return False
+
+        subdomain.config.logger.debug('Loading geometry from cache entry '
+                                      '{0}.'.format(key))
+        subdomain._type_map_base[:] = arrays['type_map']
+        subdomain._orientation_base[:] = arrays['orientation']
+        subdomain._type_vis_map = arrays['vis_map']
+        subdomain._params = state['params']
+        subdomain._param_keys = state['param_keys']
+        subdomain._seen_types = state['seen_types']
+        subdomain._needs_orientation = state['needs_orientation']
+        subdomain._type_map_encoded = True
+
+        encoder = state['encoder']
+        encoder.subdomain = subdomain
+        encoder.config = subdomain.config
+        encoder._encoded_param_map = arrays['param_map']
+        subdomain._encoder = encoder
+
+        for flag in ('time_dependence', 'space_dependence'):
+            if state[flag]:
+                setattr(subdomain.config, flag, True)
+        return True
+
+    def save(self, subdomain):
+        """Stores the processed and encoded geometry of subdomain in the
+        cache."""
+        key = self.make_key(subdomain)
+        if os.path.exists(self._path(key)):
+            return
+
+        config = subdomain.config
+        state = {
+            'params': subdomain._params,
+            'param_keys': subdomain._param_keys,
+            'seen_types': subdomain._seen_types,
+            'needs_orientation': subdomain._needs_orientation,
+            'encoder': subdomain._encoder,
+            'time_dependence': config.time_dependence,
+            'space_dependence': config.space_dependence,
+        }
+
+        tmp_path = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+        try:
+            np.save(os.path.join(tmp_path, 'type_map.npy'),
+                    subdomain.encoded_map())
+            np.save(os.path.join(tmp_path, 'orientation.npy'),
+                    subdomain._orientation_base)
+            np.save(os.path.join(tmp_path, 'vis_map.npy'),
+                    subdomain._type_vis_map)
+            np.save(os.path.join(tmp_path, 'param_map.npy'),
+                    subdomain._encoder._encoded_param_map)
+            if subdomain.active_node_mask is not None:
+                np.save(os.path.join(tmp_path, self.mask_file),
+                        subdomain.active_node_mask)
+            with open(os.path.join(tmp_path, self.state_file), 'wb') as f:
+                pickle.dump(state, f, -1)
+            os.rename(tmp_path, self._path(key))
+        except OSError:
+            # Another process might have stored the same entry in the
+            # meantime.
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.exists(self._path(key)):
+                raise
+        except:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        config.logger.debug('Saved geometry to cache entry {0}.'.format(key))
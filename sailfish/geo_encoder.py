@@ -18,6 +18,27 @@ def bit_len(num):
     return max(length, 1)
 
 
+def count_node_params(param_dict):
+    """Returns the number of floating point values necessary to store all
+    distinct non-symbolic node parameters.
+
+    :param param_dict: maps entries from param_map to LBNodeType objects
+    """
+    seen_params = set()
+    count = 0
+    for node_type in param_dict.values():
+        for param in node_type.params.values():
+            if util.is_number(param) or type(param) is tuple:
+                if param not in seen_params:
+                    seen_params.add(param)
+                    count += 1 if util.is_number(param) else len(param)
+            elif isinstance(param, np.ndarray):
+                # Distinct values are not deduplicated between different
+                # field params here, so this can overestimate the count.
+                count += len(np.unique(param)) * len(param.dtype)
+    return count
+
+
 class GeoEncoder(object):
     """Takes information about geometry as specified by the simulation and
     encodes it into buffers suitable for processing on a GPU.
@@ -33,6 +54,15 @@ class GeoEncoder(object):
     def dim(self):
         return self.subdomain.dim
 
+    def __getstate__(self):
+        # References to the subdomain, its config and its maps are not
+        # pickled (see geo_cache.GeometryCache).
+        state = self.__dict__.copy()
+        for name in ('subdomain', 'config', '_type_map', '_param_map',
+                     '_scratch_map', '_encoded_param_map'):
+            state.pop(name, None)
+        return state
+
     def encode(self):
         raise NotImplementedError("encode() should be implemented in a subclass")
 
@@ -79,7 +109,8 @@ class GeoEncoderConst(GeoEncoder):
         :param param_map: array whose entries are keys in param_dict
         :param param_dict: maps entries from param_map to LBNodeType objects
         """
-        uniq_types = list(np.unique(type_map))
+        num_threads = self.config.geometry_threads
+        uniq_types = list(util.unique(type_map, num_threads))
         for nt_id in uniq_types:
             self._node_types.add(nt._NODE_TYPES[nt_id])
 
@@ -91,8 +122,29 @@ class GeoEncoderConst(GeoEncoder):
         self._type_map = type_map
         self._param_map = param_map
         self._param_dict = param_dict
-        self._encoded_param_map = np.zeros_like(self._type_map)
-        self._scratch_map = np.zeros_like(self._type_map)
+
+        # Group nodes by their key in param_map with a single sort, instead
+        # of scanning the whole map for every key.  Nodes without a key (0,
+        # e.g. fluid nodes) do not need to be considered unless the key is
+        # actually used.
+        flat_param_map = param_map.ravel()
+        if 0 in param_dict:
+            key_nodes = np.arange(flat_param_map.size)
+        else:
+            key_nodes = np.flatnonzero(flat_param_map)
+        keys, key_inverse = np.unique(flat_param_map[key_nodes],
+                                      return_inverse=True)
+        key_pos = dict((key, i) for i, key in enumerate(keys))
+
+        def _nodes_with_key(node_key):
+            """Returns flat indices (in C order) of nodes with node_key."""
+            return key_nodes[key_inverse == key_pos[node_key]]
+
+        # Maps node keys to the encoded param index (for scalar and vector
+        # params) or to an array of encoded param indices for every node with
+        # the key (for field params).  Every param of a node type overrides
+        # the previous one.
+        node_key_params = {}
 
         param_to_idx = dict()  # Maps entries in seen_params to ids.
         seen_params = set()
@@ -111,7 +163,7 @@ class GeoEncoderConst(GeoEncoder):
                         idx = param_items
                         param_to_idx[param] = idx
                         param_items += 1
-                    self._encoded_param_map[param_map == node_key] = idx
+                    node_key_params[node_key] = idx
                 elif type(param) is tuple:
                     if param in seen_params:
                         idx = param_to_idx[param]
@@ -121,14 +173,14 @@ class GeoEncoderConst(GeoEncoder):
                         idx = param_items
                         param_to_idx[param] = idx
                         param_items += len(param)
-                    self._encoded_param_map[param_map == node_key] = idx
+                    node_key_params[node_key] = idx
                 # Param is a structured numpy array.
                 elif isinstance(param, np.ndarray):
-                    nodes_idx = np.argwhere(param_map == node_key)
-
-                    uniques = np.unique(param)
+                    uniques, value_inverse = np.unique(param,
+                                                       return_inverse=True)
                     uniques.flags.writeable = False
 
+                    value_idx = []
                     for value in uniques:
                         if value in seen_params:
                             idx = param_to_idx[value]
@@ -138,16 +190,11 @@ class GeoEncoderConst(GeoEncoder):
                             idx = param_items
                             param_to_idx[value] = idx
                             param_items += len(value)
+                        value_idx.append(idx)
 
-                        idxs = nodes_idx[param == value]
-                        if idxs.shape[1] == 3:
-                            self._encoded_param_map[idxs[:,0], idxs[:,1],
-                                                    idxs[:,2]] = idx
-                        elif idxs.shape[1] == 2:
-                            self._encoded_param_map[idxs[:,0], idxs[:,1]] = idx
-                        else:
-                            assert False, 'Unsupported dimension: {0}'.format(
-                                    idxs.shape[1])
+                    node_key_params[node_key] = np.array(
+                        value_idx, dtype=np.uint32)[
+                            value_inverse.ravel()]
 
         self._non_symbolic_idxs = param_items
         self._symbol_map = {}  # Maps param indices to sympy expressions.
@@ -164,7 +211,7 @@ class GeoEncoderConst(GeoEncoder):
             for param in node_type.params.values():
                 if isinstance(param, nt.DynamicValue):
                     if param in seen_params:
-                        idx = param_to_idx[value]
+                        idx = param_to_idx[param]
                     else:
                         seen_params.add(param)
                         idx = param_items
@@ -182,28 +229,51 @@ class GeoEncoderConst(GeoEncoder):
                                 timeseries_offset += ts._data.size
                                 self._timeseries_data.extend(ts._data)
 
-                    self._encoded_param_map[param_map == node_key] = idx
+                    node_key_params[node_key] = idx
+
+        # Write scalar and vector params for all keys at once using a lookup
+        # table, then fill in the nodes with field params.
+        # Use the smallest dtype that can hold all param indices.
+        param_dtype = np.min_scalar_type(param_items)
+        self._encoded_param_map = np.zeros(type_map.shape, dtype=param_dtype)
+        key_params = np.zeros(len(keys), dtype=param_dtype)
+        field_params = []
+        for node_key, idx in node_key_params.items():
+            if node_key not in key_pos:
+                continue
+            if isinstance(idx, np.ndarray):
+                field_params.append((node_key, idx))
+            else:
+                key_params[key_pos[node_key]] = idx
+
+        np.put(self._encoded_param_map, key_nodes, key_params[key_inverse])
+        for node_key, idx in field_params:
+            np.put(self._encoded_param_map, _nodes_with_key(node_key), idx)
 
         self._bits_param = bit_len(param_items)
 
         # Maps node type ID to base offset within the scratch space array.
         self._scratch_space_base = {}
         type_to_node_count = {}
+        # Only allocate the scratch ID map if it is actually needed.
+        self._scratch_map = 0
         # Generate unique (within node type) scratch space ids.
         for node_type in self._node_types:
             if node_type.scratch_space_size(self.dim) <= 0:
                 continue
 
-            def _selector(idx_list):
-                return [slice(i, i+1) for i in idx_list]
-
-            idx = np.argwhere(self._type_map == node_type.id)
-            num_nodes = idx.shape[0]
+            if type(self._scratch_map) is int:
+                self._scratch_map = np.zeros_like(self._type_map)
+            # Scratch space ids are assigned consecutively, in C order.
+            num_nodes = 0
+            for chunk in util.chunk_slices(self._type_map.shape):
+                type_mask = self._type_map[chunk] == node_type.id
+                chunk_nodes = int(np.count_nonzero(type_mask))
+                self._scratch_map[chunk][type_mask] = np.arange(
+                    num_nodes, num_nodes + chunk_nodes)
+                num_nodes += chunk_nodes
             type_to_node_count[node_type.id] = num_nodes
 
-            for i in range(num_nodes):
-               self._scratch_map[_selector(idx[i,:])] = i
-
             self._scratch_space_base[node_type.id] = self.scratch_space_size
 
             # Accumulate size requirements of specific types into a global
@@ -220,8 +290,19 @@ class GeoEncoderConst(GeoEncoder):
             # TODO: Actually drop these bits to save space in the node code.
             # It would be nice to use reduce here instead, but
             # bitwise_and.identity = 1 makes it impossible to use it.
-            self._unused_tag_bits = int(np.bitwise_and.accumulate(
-                orientation[orientation > 0])[-1])
+            def _unused_bits(chunk):
+                tags = orientation[chunk]
+                tags = tags[tags > 0]
+                if tags.size == 0:
+                    return None
+                return np.bitwise_and.accumulate(tags)[-1]
+
+            chunk_bits = [x for x in util.map_chunks(_unused_bits,
+                                                     orientation.shape,
+                                                     num_threads)
+                          if x is not None]
+            self._unused_tag_bits = int(
+                np.bitwise_and.accumulate(chunk_bits)[-1])
 
     def _subdomain_encode_node(self, orientation, node_type, param):
         """Helper method for use from Subdomain only.
@@ -239,6 +320,7 @@ class GeoEncoderConst(GeoEncoder):
             modified if detect_orientation is True.
         """
         assert self._type_map is not None
+        self._check_bit_budget()
         self.config.logger.debug('Node type encoding...')
 
         # Remap type IDs.
@@ -252,15 +334,45 @@ class GeoEncoderConst(GeoEncoder):
             self.config.logger.debug('... ID %d: %s' % (k,
                                                         nt._NODE_TYPES[k].__name__))
 
-        self._type_map[:] = self._encode_node(orientation,
-                self._encoded_param_map,
-                np.choose(np.int32(self._type_map), self._type_choice_map),
-                self._scratch_map)
+        # Encode the map in chunks, writing the node codes directly into the
+        # type map, so that no full-size temporary arrays are necessary.
+        def _encode(chunk):
+            scratch_map = self._scratch_map
+            if type(scratch_map) is not int:
+                scratch_map = scratch_map[chunk]
+            self._type_map[chunk] = self._encode_node(orientation[chunk],
+                    self._encoded_param_map[chunk],
+                    self._type_choice_map[self._type_map[chunk]],
+                    scratch_map)
+
+        util.map_chunks(_encode, self._type_map.shape,
+                        self.config.geometry_threads)
         self.config.logger.debug('... type map done.')
 
         # Drop the reference to the map array.
         self._type_map = None
 
+    def _check_bit_budget(self):
+        """Verifies that all fields of the node code fit in a uint32."""
+        if self.config.use_link_tags and self._have_link_tags:
+            if 32 - self._bits_scratch < self.subdomain.grid.Q - 1:
+                raise ValueError('Not enough bits available to tag neighbor '
+                                 'nodes.')
+            bits_orientation = self.subdomain.grid.Q - 1
+        else:
+            bits_orientation = bit_len(self.subdomain.grid.Q - 1)
+
+        bits = (bits_orientation + self._bits_scratch + self._bits_param +
+                self._bits_type)
+        if bits > 32:
+            raise ValueError(
+                'Node code requires {0} bits (orientation: {1}, scratch '
+                'index: {2}, param index: {3}, node type: {4}), but only 32 '
+                'are available.  Reduce the number of distinct node '
+                'parameters.'.format(bits, bits_orientation,
+                                     self._bits_scratch, self._bits_param,
+                                     self._bits_type))
+
     def get_param(self, location, values=1):
         """
         Returns 'values' float values which are pameters of the node at
@@ -273,6 +385,19 @@ class GeoEncoderConst(GeoEncoder):
         idx = self._encoded_param_map[tuple(reversed(location))]
         return self._geo_params[idx:idx+values]
 
+    @property
+    def param_buffer(self):
+        """Node parameters to be stored in a device buffer, or None if the
+        parameters are embedded in the generated code."""
+        return None
+
+    @property
+    def param_index_map(self):
+        """uint32 array with the same layout as the type map, holding the
+        offsets of the node parameters within param_buffer, or None if the
+        offsets are part of the node code."""
+        return None
+
     def update_context(self, ctx):
         ctx.update({
             'use_link_tags': self.config.use_link_tags,
@@ -286,6 +411,7 @@ class GeoEncoderConst(GeoEncoder):
             'nt_dir_other': 0,  # used to indicate non-primary direction
                                 # in orientation processing code
             'node_params': self._geo_params,
+            'node_params_buffer': False,
             'symbol_idx_map': self._symbol_map,
             'timeseries_data': self._timeseries_data,
             'non_symbolic_idxs': self._non_symbolic_idxs,
@@ -305,18 +431,54 @@ class GeoEncoderConst(GeoEncoder):
                       ^_ nt_scratch_shift + nt_param_shift + nt_misc_shift
 
         """
-        if (32 - self._bits_scratch < self.subdomain.grid.Q - 1 and
-            self.config.use_link_tags and self._have_link_tags):
-            raise ValueError('Not enough bits available to tag neighbor nodes.')
+        # Operate in place to avoid creating full-size temporary arrays.
+        code = np.left_shift(orientation, np.uint32(self._bits_scratch),
+                             dtype=np.uint32)
+        code |= scratch_id
+        code <<= self._bits_param
+        code |= param
+        code <<= self._bits_type
+        code |= node_type
+        return code
+
+
+class GeoEncoderBuffer(GeoEncoderConst):
+    """Encodes node type into a single uint32.
+
+    The optional parameters are stored in a buffer in global memory, which
+    is passed to the compute kernels.  This makes it possible to use large
+    numbers of distinct parameter values (e.g. spatially varying velocity
+    profiles), which would not fit in const memory.
+
+    The offset of the parameters of every node within that buffer is kept
+    in a separate per-node uint32 array (param_index_map) instead of the
+    node code, so that the number of parameters is not limited by the
+    bits left over by the orientation and scratch index fields."""
+
+    def prepare_encode(self, type_map, param_map, param_dict, orientation,
+                       have_link_tags):
+        GeoEncoderConst.prepare_encode(self, type_map, param_map, param_dict,
+                                       orientation, have_link_tags)
+        self._bits_param = 0
 
-        misc_data = (orientation << self._bits_scratch) | scratch_id
-        misc_data = (misc_data << self._bits_param) | param
-        return (misc_data << self._bits_type) | node_type
+    @property
+    def param_buffer(self):
+        return self._geo_params
 
+    @property
+    def param_index_map(self):
+        return self._encoded_param_map.astype(np.uint32, copy=False)
+
+    def update_context(self, ctx):
+        GeoEncoderConst.update_context(self, ctx)
+        ctx['node_params'] = []
+        ctx['node_params_buffer'] = True
+
+    def _encode_node(self, orientation, param, node_type, scratch_id=0):
+        # The param index is stored in param_index_map.
+        return GeoEncoderConst._encode_node(self, orientation, 0, node_type,
+                                            scratch_id)
 
-# TODO: Implement this class.
-class GeoEncoderBuffer(GeoEncoder):
-    pass
 
 # TODO: Implement this class.
 class GeoEncoderMap(GeoEncoder):
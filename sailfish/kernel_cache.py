@@ -0,0 +1,130 @@
+"""Persistent on-disk cache of compiled compute device programs."""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+import errno
+import hashlib
+import os
+import tempfile
+
+from sailfish.util import file_lock
+
+
+def get_kernel_cache(config):
+    """Returns a KernelCache instance as configured by the command line
+    options, or None if caching of compiled programs is disabled."""
+    if not getattr(config, 'use_kernel_cache', False):
+        return None
+
+    directory = config.kernel_cache_dir
+    if not directory:
+        import getpass
+        directory = os.path.join(tempfile.gettempdir(),
+                                 'sailfish_kernels-{0}'.format(getpass.getuser()))
+    return KernelCache(directory, config.kernel_cache_size * 1024 * 1024)
+
+
+class KernelCache(object):
+    """Size-bounded LRU cache of program binaries.
+
+    Every entry is stored in a separate file named after its key.  Entries are
+    written to a temporary file which is then atomically renamed, so that
+    concurrent readers (e.g. subdomain runners of the same simulation) never
+    see partially written data.  Eviction is serialized between processes
+    with an exclusive lock on a lock file in the cache directory.  The
+    modification time of an entry is updated whenever it is read and is used
+    to determine the least recently used entries."""
+
+    suffix = '.bin'
+
+    def __init__(self, directory, max_size):
+        """
+        :param directory: path to the directory in which the cache is kept;
+            created if it does not exist
+        :param max_size: maximum total size of cached entries, in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @staticmethod
+    def make_key(source, backend, device, options=()):
+        """Returns a cache key for a program.
+
+        :param source: final source code of the program
+        :param backend: name of the backend building the program
+        :param device: string identifying the compute device and its driver
+        :param options: iterable of compiler options
+        """
+        h = hashlib.sha1()
+        for part in [backend, device, ' '.join(options), source]:
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        """Returns the cached data for key, or None if it is not in the
+        cache."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+
+        # Mark the entry as recently used.  The entry might have been evicted
+        # in the meantime, which is harmless.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        """Stores data under key and evicts the least recently used entries
+        if the cache grows above its maximum size."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, self._path(key))
+        except:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        self._evict()
+
+    def _evict(self):
+        with file_lock(os.path.join(self.directory, '.lock')):
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(self.suffix):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+
+            total = sum(size for _, size, _ in entries)
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_size:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                total -= size
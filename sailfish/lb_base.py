@@ -89,6 +89,12 @@ class LBSim(object):
                            'tagging for node types that support it. This '
                            'effectively falls back to the more crude '
                            'orientation tagging.')
+        group.add_argument('--max_const_node_params', type=int,
+                           default=4096, help='Maximum number of floating '
+                           'point node parameters (velocities, densities, '
+                           'etc) to store in const memory. If a subdomain '
+                           'requires more, they are stored in a global '
+                           'memory buffer instead.')
 
     @classmethod
     def modify_config(cls, config):
@@ -169,17 +175,19 @@ class LBSim(object):
                         'Field %s defined more than once.' % field.name
                 self._fields[field.name] = FieldPair(field, f)
 
-    def count_fields(self, runner):
+    def _field_sources(self):
         sources = [self]
-        scalar = 0
-        vector = 0
         # Scan for mixin classes adding their own fields.
         for c in self.__class__.mro()[1:]:
             if (issubclass(c, LBMixIn) and hasattr(c, 'fields') and
                 not issubclass(c, LBSim)):
                 sources.append(c)
+        return sources
 
-        for src in sources:
+    def count_fields(self, runner):
+        scalar = 0
+        vector = 0
+        for src in self._field_sources():
             for field in src.fields():
                 if type(field) is ScalarField:
                     scalar += 1
@@ -190,6 +198,12 @@ class LBSim(object):
 
         return scalar, vector
 
+    def count_nn_fields(self):
+        """Returns the number of scalar fields which need to be accessed from
+        nearest neighbor nodes (and thus exchanged between subdomains)."""
+        return sum(1 for src in self._field_sources() for field in src.fields()
+                   if type(field) is ScalarField and field.need_nn)
+
     def verify_fields(self):
         """Verifies that fields have not accidentally been overridden."""
         for name, field_pair in self._fields.items():
@@ -126,6 +126,11 @@ class LBFluidSim(LBSim):
             args2.append(runner.gpu_scratch_space)
             signature += 'P'
 
+        if runner.gpu_node_params is not None:
+            args1.extend([runner.gpu_node_params, runner.gpu_node_param_map])
+            args2.extend([runner.gpu_node_params, runner.gpu_node_param_map])
+            signature += 'PP'
+
         # Alpha field for the entropic LBM.
         if self.alpha_output:
             args1.append(runner.gpu_field(self.alpha))
@@ -289,6 +289,17 @@ class LBTernaryFluidShanChen(LBTernaryFluidBase, LBForcedSim):
             args_b_signature += 'P'
             args_c_signature += 'P'
 
+        if runner.gpu_node_params is not None:
+            args1a.extend([runner.gpu_node_params, runner.gpu_node_param_map])
+            args2a.extend([runner.gpu_node_params, runner.gpu_node_param_map])
+            args1b.extend([runner.gpu_node_params, runner.gpu_node_param_map])
+            args2b.extend([runner.gpu_node_params, runner.gpu_node_param_map])
+            args1c.extend([runner.gpu_node_params, runner.gpu_node_param_map])
+            args2c.extend([runner.gpu_node_params, runner.gpu_node_param_map])
+            args_a_signature += 'PP'
+            args_b_signature += 'PP'
+            args_c_signature += 'PP'
+
         macro = runner.get_kernel('ShanChenPrepareMacroFields', macro_args1,
                                   macro_signature,
                                   needs_iteration=self.config.needs_iteration_num)
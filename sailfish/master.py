@@ -8,18 +8,21 @@ __license__ = 'LGPL3'
 
 import atexit
 import ctypes
+import operator
 import os
+import shutil
 import subprocess
 import tempfile
 import time
+from functools import reduce
 
 import multiprocessing as mp
 from multiprocessing import Process, Event, Value
 
 import zmq
 
-from sailfish import subdomain_runner, util, io
-from sailfish.connector import ZMQSubdomainConnector, ZMQRemoteSubdomainConnector, CompressedZMQRemoteSubdomainConnector
+from sailfish import autotune, placement, subdomain_runner, util, io
+from sailfish.connector import ZMQSubdomainConnector, ZMQRemoteSubdomainConnector, CompressedZMQRemoteSubdomainConnector, AdaptiveCompressedZMQRemoteSubdomainConnector, SHMSubdomainConnector
 
 def _start_subdomain_runner(subdomain_spec, config, sim, num_subdomains,
         backend_class, gpu_id, output,
@@ -47,6 +50,7 @@ def _start_subdomain_runner(subdomain_spec, config, sim, num_subdomains,
     # master), so that the backend object is created within the
     # context of the new process.
     backend = backend_class(config, gpu_id)
+    autotune.apply_tuned_params(config, backend)
 
     if not timing_info_to_master:
         # If there is no controller channel, all processes are running on a
@@ -108,6 +112,16 @@ class LBMachineMaster(object):
 
         try:
             gpus = len(self.config.gpus)
+            if (getattr(self.config, 'subdomain_placement', '') == 'graph' and
+                    gpus > 1):
+                parts = placement.partition_subdomains(
+                    self.subdomain_specs, [1] * gpus,
+                    self.config.placement_max_imbalance)
+                for gpu, part in zip(self.config.gpus, parts):
+                    for subdomain in part:
+                        subdomain2gpu[subdomain.id] = gpu
+                return subdomain2gpu
+
             for i, subdomain in enumerate(self.subdomain_specs):
                 subdomain2gpu[subdomain.id] = self.config.gpus[i % gpus]
         except TypeError:
@@ -122,6 +136,31 @@ class LBMachineMaster(object):
         else:
             return ctypes.c_float
 
+    def _max_message_sizes(self, subdomain, nbid):
+        """Returns the sizes (in elements) of the largest messages sent
+        from subdomain to nbid and in the opposite direction in a single
+        exchange.
+
+        These are used to size buffers which, unlike 0MQ sockets, cannot grow
+        to accommodate messages."""
+        def _size(shape):
+            return reduce(operator.mul, shape, 1)
+
+        num_grids = len(self.sim.grids)
+        num_nn_fields = self.sim.count_nn_fields()
+        dists = [0, 0]
+        macro = [0, 0]
+        for face, block_id in subdomain.connecting_subdomains():
+            if block_id != nbid:
+                continue
+            for cpair in subdomain.get_connections(face, block_id):
+                for i, conn in enumerate((cpair.src, cpair.dst)):
+                    dists[i] += num_grids * max(
+                        _size(conn.transfer_shape),
+                        _size(conn.local_transfer_shape))
+                    macro[i] += num_nn_fields * _size(conn.macro_transfer_shape)
+        return max(dists[0], macro[0]), max(dists[1], macro[1])
+
     def _init_connectors(self):
         """Creates subdomain connectors for all subdomains connections."""
         # A set to keep track which connections are already created.
@@ -159,10 +198,15 @@ class LBMachineMaster(object):
                             subdomain.id, nbid, size1, size2, face_str))
 
                 if nbid in local_subdomain_ids:
-                    c1, c2 = ZMQSubdomainConnector.make_ipc_pair(ctype, (size1, size2),
-                                                             (subdomain.id, nbid))
+                    if self.config.local_connector == 'shm':
+                        c1, c2 = SHMSubdomainConnector.make_pair(ctype,
+                                self._max_message_sizes(subdomain, nbid),
+                                (subdomain.id, nbid), self._quit_event)
+                    else:
+                        c1, c2 = ZMQSubdomainConnector.make_ipc_pair(ctype,
+                                (size1, size2), (subdomain.id, nbid))
+                        ipc_files.append(c1.ipc_file)
                     subdomain.add_connector(nbid, c1)
-                    ipc_files.append(c1.ipc_file)
                     local_subdomain_map[nbid].add_connector(subdomain.id, c2)
                 else:
                     receiver = subdomain.id > nbid
@@ -170,7 +214,12 @@ class LBMachineMaster(object):
                         addr = "tcp://{0}".format(self._subdomain_addr_map[nbid])
                     else:
                         addr = "tcp://{0}".format(self._iface)
-                    if self.config.compress_intersubdomain_data:
+                    if self.config.adaptive_compression:
+                        c1 = AdaptiveCompressedZMQRemoteSubdomainConnector(
+                                addr, receiver=subdomain.id > nbid,
+                                bandwidth=self.config.link_bandwidth,
+                                probe_interval=self.config.compression_probe_interval)
+                    elif self.config.compress_intersubdomain_data:
                         c1 = CompressedZMQRemoteSubdomainConnector(addr,
                                 receiver=subdomain.id > nbid)
                     else:
@@ -266,6 +315,11 @@ class LBMachineMaster(object):
         for runner in self.runners:
             runner.start()
 
+        # The runners have their own copies of the connectors.
+        for subdomain in self.subdomain_specs:
+            for connector in subdomain._connectors.values():
+                connector.close()
+
         ports = {}
         for socket in sockets:
             runner_ports = socket.recv_pyobj()
@@ -340,7 +394,8 @@ class LBMachineMaster(object):
             backend_cls = next(util.get_backends(self.config.backends.split(',')))
         except StopIteration:
             self.config.logger.error('Failed to initialize compute backend.'
-                    ' Make sure pycuda/pyopencl is installed.')
+                    ' Make sure pycuda/pyopencl is installed or use'
+                    ' --backends=numpy to run on the CPU.')
             return
 
         self.config.logger.info('Selected backend: {0}'.format(backend_cls.name))
@@ -357,8 +412,16 @@ class LBMachineMaster(object):
                     None, self._channel is not None)
             self.config.logger.debug('Finished single process subdomain runner.')
         else:
-            self._run_subprocesses(output_initializer, backend_cls,
-                    subdomain2gpu)
+            # Directory through which the subdomain runners share generated
+            # code, so that every unique code generation context is only
+            # rendered once on this host.
+            self.config._codegen_dir = tempfile.mkdtemp(
+                    prefix='sailfish_codegen-')
+            try:
+                self._run_subprocesses(output_initializer, backend_cls,
+                        subdomain2gpu)
+            finally:
+                shutil.rmtree(self.config._codegen_dir, ignore_errors=True)
 
         self._finish_visualization()
 
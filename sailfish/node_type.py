@@ -415,26 +415,27 @@ def multifield(values, where=None):
             which cover the whole subdomain, 'where' should be the same
             array you're passing to set_node
     """
-    # TODO(michalj): Add support for automatic array extension (broadcasting).
-    shape = None
+    arrays = [val for val in values if isinstance(val, np.ndarray)]
+    assert arrays
+    # Arrays are broadcast against each other and the where mask, so that
+    # sparse (np.ogrid-style) coordinate arrays can be used.  Nodes are
+    # selected before conversion to avoid materializing full arrays.
+    bool_mask = isinstance(where, np.ndarray) and where.dtype == np.bool_
+    if bool_mask:
+        arrays.append(where)
+    shape = np.broadcast_arrays(*arrays)[0].shape
+    if bool_mask:
+        where = np.broadcast_to(where, shape)
+
     new_values = []
     for val in values:
-        if isinstance(val, np.ndarray):
-            assert (shape is None) or (shape == val.shape)
-            new_values.append(val.astype(np.float64))
-            shape = val.shape
-        else:
-            new_values.append(None)
-
-    assert shape is not None
-
-    for i, (old, new) in enumerate(zip(values, new_values)):
-        if new is None:
-            new_values[i] = np.zeros(shape, dtype=np.float64)
-            new_values[i][:] = old  # broadcast to the whole array
+        val = np.broadcast_to(val, shape)
+        if where is not None:
+            val = val[where]
+        new_values.append(val.astype(np.float64))
 
     if where is not None:
-        return np.core.records.fromarrays(new_values)[where]
+        return np.core.records.fromarrays(new_values)
     else:
         return np.core.records.fromarrays(new_values).flatten()
 
@@ -548,5 +549,17 @@ class LinearlyInterpolatedTimeSeries(Symbol):
         """Returns a hash of the underying data series."""
         return hashlib.sha1(self._data).digest()
 
+    def __reduce_ex__(self, protocol):
+        # The default Symbol implementation only preserves the name of the
+        # symbol.  Keep the data and the offset (used by the geometry cache).
+        return (_unpickle_time_series,
+                (self._data, self._step_size, self._offset))
+
+
+def _unpickle_time_series(data, step_size, offset):
+    ts = LinearlyInterpolatedTimeSeries(data, step_size)
+    ts._offset = offset
+    return ts
+
 # Maps node type IDs to their classes.
 _NODE_TYPES = __init_node_type_list()
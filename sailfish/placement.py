@@ -0,0 +1,173 @@
+"""Communication-aware placement of subdomains on cluster nodes and GPUs.
+
+The subdomains and their connections form a graph, in which every subdomain
+is a vertex weighted by its number of active nodes and every connection
+is an edge weighted by the amount of data exchanged over it in a single
+step.  The graph is partitioned so that the load of every part is
+proportional to its capacity (number of GPUs), and the total weight of
+the edges between different parts (e.g. traffic between hosts, which
+goes over the network instead of local IPC) is minimized.
+"""
+
+__author__ = 'Michal Januszewski'
+__email__ = 'sailfish-cfd@googlegroups.com'
+__license__ = 'LGPL3'
+
+from collections import defaultdict
+
+
+def subdomain_weight(spec):
+    """Returns the expected computational load of a subdomain.
+
+    This is the number of active nodes if known from the decomposition,
+    and the total number of nodes otherwise."""
+    active_nodes = getattr(spec, 'active_nodes', None)
+    if active_nodes is not None:
+        return active_nodes
+    return spec.num_nodes
+
+
+def subdomain_graph(subdomains):
+    """Builds the connection graph of subdomains.
+
+    :param subdomains: list of connected SubdomainSpec objects
+    :rvalue: dict mapping subdomain IDs to dicts, which map IDs of
+        connected subdomains to the number of elements exchanged with them
+        (in both directions) in a single step; connections to subdomains
+        not in the list are ignored
+    """
+    ids = set(spec.id for spec in subdomains)
+    edges = dict((spec.id, defaultdict(int)) for spec in subdomains)
+    for spec in subdomains:
+        for face, block_id in spec.connecting_subdomains():
+            if block_id not in ids or block_id == spec.id:
+                continue
+            for cpair in spec.get_connections(face, block_id):
+                edges[spec.id][block_id] += (cpair.src.elements +
+                                             cpair.dst.elements)
+    return edges
+
+
+def cut_weight(parts, edges):
+    """Returns the total weight of the edges between different parts.
+
+    :param parts: list of lists of SubdomainSpec objects
+    :param edges: connection graph as returned by subdomain_graph()
+    """
+    part_of = {}
+    for i, part in enumerate(parts):
+        for spec in part:
+            part_of[spec.id] = i
+
+    total = 0
+    for src, neighbors in edges.items():
+        for dst, weight in neighbors.items():
+            if part_of[src] != part_of[dst]:
+                total += weight
+    # Every edge is counted twice.
+    return total // 2
+
+
+def partition_subdomains(subdomains, capacities, max_imbalance=0.1,
+                         max_passes=10):
+    """Partitions subdomains between units of the given capacities.
+
+    The partition is first built by greedy graph growing (every part is
+    filled with subdomains most strongly connected to it, until its load
+    reaches the target), and then refined by moving single subdomains to
+    the part they are most strongly connected to, as long as this reduces
+    the cut and keeps the load of every part within the allowed imbalance.
+
+    :param subdomains: list of connected SubdomainSpec objects
+    :param capacities: list of relative capacities (e.g. number of GPUs)
+        of the units
+    :param max_imbalance: maximum relative excess of the load of a part over
+        its target allowed during refinement
+    :param max_passes: maximum number of refinement passes
+    :rvalue: list of len(capacities) lists of subdomains; only the trailing
+        lists can be empty (when there are fewer subdomains than units)
+    """
+    edges = subdomain_graph(subdomains)
+    specs = dict((spec.id, spec) for spec in subdomains)
+    weights = dict((spec.id, subdomain_weight(spec)) for spec in subdomains)
+    order = sorted(specs.keys())
+
+    total_weight = float(sum(weights.values()))
+    total_capacity = float(sum(capacities))
+    targets = [total_weight * c / total_capacity for c in capacities]
+    num_parts = len(capacities)
+
+    part_of = {}
+    loads = [0] * num_parts
+
+    def _connection(sid, part):
+        return sum(w for nid, w in edges[sid].items()
+                   if part_of.get(nid) == part)
+
+    # Greedy graph growing.
+    for part in range(num_parts):
+        unassigned = [sid for sid in order if sid not in part_of]
+        if not unassigned:
+            break
+        # Leave at least one subdomain for every remaining part.
+        max_count = max(1, len(unassigned) - (num_parts - part - 1))
+        count = 0
+        while unassigned and count < max_count:
+            if part == num_parts - 1 or count == 0:
+                sid = unassigned[0]
+            else:
+                under = targets[part] - loads[part]
+                if under <= 0:
+                    break
+                # The subdomain most strongly connected to the current part
+                # that does not overshoot its target load, or the one with the
+                # lowest ID if none is connected (disconnected component).
+                sid = None
+                for cand in sorted(unassigned, key=lambda x: (
+                        -_connection(x, part), x)):
+                    if loads[part] + weights[cand] - targets[part] <= under:
+                        sid = cand
+                        break
+                if sid is None:
+                    break
+            part_of[sid] = part
+            loads[part] += weights[sid]
+            unassigned.remove(sid)
+            count += 1
+
+    # Refinement.
+    counts = [0] * num_parts
+    for part in part_of.values():
+        counts[part] += 1
+
+    for _ in range(max_passes):
+        moved = False
+        for sid in order:
+            src = part_of[sid]
+            if counts[src] == 1:
+                continue
+            own = _connection(sid, src)
+            best = None
+            for part in set(part_of[nid] for nid in edges[sid]):
+                if part == src:
+                    continue
+                gain = _connection(sid, part) - own
+                if (gain > 0 and loads[part] + weights[sid] <=
+                        (1.0 + max_imbalance) * targets[part] and
+                        (best is None or gain > best[0])):
+                    best = gain, part
+            if best is not None:
+                _, dst = best
+                part_of[sid] = dst
+                loads[src] -= weights[sid]
+                loads[dst] += weights[sid]
+                counts[src] -= 1
+                counts[dst] += 1
+                moved = True
+        if not moved:
+            break
+
+    ret = [[] for _ in range(num_parts)]
+    for sid in order:
+        ret[part_of[sid]].append(specs[sid])
+    return ret
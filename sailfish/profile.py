@@ -6,6 +6,7 @@ __email__ = 'sailfish-cfd@googlegroups.com'
 __license__ = 'LGPL3'
 
 import time
+from collections import defaultdict
 from sailfish import util
 
 class TimeProfile(object):
@@ -48,6 +49,13 @@ class TimeProfile(object):
         self._sample_sum = 0.0
         self._is_benchmark = runner.config.mode == 'benchmark'
 
+        # Per-kernel execution times (in seconds) and numbers of calls.
+        # Only available if supported by the backend.
+        self._collect_kernel_timings = getattr(runner.backend,
+                                               'collect_kernel_timings', None)
+        self.kernel_timings = defaultdict(float)
+        self.kernel_calls = defaultdict(int)
+
     def record_start(self):
         self.t_start = time.time()
 
@@ -102,16 +110,36 @@ class TimeProfile(object):
 
         self._runner.send_summary_info(ti, min_ti, max_ti)
 
+        for name in sorted(self.kernel_timings):
+            calls = self.kernel_calls[name]
+            self._runner.config.logger.info(
+                'Kernel {0}: {1} calls, {2:.3f} ms/call, {3:.3f} s total'.format(
+                    name, calls, self.kernel_timings[name] / calls * 1e3,
+                    self.kernel_timings[name]))
+
     def start_step(self):
         self.record_cpu_start(self.STEP)
 
     def end_step(self):
-        if (not self._is_benchmark or self._runner._sim.iteration <
+        if not self._is_benchmark:
+            return
+
+        # Always collect the timings so that they do not accumulate in the
+        # backend while samples are not being taken.
+        kernel_timings = []
+        if self._collect_kernel_timings is not None:
+            kernel_timings = self._collect_kernel_timings()
+
+        if (self._runner._sim.iteration <
             self._runner.config.benchmark_sample_from):
             return
 
         self.record_cpu_end(self.STEP)
 
+        for name, duration in kernel_timings:
+            self.kernel_timings[name] += duration
+            self.kernel_calls[name] += 1
+
         # Aggregate timings from GPU events.
         for i, ev_start in self._events_start.items():
             duration = self._events_end[i].time_since(ev_start) / 1e3
@@ -11,8 +11,8 @@ import inspect
 import operator
 import multiprocessing as mp
 import numpy as np
-from scipy.ndimage import filters
 
+from sailfish import geo_cache
 from sailfish import util
 from sailfish import sym
 import sailfish.node_type as nt
@@ -61,6 +61,10 @@ class SubdomainSpec(object):
         self._clear_connections()
         self._clear_connectors()
 
+        # Number of active nodes in the subdomain, if known at the time of
+        # domain decomposition.  Used to balance the load when assigning
+        # subdomains to GPUs.
+        self.active_nodes = None
         self.geo_queue = None
         self.vis_buffer = None
         self.vis_geo_buffer = None
@@ -108,6 +112,14 @@ class SubdomainSpec(object):
     def periodic(self):
         return any(self._periodicity)
 
+    def codegen_signature(self):
+        """Returns a tuple of the properties of the subdomain that can affect
+        the generated compute unit code. Subdomains with identical signatures
+        differ only in their location and ID."""
+        return (self.dim, tuple(self.size), tuple(self.actual_size),
+                self.envelope_size, tuple(self._periodicity),
+                tuple(sorted(self._connections.keys())))
+
     def update_context(self, ctx):
         ctx['dim'] = self.dim
         # The flux tensor is a symmetric matrix.
@@ -356,6 +368,12 @@ class Subdomain(object):
     NODE_MISC_SHIFT = 1
     NODE_TYPE_MASK = 2
 
+    #: Whether the processed geometry can be stored in and loaded from the
+    #: geometry cache (--geometry_cache_dir).  boundary_conditions() is not
+    #: called when the geometry is loaded from the cache, so subclasses which
+    #: set up other state there should set this to False.
+    cache_geometry = True
+
     @classmethod
     def add_options(cls, group):
         pass
@@ -377,9 +395,14 @@ class Subdomain(object):
         self._type_vis_map = np.zeros(self.lat_shape, dtype=np.uint8)
         self._type_map_encoded = False
         self._params = {}
+        # Maps hashes of node parameters to keys in the param map.
+        self._param_keys = {}
         self._encoder = None
         self._seen_types = set([0])
         self._needs_orientation = False
+        # Slice (along the slowest-changing axis of the base field) of the
+        # slab for which boundary conditions are currently being set.
+        self._slab = None
 
         # A dense boolean array indicating which nodes are active in the
         # simulation (marked as True). This is only used in the indirect
@@ -387,8 +410,12 @@ class Subdomain(object):
         self.active_node_mask = None
 
         if self.spec.runner.config.node_addressing == 'indirect':
-            self.config.logger.debug('Loading active node map..')
-            self.load_active_node_map(*self._get_mgrid_base(self.config))
+            cache = geo_cache.get_geometry_cache(self)
+            if cache is not None:
+                self.active_node_mask = cache.load_active_node_mask(self)
+            if self.active_node_mask is None:
+                self.config.logger.debug('Loading active node map..')
+                self.load_active_node_map(*self._get_mgrid_base(self.config))
             self.spec.runner.config.logger.info('Fill ratio is: %0.2f%%' %
                     (self.active_nodes / float(self.spec.num_actual_nodes) * 100))
 
@@ -397,7 +424,9 @@ class Subdomain(object):
         self._type_map_ghost, self._sparse_type_map = runner.make_scalar_field(np.uint32, register=False, nonghost_view=False)
         self._type_map = self._type_map_ghost[self.spec._nonghost_slice]
         self._type_map_base = runner.field_base(self._type_map_ghost)
-        self._param_map, self._sparse_param_map = runner.make_scalar_field(dtype=np.int_, register=False)
+        # Param map entries are small consecutive keys, so start with the
+        # smallest dtype and widen it as necessary (see _param_key).
+        self._param_map, self._sparse_param_map = runner.make_scalar_field(dtype=np.uint8, register=False)
         self._param_map_base = runner.field_base(self._param_map)
         self._orientation, self._sparse_orientation_map = runner.make_scalar_field(np.uint32, register=False)
         self._orientation_base = runner.field_base(self._orientation)
@@ -441,15 +470,19 @@ class Subdomain(object):
 
         Use this with arrays covering all nodes in the global simulation domain.
         Args are the index arrays hx, hy, [hz].
-        """
-        if self.dim == 3:
-            hz = args[0]
 
+        Only the bounding box of the selected nodes is read from array, so
+        memory-mapped arrays and chunked containers (see util.open_array)
+        can be used to avoid loading the whole global array into memory.
+        """
         es = self.spec.envelope_size
-        if self.dim == 2:
-            return array[hy + es, hx + es]
-        else:
-            return array[hz + es, hy + es, hx + es]
+        box = []
+        idx = []
+        for h in reversed((hx, hy) + args[:self.dim - 2]):
+            low = int(np.min(h))
+            box.append(slice(low + es, int(np.max(h)) + es + 1))
+            idx.append(h - low)
+        return np.asarray(array[tuple(box)])[tuple(idx)]
 
     def set_active_node_map_from_wall_map(self, wall_map):
         """Sets the active node map from a wall map.
@@ -463,13 +496,18 @@ class Subdomain(object):
         """
         self.config.logger.debug('... setting active node map from wall map')
         fluid_map = np.logical_not(wall_map)
-        neighbor = self._lattice_kernel(zero=0)
+        shift = util.PeriodicShift(fluid_map, self._max_shift())
+        # Skip the stationary vector.
+        basis = self._int_basis()[1:]
 
         # Mark nodes connected to at least one active node as active.
         # We need these nodes for walls and ghost nodes.
-        mask = (filters.convolve(fluid_map.astype(np.uint8), neighbors,
-                                  mode='wrap') > 0)
-        fluid_map[mask] = True
+        def _mark(chunk):
+            active = fluid_map[chunk]
+            for vec in basis:
+                active |= shift.shifted(vec, chunk)
+
+        util.map_chunks(_mark, fluid_map.shape, self.config.geometry_threads)
         self.active_node_mask = fluid_map
 
     @property
@@ -484,7 +522,11 @@ class Subdomain(object):
         if self.active_node_mask is not None:
             return self.active_nodes
         else:
-            return np.sum(self.fluid_map())
+            fm = self.visualization_map()
+            wet_types = self._used_type_ids(nt.get_wet_node_type_ids(), fm)
+            return sum(util.map_chunks(
+                lambda chunk: np.count_nonzero(
+                    util.in_anyd_fast(fm[chunk], wet_types)), fm.shape))
 
     def _verify_params(self, mask, node_type):
         """Verifies that the node parameters are set correctly."""
@@ -502,7 +544,7 @@ class Subdomain(object):
             # needs to be a numpy record array.  Use node_util.multifield()
             # to create this array easily.
             elif isinstance(param, np.ndarray):
-                assert param.size == np.sum(mask), ("Your array needs to "
+                assert param.size == mask[0].size, ("Your array needs to "
                         "have exactly as many nodes as there are True values "
                         "in the 'where' array.  Use node_util.multifield() to "
                         "generate the array in an easy way.")
@@ -532,7 +574,12 @@ class Subdomain(object):
         :param mask: index expression selecting nodes to set
         :param node_type: LBNodeType subclass or instance
         """
-        mask = np.where(mask)
+        shape = self.full_lat_shape
+        if self._slab is not None:
+            shape[0] = self._slab.stop - self._slab.start
+        mask = np.where(self._broadcast_mask(mask, shape))
+        if self._slab is not None:
+            mask = (mask[0] + self._slab.start,) + mask[1:]
         assert not self._type_map_encoded
         if inspect.isclass(node_type):
             assert issubclass(node_type, nt.LBNodeType)
@@ -542,7 +589,7 @@ class Subdomain(object):
 
         self._verify_params(mask, node_type)
         self._type_map_base[mask] = node_type.id
-        key = hash((node_type.id, self._hashable_params(node_type.params)))
+        key = self._param_key(node_type)
         assert np.all(self._param_map_base[mask] == 0),\
                 "Overriding previously set nodes is not allowed."
         self._param_map_base[mask] = key
@@ -554,6 +601,35 @@ class Subdomain(object):
         elif node_type.needs_orientation:
             self._needs_orientation = True
 
+    @staticmethod
+    def _broadcast_mask(mask, shape):
+        """Expands a boolean mask built from sparse coordinate arrays to
+        the full shape (without copying it)."""
+        if (isinstance(mask, np.ndarray) and mask.dtype == np.bool_ and
+                mask.size < np.prod(shape)):
+            return np.broadcast_to(mask, shape)
+        return mask
+
+    def _param_key(self, node_type):
+        """Returns the key of the parameters of node_type in the param map.
+
+        Keys are assigned consecutively, starting from 1.  The param map
+        is widened if the new key does not fit in its dtype."""
+        h = hash((node_type.id, self._hashable_params(node_type.params)))
+        if h in self._param_keys:
+            return self._param_keys[h]
+
+        key = len(self._param_keys) + 1
+        self._param_keys[h] = key
+        if key > np.iinfo(self._param_map_base.dtype).max:
+            runner = self.spec.runner
+            old_map = self._param_map_base
+            self._param_map, self._sparse_param_map = runner.make_scalar_field(
+                dtype=np.min_scalar_type(key), register=False)
+            self._param_map_base = runner.field_base(self._param_map)
+            self._param_map_base[:] = old_map
+        return key
+
     def update_node(self, mask, node_type):
         """Updates a boundary condition at selected node(s).
 
@@ -569,7 +645,8 @@ class Subdomain(object):
         if not self._type_map_encoded:
             raise ValueError('Simulation not started. Use set_node instead.')
 
-        key = hash((node_type.id, self._hashable_params(node_type.params)))
+        key = self._param_keys.get(
+            hash((node_type.id, self._hashable_params(node_type.params))))
         if key not in self._params:
             if node_type.id == 0:
                 key = 0
@@ -581,6 +658,7 @@ class Subdomain(object):
                                             or node_type.orientation is None):
             raise ValueError('Node orientation not specified.')
 
+        mask = self._broadcast_mask(mask, self.lat_shape)
         self._type_vis_map[mask] = node_type.id
         self._type_map[mask] = self._encoder._subdomain_encode_node(
             getattr(node_type, 'orientation', 0),
@@ -601,72 +679,107 @@ class Subdomain(object):
             if not periodic:
                 ngs[i] = slice(None)
 
-        # Limit dry and wet types to these that are actually used in the simulation.
-        uniq_types = set(np.unique(self._type_map.base))
-        dry_types = list(set(nt.get_dry_node_type_ids()) & uniq_types)
-        wet_types = list(set(nt.get_wet_node_type_ids()) & uniq_types)
-        orient_types = list(set(nt.get_link_tag_node_type_ids()) & uniq_types)
+        # Limit wet types to these that are actually used in the simulation.
+        wet_types = self._used_type_ids(nt.get_wet_node_type_ids())
+        orient_types = self._used_type_ids(nt.get_link_tag_node_type_ids())
 
-        if not orient_types:
+        if not len(orient_types):
             return False
 
-        # Convert to a numpy array.
-        dry_types = self._type_map.dtype.type(dry_types)
-        wet_types = self._type_map.dtype.type(wet_types)
-        orient_types = self._type_map.dtype.type(orient_types)
-        # Only do direction tagging for nodes that do not have
-        # orientation/direction already.
-        orient_map = (
-            util.in_anyd_fast(self._type_map_base[ngs], orient_types) &
-            (self._orientation_base[ngs] == 0))
-
-        l = self.grid.dim - 1
-        # Skip the stationary vector.
-        for i, vec in enumerate(self.grid.basis[1:]):
-            shifted_map = self._type_map_base[ngs]
-            for j, shift in enumerate(vec):
-                if shift == 0:
-                    continue
-                shifted_map = np.roll(shifted_map, int(-shift), axis=l-j)
-
-            # If the given distribution points to a fluid node, tag it as
-            # active.
-            idx = orient_map & util.in_anyd_fast(shifted_map, wet_types)
-            self._orientation_base[ngs][idx] |= (1 << i)
+        type_map = self._type_map_base[tuple(ngs)]
+        orientation = self._orientation_base[tuple(ngs)]
 
+        # Skip the stationary vector.
+        basis = self._int_basis()[1:]
+
+        for slab in self._slabs(type_map.shape[0]):
+            wet_map = util.PeriodicShift(
+                type_map, self._max_shift(), rows=slab,
+                func=lambda x: util.in_anyd_fast(x, wet_types))
+            slab_type_map = type_map[slab]
+            slab_orientation = orientation[slab]
+
+            def _tag(chunk):
+                # Only do direction tagging for nodes that do not have
+                # orientation/direction already.
+                chunk_orientation = slab_orientation[chunk]
+                orient_map = (util.in_anyd_fast(slab_type_map[chunk],
+                                                orient_types) &
+                              (chunk_orientation == 0))
+                for i, vec in enumerate(basis):
+                    # If the given distribution points to a fluid node, tag
+                    # it as active.
+                    idx = orient_map & wet_map.shifted(vec, chunk)
+                    chunk_orientation[idx] |= (1 << i)
+
+            util.map_chunks(_tag, slab_type_map.shape,
+                            self.config.geometry_threads)
         self.config.logger.debug('... link tagging done.')
         return True
 
     def detect_orientation(self, use_tags):
-        # Limit dry and wet types to these that are actually used in the simulation.
-        uniq_types = set(np.unique(self._type_map.base))
-        dry_types = list(set(nt.get_dry_node_type_ids()) & uniq_types)
-        orient_types = list((set(nt.get_orientation_node_type_ids()) -
-                             set(nt.get_link_tag_node_type_ids() if use_tags
-                                 else [])) & uniq_types)
-
-        if not orient_types:
-            return
+        # Limit orientation types to these that are actually used in the
+        # simulation.
+        orient_types = self._used_type_ids(
+            set(nt.get_orientation_node_type_ids()) -
+            set(nt.get_link_tag_node_type_ids() if use_tags else []))
 
-        # Convert to a numpy array.
-        dry_types = self._type_map.dtype.type(dry_types)
-        orient_types = self._type_map.dtype.type(orient_types)
-        orient_map = util.in_anyd_fast(self._type_map_base, orient_types)
-        l = self.grid.dim - 1
-        for vec in self.grid.basis:
-            # Orientaion only handles the primary directions. More complex
-            # setups need link tagging.
-            if vec.dot(vec) != 1:
-                continue
-            shifted_map = self._type_map_base
-            for j, shift in enumerate(vec):
-                if shift == 0:
-                    continue
-                shifted_map = np.roll(shifted_map, int(-shift), axis=l-j)
+        if not len(orient_types):
+            return
 
-            # Only set orientation where it's not already defined (=0).
-            idx = orient_map & (shifted_map == 0) & (self._orientation_base == 0)
-            self._orientation_base[idx] = self.grid.vec_to_dir(list(vec))
+        # Orientaion only handles the primary directions. More complex
+        # setups need link tagging.
+        vecs = [vec for vec in self._int_basis()
+                if sum(x * x for x in vec) == 1]
+        dirs = [self.grid.vec_to_dir(list(vec)) for vec in vecs]
+
+        for slab in self._slabs(self._type_map_base.shape[0]):
+            fluid_map = util.PeriodicShift(self._type_map_base,
+                                           self._max_shift(), rows=slab,
+                                           func=lambda x: x == 0)
+            slab_type_map = self._type_map_base[slab]
+            slab_orientation = self._orientation_base[slab]
+
+            def _detect(chunk):
+                orient_map = util.in_anyd_fast(slab_type_map[chunk],
+                                               orient_types)
+                orientation = slab_orientation[chunk]
+                for vec, direction in zip(vecs, dirs):
+                    # Only set orientation where it's not already defined
+                    # (=0).
+                    idx = (orient_map & fluid_map.shifted(vec, chunk) &
+                           (orientation == 0))
+                    orientation[idx] = direction
+
+            util.map_chunks(_detect, slab_type_map.shape,
+                            self.config.geometry_threads)
+
+    def _int_basis(self):
+        """Returns the basis vectors of the grid as tuples of ints."""
+        return [tuple(int(x) for x in vec) for vec in self.grid.basis]
+
+    def _max_shift(self):
+        """Returns the largest shift along any axis in the grid basis."""
+        return max(abs(x) for vec in self._int_basis() for x in vec)
+
+    def _used_type_ids(self, type_ids, type_map=None):
+        """Returns an array of these node type IDs from type_ids that are
+        actually used in type_map (the base type map by default)."""
+        if type_map is None:
+            type_map = self._type_map_base
+        uniq_types = set(util.unique(type_map, self.config.geometry_threads))
+        return type_map.dtype.type(sorted(set(type_ids) & uniq_types))
+
+    def _slabs(self, num_rows):
+        """Returns a list of slices covering num_rows rows along the
+        slowest-changing axis, in slabs of geometry_slab_size rows.  If slab
+        processing is disabled, a single slice covering all rows is
+        returned."""
+        size = self.config.geometry_slab_size
+        if size <= 0:
+            size = max(num_rows, 1)
+        return [slice(i, min(i + size, num_rows))
+                for i in range(0, num_rows, size)]
 
     def reset(self, encode=True):
         self.config.logger.debug('Setting subdomain geometry...')
@@ -678,7 +791,18 @@ class Subdomain(object):
         # another domain.
         # TODO: When setting nodes on ghosts, do not actually save the
         # node parameters as they will never be used.
-        self.boundary_conditions(*self._get_mgrid_base(self.config))
+        #
+        # With geometry_slab_size set, the subdomain is processed in slabs
+        # along the slowest-changing axis, so that the size of the temporary
+        # arrays used here and in the processing steps below depends on the
+        # slab size and not on the size of the subdomain.
+        for slab in self._slabs(self.full_lat_shape[0]):
+            self._slab = slab
+            try:
+                self.boundary_conditions(
+                    *self._get_mgrid_base(self.config, slab))
+            finally:
+                self._slab = None
         self.config.logger.debug('... boundary conditions done.')
 
         have_link_tags = False
@@ -710,9 +834,16 @@ class Subdomain(object):
         # Cache the unencoded type map for visualization.
         self._type_vis_map[:] = self._type_map[:]
 
-        # TODO: At this point, we should decide which GeoEncoder class to use.
+        # Node parameters which do not fit in const memory are stored in
+        # a global memory buffer instead.
         from sailfish import geo_encoder
-        self._encoder = geo_encoder.GeoEncoderConst(self)
+        num_params = geo_encoder.count_node_params(self._params)
+        if num_params > self.config.max_const_node_params:
+            self.config.logger.debug('... using a buffer for %d node '
+                                     'parameters.' % num_params)
+            self._encoder = geo_encoder.GeoEncoderBuffer(self)
+        else:
+            self._encoder = geo_encoder.GeoEncoderConst(self)
         self._encoder.prepare_encode(self._type_map_base, self._param_map_base,
                                      self._params, self._orientation_base,
                                      have_link_tags)
@@ -737,7 +868,7 @@ class Subdomain(object):
             the fluid in the direction corresponding to the distribution
         """
         # Find all non-fluid nodes within the specified bounding box.
-        mgrid = self._get_mgrid()
+        mgrid = self._get_mgrid(sparse=True)
         cond = (self._type_vis_map != nt._NTFluid.id)
         for mx, x0, x1 in zip(mgrid, fo.start, fo.end):
             cond &= (mx >= x0) & (mx <= x1)
@@ -745,19 +876,27 @@ class Subdomain(object):
         self.config.logger.debug('%s: num solid nodes: %d' %
                                  (fo, np.sum(cond)))
 
-        ret = {}
-        l = self.grid.dim - 1
         # Skip the stationary vector.
-        for i, vec in enumerate(self.grid.basis[1:]):
-            shifted_map = self._type_vis_map.copy()
-
-            for j, shift in enumerate(vec):
-                if shift == 0:
-                    continue
-                shifted_map = np.roll(shifted_map, int(-shift), axis=l-j)
+        basis = self._int_basis()[1:]
+        fluid_map = util.PeriodicShift(self._type_vis_map == nt._NTFluid.id,
+                                       self._max_shift())
+
+        def _find(chunk):
+            chunk_cond = cond[chunk]
+            ret = []
+            for vec in basis:
+                # The current distribution is pointing to a fluid node.
+                t = np.nonzero(chunk_cond & fluid_map.shifted(vec, chunk))
+                ret.append((t[0] + chunk.start,) + t[1:])
+            return ret
+
+        chunks = util.map_chunks(_find, cond.shape,
+                                 self.config.geometry_threads)
 
-            # The current distribution is pointing to a fluid node.
-            t = np.where(cond & (shifted_map == nt._NTFluid.id))
+        ret = {}
+        for i in range(len(basis)):
+            t = [np.concatenate([c[i][j] for c in chunks])
+                 for j in range(cond.ndim)]
             # Only add entries for distributions that actually contribute
             # momentum.
             if t[0].size > 0:
@@ -770,8 +909,28 @@ class Subdomain(object):
         """Node scratch space size expressed in number of floating point values."""
         return self._encoder.scratch_space_size if self._encoder is not None else 0
 
+    @property
+    def node_params(self):
+        """Node parameters to be stored in a device buffer, or None if the
+        parameters are embedded in the generated code."""
+        return self._encoder.param_buffer if self._encoder is not None else None
+
+    def node_param_map(self, indirect_address=None):
+        """Returns a uint32 array with the offsets of the parameters of every
+        node in node_params, using the same layout as encoded_map(), or None
+        if the offsets are part of the node codes."""
+        param_map = self._encoder.param_index_map
+        if param_map is None or indirect_address is None:
+            return param_map
+
+        assert self.active_node_mask is not None
+        anm = self.active_node_mask
+        sparse_param_map = np.zeros(self.active_nodes, dtype=np.uint32)
+        sparse_param_map[indirect_address[anm]] = param_map[anm]
+        return sparse_param_map
+
     def init_fields(self, sim):
-        mgrid = self._get_mgrid()
+        mgrid = self._get_mgrid(sparse=self.config.sparse_coordinates)
         self.initial_conditions(sim, *mgrid)
 
     def update_context(self, ctx):
@@ -812,57 +971,78 @@ class Subdomain(object):
         represent fluid and have valid macroscopic fields)."""
         fm = self.visualization_map()
         if wet:
-            uniq_types = set(np.unique(fm))
-            wet_types = list(set(nt.get_wet_node_type_ids()) & uniq_types)
-            wet_types = self._type_map.dtype.type(wet_types)
+            wet_types = self._used_type_ids(nt.get_wet_node_type_ids(), fm)
             return util.in_anyd_fast(fm, wet_types)
         else:
             return fm == 0
 
-    def _fluid_map(self, wet=True, base=True, allow_unused=None):
-        assert not self._type_map_encoded
-
-        if base:
-            src = self._type_map_base
-        else:
-            src = self._type_map
-
-        if wet:
-            uniq_types = set(np.unique(src))
-            wet_types = list(set(nt.get_wet_node_type_ids(allow_unused=allow_unused)) & uniq_types)
-            wet_types = self._type_map.dtype.type(wet_types)
-            return util.in_anyd_fast(src, wet_types)
-        else:
-            return src == 0
-
-    def _lattice_kernel(self, zero=1):
-        raise NotImplementedError
+    def _neighborhood_any(self, mask, cval):
+        """Returns a boolean array indicating nodes for which mask is True
+        at the node itself or at any of its neighbors (along the grid basis
+        vectors).  Nodes outside of the array are assumed to have the value
+        of cval."""
+        padded = np.pad(mask, 1, mode='constant', constant_values=cval)
+        ret = np.zeros(mask.shape, dtype=np.bool)
+        for vec in self._int_basis():
+            ret |= padded[tuple(slice(1 + vec[self.dim - 1 - axis],
+                                      1 + vec[self.dim - 1 - axis] + size)
+                                for axis, size in enumerate(mask.shape))]
+        return ret
 
     def _postprocess_nodes(self):
-        fluid_map = self._fluid_map(wet=False, base=True).astype(np.uint8)
-        wet_map_for_unused = self._fluid_map(wet=True, allow_unused=True, base=True).astype(np.uint8)
-        wet_map = self._fluid_map(wet=True, base=True).astype(np.uint8)
-        neighbors = self._lattice_kernel()
-
-        # Any *wet* node not connected to at least one *fluid* node is marked unused.
-        # Note that dry nodes connecting to wet nodes need to be retained.
-        # For instance:
-        #  W W
-        #  W V
-        # where W is a HBB wall and V is a velocity BC.
-        mask = (filters.convolve(fluid_map, neighbors, mode='constant', cval=1) == 0)
-        self._type_map_base[mask & wet_map_for_unused.astype(np.bool)] = nt._NTUnused.id
-
-        # Any dry node, not connected to at least one wet node is marked unused.
-        # For instance, for HBB walls: .. W W W F -> .. U U W F.
-        mask = (filters.convolve(wet_map, neighbors, mode='constant', cval=0) == 0)
-        self._type_map_base[mask & np.logical_not(wet_map.astype(np.bool))] = nt._NTUnused.id
-
-        # If an unused node touches a wet node, mark it as propagation only.
-        # For instance, for HBB walls: .. U U W F -> .. U P W F.
-        used_map = (self._type_map_base != nt._NTUnused.id).astype(np.uint8)
-        mask = (filters.convolve(used_map, neighbors, mode='constant', cval=0) > 0)
-        self._type_map_base[mask & (self._type_map_base == nt._NTUnused.id)] = nt._NTPropagationOnly.id
+        """Detects unused and propagation-only nodes.
+
+        All nodes are classified in a single pass over the type map, in
+        chunks which are processed independently (and in parallel if
+        geometry_threads > 1).  The type map is only modified after all
+        chunks are processed."""
+        assert not self._type_map_encoded
+        type_map = self._type_map_base
+        wet_types = self._used_type_ids(nt.get_wet_node_type_ids())
+        wet_types_for_unused = self._used_type_ids(
+            nt.get_wet_node_type_ids(allow_unused=True))
+        # Propagation-only nodes are detected using unused nodes in their
+        # neighborhood, so a halo of two nodes is necessary around every
+        # chunk.
+        halo = 2
+
+        def _classify(chunk):
+            lo = max(chunk.start - halo, 0)
+            hi = min(chunk.stop + halo, type_map.shape[0])
+            core = slice(chunk.start - lo, chunk.stop - lo)
+            ext = type_map[lo:hi]
+            wet_map = util.in_anyd_fast(ext, wet_types)
+
+            # Any *wet* node not connected to at least one *fluid* node is
+            # marked unused.  Note that dry nodes connecting to wet nodes need
+            # to be retained.  For instance:
+            #  W W
+            #  W V
+            # where W is a HBB wall and V is a velocity BC.
+            unused = (np.logical_not(self._neighborhood_any(ext == 0, True)) &
+                      util.in_anyd_fast(ext, wet_types_for_unused))
+
+            # Any dry node, not connected to at least one wet node is marked
+            # unused.  For instance, for HBB walls: .. W W W F -> .. U U W F.
+            unused |= (np.logical_not(self._neighborhood_any(wet_map, False)) &
+                       np.logical_not(wet_map))
+            unused |= (ext == nt._NTUnused.id)
+
+            # If an unused node touches a used node, mark it as propagation
+            # only.  For instance, for HBB walls: .. U U W F -> .. U P W F.
+            propagation_only = unused & self._neighborhood_any(
+                np.logical_not(unused), False)
+            unused &= np.logical_not(propagation_only)
+            return np.packbits(unused[core]), np.packbits(propagation_only[core])
+
+        results = util.map_chunks(_classify, type_map.shape,
+                                  self.config.geometry_threads)
+        for chunk, masks in zip(util.chunk_slices(type_map.shape), results):
+            chunk_map = type_map[chunk]
+            for mask, node_type in zip(masks, (nt._NTUnused,
+                                               nt._NTPropagationOnly)):
+                mask = np.unpackbits(mask)[:chunk_map.size].astype(np.bool)
+                chunk_map[mask.reshape(chunk_map.shape)] = node_type.id
 
 
 class Subdomain2D(Subdomain):
@@ -872,20 +1052,31 @@ class Subdomain2D(Subdomain):
         self.gy, self.gx = grid_shape
         Subdomain.__init__(self, grid_shape, spec, *args, **kwargs)
 
-    def _get_mgrid(self):
+    def _get_mgrid(self, sparse=False):
         """Returns a sequence (in natural order) of indexing arrays for the
-        non-ghost slice."""
-        return reversed(np.mgrid[self.spec.oy:self.spec.oy + self.spec.ny,
-                                 self.spec.ox:self.spec.ox + self.spec.nx])
+        non-ghost slice.
 
-    def _get_mgrid_base(self, config):
+        :param sparse: if True, returns broadcastable (np.ogrid-style)
+            arrays instead of full ones
+        """
+        grid = np.ogrid if sparse else np.mgrid
+        return reversed(grid[self.spec.oy:self.spec.oy + self.spec.ny,
+                             self.spec.ox:self.spec.ox + self.spec.nx])
+
+    def _get_mgrid_base(self, config, rows=slice(None)):
         """Returns a sequence (in natural order) of indexing arrays for the
-        base field (including ghosts)."""
+        base field (including ghosts).
+
+        :param rows: slice along the Y axis of the base field, selecting
+            the part of the field to return the arrays for
+        """
         es = self.spec.envelope_size
         ox = self.spec.ox - es
         oy = self.spec.oy - es
-        hx, hy = reversed(np.mgrid[oy:oy + self.spec.ny + 2 * es,
-                                   ox:ox + self.spec.nx + 2 * es])
+        y0, y1, _ = rows.indices(self.spec.ny + 2 * es)
+        grid = np.ogrid if config.sparse_coordinates else np.mgrid
+        hx, hy = reversed(grid[oy + y0:oy + y1,
+                               ox:ox + self.spec.nx + 2 * es])
         if config.periodic_x:
             hx[hx < 0] += self.gx
             hx[hx >= self.gx] -= self.gx
@@ -924,13 +1115,6 @@ class Subdomain2D(Subdomain):
         _set(self._type_map_base[es + self.spec.ny:, :], self.spec.Y_HIGH)
         _set(self._type_map_base[:, es + self.spec.nx:], self.spec.X_HIGH)
 
-    def _lattice_kernel(self, zero=1):
-        neighbors = np.zeros((3, 3), dtype=np.uint8)
-        neighbors[1,1] = zero
-        for ei in self.grid.basis:
-            neighbors[1 + ei[1], 1 + ei[0]] = 1
-        return neighbors
-
 
 class Subdomain3D(Subdomain):
     dim = 3
@@ -939,21 +1123,28 @@ class Subdomain3D(Subdomain):
         self.gz, self.gy, self.gx = grid_shape
         Subdomain.__init__(self, grid_shape, spec, *args, **kwargs)
 
-    def _get_mgrid(self):
-        return reversed(np.mgrid[self.spec.oz:self.spec.oz + self.spec.nz,
-                                 self.spec.oy:self.spec.oy + self.spec.ny,
-                                 self.spec.ox:self.spec.ox + self.spec.nx])
+    def _get_mgrid(self, sparse=False):
+        grid = np.ogrid if sparse else np.mgrid
+        return reversed(grid[self.spec.oz:self.spec.oz + self.spec.nz,
+                             self.spec.oy:self.spec.oy + self.spec.ny,
+                             self.spec.ox:self.spec.ox + self.spec.nx])
 
-    def _get_mgrid_base(self, config):
+    def _get_mgrid_base(self, config, rows=slice(None)):
         """Returns a sequence (in natural order) of indexing arrays for the
-        base field (including ghosts)."""
+        base field (including ghosts).
+
+        :param rows: slice along the Z axis of the base field, selecting
+            the part of the field to return the arrays for
+        """
         es = self.spec.envelope_size
         ox = self.spec.ox - es
         oy = self.spec.oy - es
         oz = self.spec.oz - es
-        hx, hy, hz = reversed(np.mgrid[oz:oz + self.spec.nz + 2 * es,
-                                       oy:oy + self.spec.ny + 2 * es,
-                                       ox:ox + self.spec.nx + 2 * es])
+        z0, z1, _ = rows.indices(self.spec.nz + 2 * es)
+        grid = np.ogrid if config.sparse_coordinates else np.mgrid
+        hx, hy, hz = reversed(grid[oz + z0:oz + z1,
+                                   oy:oy + self.spec.ny + 2 * es,
+                                   ox:ox + self.spec.nx + 2 * es])
         if config.periodic_x:
             hx[hx < 0] += self.gx
             hx[hx >= self.gx] -= self.gx
@@ -999,10 +1190,3 @@ class Subdomain3D(Subdomain):
         _set(self._type_map_base[es + self.spec.nz:, :, :], self.spec.Z_HIGH)
         _set(self._type_map_base[:, es + self.spec.ny:, :], self.spec.Y_HIGH)
         _set(self._type_map_base[:, :, es + self.spec.nx:], self.spec.X_HIGH)
-
-    def _lattice_kernel(self, zero=1):
-        neighbors = np.zeros((3, 3, 3), dtype=np.uint8)
-        neighbors[1,1,1] = zero
-        for ei in self.grid.basis:
-            neighbors[1 + ei[2], 1 + ei[1], 1 + ei[0]] = 1
-        return neighbors
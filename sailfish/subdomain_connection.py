@@ -163,7 +163,8 @@ class ConnectionBuffer(object):
             coll_idx_opposite=None,
             dist_full_idx_opposite=None,
             local_coll_buf=None,
-            local_recv_buf=None):
+            local_recv_buf=None,
+            sparse_halo=False):
         """
         :param face: face ID
         :param cpair: ConnectionPair, a tuple of two LBConnection objects
@@ -193,6 +194,9 @@ class ConnectionBuffer(object):
             the AA access pattern
         :param local_recv_buf: like recv_buf, but for the fully local step of
             the AA access pattern
+        :param sparse_halo: if True, only the data for nodes active on both
+            sides of the connection is transferred; recv_buf is then a flat
+            array, distributed to the nodes indicated by dist_full_idx
         """
         self.face = face
         self.cpair = cpair
@@ -209,17 +213,30 @@ class ConnectionBuffer(object):
         self.dist_full_idx_opposite = dist_full_idx_opposite
         self.local_coll_buf = local_coll_buf
         self.local_recv_buf = local_recv_buf
+        self.sparse_halo = sparse_halo
+
+    def distribute(self, backend, stream, recv_buf=None):
+        """
+        :param recv_buf: if not None, array of the same shape as
+            self.recv_buf, from which the data is read instead
+        """
+        if recv_buf is None:
+            recv_buf = self.recv_buf
+
+        if self.sparse_halo:
+            self.dist_full_buf.host[:] = recv_buf
+            backend.to_buf_async(self.dist_full_buf.gpu, stream)
+            return
 
-    def distribute(self, backend, stream):
         # Serialize partial distributions into a contiguous buffer.
         if self.dist_partial_sel is not None:
-            self.dist_partial_buf.host[:] = self.recv_buf[self.dist_partial_sel]
+            self.dist_partial_buf.host[:] = recv_buf[self.dist_partial_sel]
             backend.to_buf_async(self.dist_partial_buf.gpu, stream)
 
         if self.cpair.dst.dst_slice:
-            slc = [slice(0, self.recv_buf.shape[0])] + list(
+            slc = [slice(0, recv_buf.shape[0])] + list(
                     reversed(self.cpair.dst.dst_full_buf_slice))
-            self.dist_full_buf.host[:] = self.recv_buf[slc]
+            self.dist_full_buf.host[:] = recv_buf[slc]
             backend.to_buf_async(self.dist_full_buf.gpu, stream)
 
     def distribute_unpropagated(self, backend, stream):
@@ -18,7 +18,8 @@ import signal
 import time
 import numpy as np
 import zmq
-from sailfish import codegen, io
+from sailfish import codegen, geo_cache, io
+from sailfish.comm_thread import CommThread
 from sailfish.lb_base import LBMixIn, LBSim
 from sailfish.profile import profile, TimeProfile
 from sailfish.subdomain_connection import ConnectionBuffer, MacroConnectionBuffer
@@ -63,6 +64,11 @@ class SubdomainRunner(object):
     """
     INVALID_NODE = 0xffffffff
 
+    # Used to exchange data with other subdomains in the background, if
+    # enabled (see CommThread).
+    _comm_thread = None
+    _pending_exchange = None
+
     def __init__(self, simulation, spec, output, backend, quit_event,
             summary_addr=None, master_addr=None, summary_channel=None):
         """
@@ -171,6 +177,9 @@ class SubdomainRunner(object):
             connector.set_addr(addr)
             connector.init_runner(self._ctx)
 
+        for connector in self._spec._connectors.values():
+            connector.close_unused()
+
     @property
     def config(self):
         return self._sim.config
@@ -179,6 +188,11 @@ class SubdomainRunner(object):
     def dim(self):
         return self._spec.dim
 
+    @property
+    def time_profile(self):
+        """TimeProfile object with the timings of the simulation."""
+        return self._profile
+
     def update_context(self, ctx):
         """Called by the codegen module."""
         self._spec.update_context(ctx)
@@ -351,7 +365,11 @@ class SubdomainRunner(object):
         self._subdomain = self._sim.subdomain(self._global_size, self._spec, self._sim.grid)
         self._log_required_memory()
         self._subdomain.allocate()
-        self._subdomain.reset()
+        cache = geo_cache.get_geometry_cache(self._subdomain)
+        if cache is None or not cache.load(self._subdomain):
+            self._subdomain.reset()
+            if cache is not None:
+                cache.save(self._subdomain)
         self._output.set_fluid_map(self._subdomain.fluid_map())
         if self.config.debug_dump_node_type_map:
             self._output.dump_node_type(self._subdomain.visualization_map())
@@ -509,22 +527,93 @@ class SubdomainRunner(object):
             self.lat_linear_dist.extend([self._lat_size[-3] - 1 - evs, evs])
             self.lat_linear_macro.extend([evs, self._lat_size[-3] - 1 - evs])
 
+    def estimate_memory(self):
+        """Returns a dict with estimates of the memory (in bytes) required to
+        simulate the subdomain.
+
+        Only requires the shape of the subdomain to be initialized
+        (_init_shape()), and the subdomain object to exist when indirect node
+        addressing is used.  The keys are:
+
+        - dists_ab, dists_aa: distributions for the AB and AA access patterns
+        - fields: macroscopic fields on the compute device
+        - halo_buffers: buffers for data exchanged with other subdomains
+        - device: total for the compute device (for the selected access
+          pattern), including the node type map
+        - host: host copies of the macroscopic fields, geometry maps and
+          communication buffers
+        """
+        float_bytes = self.float().nbytes
+        dist_bytes = sum([self._get_dist_bytes(g) for g in self._sim.grids])
+        scalar, vector = self._sim.count_fields(self)
+        field_bytes = (self.num_active_nodes *
+                       (scalar + self.dim * vector) * float_bytes)
+
+        halo_elements = 0
+        for face, block_id in self._spec.connecting_subdomains():
+            for cpair in self._spec.get_connections(face, block_id):
+                shapes = [cpair.src.transfer_shape, cpair.dst.transfer_shape,
+                          cpair.dst.full_shape]
+                if self.config.access_pattern == 'AA':
+                    shapes.extend([cpair.src.local_transfer_shape,
+                                   cpair.dst.local_transfer_shape])
+                halo_elements += sum(reduce(operator.mul, shape)
+                                     for shape in shapes) * len(self._sim.grids)
+        halo_bytes = halo_elements * float_bytes
+
+        if self.config.access_pattern == 'AB':
+            device_dist_bytes = 2 * dist_bytes
+        else:
+            device_dist_bytes = dist_bytes
+
+        return {
+            'dists_ab': 2 * dist_bytes,
+            'dists_aa': dist_bytes,
+            'fields': field_bytes,
+            'halo_buffers': halo_bytes,
+            # Node type map (uint32 per node).
+            'device': (device_dist_bytes + field_bytes + halo_bytes +
+                       self.num_active_nodes * 4),
+            # Fields are stored for all nodes on the host.  The geometry maps
+            # are: type (uint32), orientation (uint32), node parameters (at
+            # least uint8) and visualization (uint8).
+            'host': (self.num_phys_nodes *
+                     ((scalar + self.dim * vector) * float_bytes + 10) +
+                     halo_bytes),
+        }
+
+    def halo_traffic(self):
+        """Returns a dict mapping IDs of connected subdomains to (sent,
+        received) tuples with the number of bytes exchanged with them in
+        a single simulation step (averaged over two steps for the AA access
+        pattern)."""
+        def _bytes(shape):
+            return reduce(operator.mul, shape) * len(self._sim.grids)
+
+        ret = defaultdict(lambda: (0, 0))
+        for face, block_id in self._spec.connecting_subdomains():
+            for cpair in self._spec.get_connections(face, block_id):
+                sent = _bytes(cpair.src.transfer_shape)
+                received = _bytes(cpair.dst.transfer_shape)
+                if self.config.access_pattern == 'AA':
+                    sent = (sent + _bytes(cpair.src.local_transfer_shape)) / 2
+                    received = (received +
+                                _bytes(cpair.dst.local_transfer_shape)) / 2
+                prev_sent, prev_received = ret[block_id]
+                ret[block_id] = (prev_sent + sent * self.float().nbytes,
+                                 prev_received + received * self.float().nbytes)
+        return dict(ret)
+
     def _log_required_memory(self):
         # Compute the total memory required for the simulation and log it early
         # for easier debugging.
-        total_dist_bytes = sum([self._get_dist_bytes(g) for g in self._sim.grids])
-        if self.config.access_pattern == 'AB':
-            total_dist_bytes *= 2
-
+        memory = self.estimate_memory()
         self.config.logger.info('Required memory: ')
         self.config.logger.info('. distributions: %d MiB' %
-                                (total_dist_bytes // 1024 // 1024))
-
-        scalar, vector = self._sim.count_fields(self)
-        total_field_bytes = (self.num_active_nodes *
-                             (scalar + self.dim * vector) * self.float().nbytes)
+                                (memory['dists_' + self.config.access_pattern.lower()]
+                                 // 1024 // 1024))
         self.config.logger.info('. fields: %d MiB' %
-                                (total_field_bytes // 1024 // 1024))
+                                (memory['fields'] // 1024 // 1024))
 
     def _log_relaxation_model(self):
         if not hasattr(self.config, 'model'):
@@ -621,6 +710,25 @@ class SubdomainRunner(object):
             return self._get_global_idx((gx, idx[2], idx[1]),
                                         idx[0]).astype(np.uint32)
 
+    def _face_idx_helper(self, face, loc, buf_slice, dists):
+        """Like _idx_helper, but for connections via any face.
+
+        The returned array has the layout of the transfer buffers (see
+        CollectContinuousData).
+
+        :param face: face ID
+        :param loc: location along the axis perpendicular to the face
+        :param buf_slice: slice in the area of the face
+        :param dists: a list of distribution indices
+        """
+        sel = [slice(0, len(dists))]
+        idx = np.mgrid[sel + list(reversed(buf_slice))].astype(np.uint32)
+        for i, dist_num in enumerate(dists):
+            idx[0][i,:] = dist_num
+        location = list(reversed(idx[1:]))
+        location.insert(self._spec.face_to_axis(face), loc)
+        return self._get_global_idx(location, idx[0]).astype(np.uint32)
+
     def _get_src_slice_indices(self, face, cpair, opposite=False):
         """Returns a numpy array of indices of sparse nodes from which
         data is to be collected.
@@ -810,8 +918,126 @@ class SubdomainRunner(object):
                                           x.grid_id))
             self._recv_block_to_connbuf[subdomain_id] = recv_bufs
 
+        if getattr(self.config, 'sparse_halo', False):
+            self._init_sparse_halo()
+
+    def _pack_mask(self, masks):
+        """Returns a list of boolean arrays packed into a single array that
+        can be sent through a connector."""
+        bits = np.packbits(np.hstack([np.ravel(x) for x in masks]))
+        nbytes = self.float().nbytes
+        ret = np.zeros(int(math.ceil(bits.size / nbytes)) * nbytes,
+                       dtype=np.uint8)
+        ret[:bits.size] = bits
+        return ret.view(self.float)
+
+    def _recv_mask(self, connector, shapes):
+        """Receives boolean arrays of the specified shapes packed with
+        _pack_mask().  Returns None if the quit event is active."""
+        sizes = [reduce(operator.mul, shape) for shape in shapes]
+        nbytes = self.float().nbytes
+        buf = np.zeros(int(math.ceil(sum(sizes) / 8.0 / nbytes)),
+                       dtype=self.float)
+        if not connector.recv(buf, self._quit_event):
+            return None
+        bits = np.unpackbits(buf.view(np.uint8)).astype(np.bool)
+        ret = []
+        i = 0
+        for size, shape in zip(sizes, shapes):
+            ret.append(bits[i:i+size].reshape(shape))
+            i += size
+        return ret
+
+    def _get_sparse_halo_dst_indices(self, cbuf):
+        """Returns a numpy array of indices of nodes to which data is to be
+        distributed, in the layout of the receive buffer.  Entries which are
+        not distributed at all are INVALID_NODE."""
+        cpair = cbuf.cpair
+        idx = np.empty(cbuf.recv_buf.shape, dtype=np.uint32)
+        idx[:] = self.INVALID_NODE
+        if cpair.dst.dst_slice:
+            es = self._spec.envelope_size
+            dst_slice = [slice(x.start + es, x.stop + es) for x in cpair.dst.dst_slice]
+            slc = [slice(0, idx.shape[0])] + list(
+                reversed(cpair.dst.dst_full_buf_slice))
+            idx[tuple(slc)] = self._face_idx_helper(
+                cbuf.face, self.lat_linear_dist[self._spec.opposite_face(cbuf.face)],
+                dst_slice, cpair.dst.dists)
+        if cbuf.dist_partial_sel is not None:
+            idx[tuple(cbuf.dist_partial_sel)] = cbuf.dist_partial_idx.host
+        return idx
+
+    def _init_sparse_halo(self):
+        """Restricts the data exchanged with other subdomains to entries of
+        the transfer buffers corresponding to nodes active on both sides of
+        the connection.
+
+        Every runner first tells the sender which entries of its receive
+        buffers are distributed to active nodes.  The sender drops entries
+        collected from inactive nodes and sends the final selection back, so
+        that both sides use identical selections even if their views of the
+        nodes on the connection face differ.  The selected entries are then
+        collected and distributed with the sparse kernels for all faces.
+        """
+        alloc = self.backend.alloc_async_host_buf
+        connectors = self._spec._connectors
+
+        dst_idx = {}
+        for b_id, connector in connectors.items():
+            cbufs = self._recv_block_to_connbuf[b_id]
+            for cbuf in cbufs:
+                dst_idx[id(cbuf)] = self._get_sparse_halo_dst_indices(cbuf)
+            connector.send(self._pack_mask(
+                [dst_idx[id(x)] != self.INVALID_NODE for x in cbufs]))
+
+        for b_id, connector in connectors.items():
+            cbufs = self._block_to_connbuf[b_id]
+            masks = self._recv_mask(connector, [x.coll_buf.host.shape for x in cbufs])
+            if masks is None:
+                return
+            for cbuf, mask in zip(cbufs, masks):
+                src_idx = self._face_idx_helper(
+                    cbuf.face, self.lat_linear[cbuf.face],
+                    cbuf.cpair.src.src_slice, cbuf.cpair.src.dists)
+                mask &= src_idx != self.INVALID_NODE
+                # Keep the buffers non-empty so that the kernels can always
+                # be run.
+                if not mask.any():
+                    mask.flat[0] = True
+                cbuf.coll_idx = GPUBuffer(src_idx[mask], self.backend)
+                cbuf.coll_buf = GPUBuffer(alloc(cbuf.coll_idx.host.size,
+                                                dtype=self.float), self.backend)
+            connector.send(self._pack_mask(masks))
+
+        for b_id, connector in connectors.items():
+            cbufs = self._recv_block_to_connbuf[b_id]
+            masks = self._recv_mask(connector, [x.recv_buf.shape for x in cbufs])
+            if masks is None:
+                return
+            for cbuf, mask in zip(cbufs, masks):
+                idx = dst_idx[id(cbuf)][mask]
+                cbuf.recv_buf = alloc(idx.size, dtype=self.float)
+                cbuf.dist_full_buf = GPUBuffer(alloc(idx.size, dtype=self.float),
+                                               self.backend)
+                cbuf.dist_full_idx = GPUBuffer(idx, self.backend)
+                cbuf.dist_partial_buf = GPUBuffer(None, self.backend)
+                cbuf.dist_partial_idx = GPUBuffer(None, self.backend)
+                cbuf.dist_partial_sel = None
+                cbuf.sparse_halo = True
+
+        self.config.logger.debug('sparse halo: {0} of {1} entries sent'.format(
+            sum(x.coll_buf.host.size for cbufs in self._block_to_connbuf.values()
+                for x in cbufs),
+            sum(reduce(operator.mul, x.cpair.src.transfer_shape)
+                for cbufs in self._block_to_connbuf.values() for x in cbufs)))
+
     def _update_compute_code(self):
-        code = self._bcg.get_code(self, self.backend.name)
+        if self.backend.runs_on_host:
+            # Host backends run the kernels directly and only need the
+            # context used for code generation.
+            code = self._bcg.get_context(self)
+        else:
+            code = self._bcg.get_code(self, self.backend.name)
         self.config.logger.debug("... compute code prepared.")
         self.module = self.backend.build(code)
 
@@ -917,6 +1143,19 @@ class SubdomainRunner(object):
         else:
             self.gpu_scratch_space = None
 
+        node_params = self._subdomain.node_params
+        if node_params is not None:
+            self.config.logger.debug("Using a buffer for {0} node "
+                                     "parameters".format(len(node_params)))
+            self.gpu_node_params = self.backend.alloc_buf(
+                    like=np.array(node_params, dtype=self.float))
+            self.gpu_node_param_map = self.backend.alloc_buf(
+                    like=self._subdomain.node_param_map(
+                        self._host_indirect_address))
+        else:
+            self.gpu_node_params = None
+            self.gpu_node_param_map = None
+
     def gpu_field(self, field):
         """Returns the GPU copy of a field."""
         return self._gpu_field_map[id(field)]
@@ -1072,71 +1311,109 @@ class SubdomainRunner(object):
             buf = 'coll_buf'
 
         for b_id, connector in self._spec._connectors.items():
+            # The host buffers are sent without copying, so make sure the
+            # previous messages are gone before overwriting them.  With the
+            # communication thread, this is done before the exchange completes.
+            if self._comm_thread is None:
+                connector.wait_sent()
             conn_bufs = self._block_to_connbuf[b_id]
             for x in conn_bufs:
                 self.backend.from_buf_async(getattr(x, buf).gpu, self._data_stream)
 
+        if self._comm_thread is not None:
+            if self.config.access_pattern == 'AA' and self._sim.iteration & 1:
+                get_buf = operator.attrgetter('local_recv_buf.host')
+            else:
+                get_buf = operator.attrgetter('recv_buf')
+            self._pending_exchange = self._comm_thread.exchange(
+                self.backend.make_event(self._data_stream),
+                [(connector, [getattr(x, buf).host for x in
+                              self._block_to_connbuf[b_id]])
+                 for b_id, connector in self._spec._connectors.items()],
+                [(connector, [get_buf(x) for x in
+                              self._recv_block_to_connbuf[b_id]])
+                 for b_id, connector in self._spec._connectors.items()],
+                self._quit_event, zero_copy=True)
+            return
+
         self.backend.sync_stream(self._data_stream)
 
         for b_id, connector in self._spec._connectors.items():
             conn_bufs = self._block_to_connbuf[b_id]
-
-            if len(conn_bufs) > 1:
-                connector.send(np.hstack(
-                    [np.ravel(getattr(x, buf).host) for x in conn_bufs]))
-            else:
-                # TODO(michalj): Use non-blocking sends here?
-                connector.send(np.ravel(getattr(conn_bufs[0], buf).host).copy())
+            connector.send_parts([getattr(x, buf).host for x in conn_bufs])
 
     @profile(TimeProfile.RECV_DISTS)
     def _recv_dists(self):
+        # _recv_dists is called after the iteration counter has been updated.
+        unpropagated = (self.config.access_pattern == 'AA' and
+                        self._sim.iteration & 1)
+        if unpropagated:
+            get_buf = operator.attrgetter('local_recv_buf.host')
+        else:
+            get_buf = operator.attrgetter('recv_buf')
+
         def distribute(cbuf):
-            # _recv_dists is called after the iteration counter has been updated.
-            if self.config.access_pattern == 'AA' and self._sim.iteration & 1:
+            if unpropagated:
                 cbuf.distribute_unpropagated(self.backend, self._data_stream)
             else:
                 cbuf.distribute(self.backend, self._data_stream)
 
-        if self.config.access_pattern == 'AA' and self._sim.iteration & 1:
-            get_buf = operator.attrgetter('local_recv_buf.host')
-        else:
-            get_buf = operator.attrgetter('recv_buf')
+        def distribute_view(connector, conn_bufs, src):
+            # Distribute the data directly from the connector's buffer.
+            # The buffer is handed back to the sender once its contents
+            # have been copied to the staging buffers.
+            i = 0
+            for cbuf in conn_bufs:
+                recv_buf = get_buf(cbuf)
+                l = recv_buf.size
+                view = src[i:i+l].reshape(recv_buf.shape)
+                i += l
+                if unpropagated:
+                    recv_buf[:] = view
+                    cbuf.distribute_unpropagated(self.backend, self._data_stream)
+                else:
+                    cbuf.distribute(self.backend, self._data_stream, view)
+            connector.release()
+
+        if self._pending_exchange is not None:
+            exchange = self._pending_exchange
+            self._pending_exchange = None
+            self._profile.record_cpu_start(TimeProfile.NET_RECV)
+            # Returns false only if quit event is active.
+            if not exchange.wait():
+                return
+
+            self._profile.record_cpu_end(TimeProfile.NET_RECV)
+            for b_id, connector in self._spec._connectors.items():
+                conn_bufs = self._recv_block_to_connbuf[b_id]
+                if connector in exchange.views:
+                    distribute_view(connector, conn_bufs,
+                                    exchange.views[connector])
+                else:
+                    for cbuf in conn_bufs:
+                        distribute(cbuf)
+            return
 
         for b_id, connector in self._spec._connectors.items():
             conn_bufs = self._recv_block_to_connbuf[b_id]
-            if len(conn_bufs) > 1:
-                dest = np.hstack([np.ravel(get_buf(x)) for x in conn_bufs])
+            if connector.zero_copy:
                 self._profile.record_cpu_start(TimeProfile.NET_RECV)
-                # Returns false only if quit event is active.
-                if not connector.recv(dest, self._quit_event):
+                src = connector.recv_view(self._quit_event)
+                if src is None:
                     return
 
                 self._profile.record_cpu_end(TimeProfile.NET_RECV)
-                i = 0
-                for cbuf in conn_bufs:
-                    recv_buf = get_buf(cbuf)
-                    l = recv_buf.size
-                    recv_buf[:] = dest[i:i+l].reshape(recv_buf.shape)
-                    i += l
-                    distribute(cbuf)
+                distribute_view(connector, conn_bufs, src)
             else:
-                cbuf = conn_bufs[0]
-                recv_buf = get_buf(cbuf)
-                dest = np.ravel(recv_buf)
-
-                # Returns false only if quit event is active.
                 self._profile.record_cpu_start(TimeProfile.NET_RECV)
-                if not connector.recv(dest, self._quit_event):
+                # Returns false only if quit event is active.
+                if not connector.recv_parts([get_buf(x) for x in conn_bufs],
+                                            self._quit_event):
                     return
 
                 self._profile.record_cpu_end(TimeProfile.NET_RECV)
-                # If ravel returned a copy, we need to write the data
-                # back to the proper buffer.
-                # TODO(michalj): Check if there is any way of avoiding this
-                # copy.
-                if dest.flags.owndata:
-                    recv_buf[:] = dest.reshape(recv_buf.shape)
-                distribute(cbuf)
+                for cbuf in conn_bufs:
+                    distribute(cbuf)
 
     def _fields_to_host(self, sync=False):
         """Copies data for all fields from the GPU to the host."""
@@ -1562,6 +1839,10 @@ class SubdomainRunner(object):
             self._pbc_kernels = self._sim.get_pbc_kernels(self)
         self._aux_kernels = self._sim.get_aux_kernels(self)
 
+        if self.config.comm_thread and self._spec._connectors:
+            self._comm_thread = CommThread(self.backend)
+            self._comm_thread.start()
+
         # No need to run the potentially costly initilization if we are
         # restarting from a checkpoint.
         if restore_filename is None:
@@ -1593,10 +1874,30 @@ class SubdomainRunner(object):
 
         self.config.logger.info("Starting simulation.")
         self.main()
+        if self._comm_thread is not None:
+            self._comm_thread.stop()
+        self._log_connector_stats()
+        for connector in self._spec._connectors.values():
+            connector.close()
         self.config.logger.info(
             "Simulation completed after {0} iterations.".format(
                 self._sim.iteration))
 
+    def _log_connector_stats(self):
+        for nbid, connector in sorted(self._spec._connectors.items()):
+            stats = connector.stats()
+            if not stats or not stats['raw_bytes']:
+                continue
+            self.config.logger.info(
+                "Data sent to subdomain {0}: {1:.2f} MiB ({2:.1f}% of raw size), "
+                "encoding time: {3:.2f} s, decoding time: {4:.2f} s, "
+                "messages per encoding: {5}".format(
+                    nbid, stats['sent_bytes'] / 1024.0 / 1024.0,
+                    100.0 * stats['sent_bytes'] / stats['raw_bytes'],
+                    stats['encode_time'], stats['decode_time'],
+                    ', '.join('{0}: {1}'.format(k, v) for k, v in
+                              sorted(stats['messages'].items()))))
+
     def need_quit(self):
         if self.config.max_iters > 0:
             it = self._sim.iteration
@@ -1870,48 +2171,68 @@ class NNSubdomainRunner(SubdomainRunner):
         super(NNSubdomainRunner, self).__init__(*args, **kwargs)
         self._pbc_kernels = MacroKernels(macro=[], distributions=[])
 
+    def halo_traffic(self):
+        ret = super(NNSubdomainRunner, self).halo_traffic()
+        num_nn_fields = self._sim.count_nn_fields()
+        float_bytes = self.float().nbytes
+        for face, block_id in self._spec.connecting_subdomains():
+            for cpair in self._spec.get_connections(face, block_id):
+                sent, received = ret[block_id]
+                ret[block_id] = (
+                    sent + num_nn_fields * float_bytes *
+                    reduce(operator.mul, cpair.src.macro_transfer_shape),
+                    received + num_nn_fields * float_bytes *
+                    reduce(operator.mul, cpair.dst.macro_transfer_shape))
+        return ret
+
     @profile(TimeProfile.RECV_MACRO)
     def _recv_macro(self):
+        if self._pending_exchange is not None:
+            exchange = self._pending_exchange
+            self._pending_exchange = None
+            # Returns false only if quit event is active.
+            if not exchange.wait():
+                return
+            for b_id in self._spec._connectors:
+                for cbuf in self._recv_block_to_macrobuf[b_id]:
+                    self.backend.to_buf_async(cbuf.recv_buf.gpu, self._data_stream)
+            return
+
         for b_id, connector in self._spec._connectors.items():
             conn_bufs = self._recv_block_to_macrobuf[b_id]
-            if len(conn_bufs) > 1:
-                dest = np.hstack([np.ravel(x.recv_buf.host) for x in conn_bufs])
-                # Returns false only if quit event is active.
-                if not connector.recv(dest, self._quit_event):
-                    return
-                i = 0
-                for cbuf in conn_bufs:
-                    l = cbuf.recv_buf.host.size
-                    cbuf.recv_buf.host[:] = dest[i:i+l].reshape(cbuf.recv_buf.host.shape)
-                    i += l
-                    self.backend.to_buf_async(cbuf.recv_buf.gpu, self._data_stream)
-            else:
-                cbuf = conn_bufs[0]
-                dest = np.ravel(cbuf.recv_buf.host)
-                # Returns false only if quit event is active.
-                if not connector.recv(dest, self._quit_event):
-                    return
-                if dest.flags.owndata:
-                    cbuf.recv_buf.host[:] = dest.reshape(cbuf.recv_buf.host.shape)
+            # Returns false only if quit event is active.
+            if not connector.recv_parts([x.recv_buf.host for x in conn_bufs],
+                                        self._quit_event):
+                return
+            for cbuf in conn_bufs:
                 self.backend.to_buf_async(cbuf.recv_buf.gpu, self._data_stream)
 
     @profile(TimeProfile.SEND_MACRO)
     def _send_macro(self):
         for b_id, connector in self._spec._connectors.items():
+            if self._comm_thread is None:
+                connector.wait_sent()
             conn_bufs = self._block_to_macrobuf[b_id]
             for x in conn_bufs:
                 self.backend.from_buf_async(x.coll_buf.gpu, self._data_stream)
 
+        if self._comm_thread is not None:
+            self._pending_exchange = self._comm_thread.exchange(
+                self.backend.make_event(self._data_stream),
+                [(connector, [x.coll_buf.host for x in
+                              self._block_to_macrobuf[b_id]])
+                 for b_id, connector in self._spec._connectors.items()],
+                [(connector, [x.recv_buf.host for x in
+                              self._recv_block_to_macrobuf[b_id]])
+                 for b_id, connector in self._spec._connectors.items()],
+                self._quit_event)
+            return
+
         self.backend.sync_stream(self._data_stream)
 
         for b_id, connector in self._spec._connectors.items():
             conn_bufs = self._block_to_macrobuf[b_id]
-            if len(conn_bufs) > 1:
-                connector.send(np.hstack(
-                    [np.ravel(x.coll_buf.host) for x in conn_bufs]))
-            else:
-                # TODO(michalj): Use non-blocking sends here?
-                connector.send(np.ravel(conn_bufs[0].coll_buf.host).copy())
+            connector.send_parts([x.coll_buf.host for x in conn_bufs])
 
     def _macro_idx_helper(self, gx, buf_slice):
         idx = np.mgrid[list(reversed(buf_slice))].astype(np.uint32)
@@ -358,7 +358,7 @@ ${device_func}  void get0thMoment(Dist *fi, int node_type, int orientation, floa
 
 // Common code for the equilibrium and Zou-He density boundary conditions.
 <%def name="_macro_density_bc_common()">
-  int node_param_idx = decodeNodeParamIdx(ncode);
+  int node_param_idx = decodeNodeParamIdx(ncode ${node_param_slot_arg_if_required()});
   ${_fill_missing_distributions_with_opposite()}
   *rho = ${sym.ex_rho(grid, 'fi', incompressible, minimize_roundoff=config.minimize_roundoff)};
   float par_rho = node_param_get_scalar(node_param_idx ${dynamic_val_args()});
@@ -376,7 +376,7 @@ ${device_func}  void get0thMoment(Dist *fi, int node_type, int orientation, floa
 </%def>
 
 <%def name="_macro_velocity_bc_common()">
-  int node_param_idx = decodeNodeParamIdx(ncode);
+  int node_param_idx = decodeNodeParamIdx(ncode ${node_param_slot_arg_if_required()});
   // We're dealing with a boundary node, for which some of the distributions
   // might be meaningless.  Fill them with the values of the opposite
   // distributions.
@@ -9,6 +9,7 @@ ${kernel} void ComputeStressTensor(
 %for i in range(dim * (dim - 1)):
   , ${global_ptr} float *stress${i}
 %endfor
+  ${node_params_if_required()}
   ${iteration_number_if_required()}
 ) {
   ${local_indices()}
@@ -156,9 +156,18 @@ ${device_func}  unsigned int decodeNodeScratchId(unsigned int nodetype) {
   return (nodetype >> ${nt_misc_shift + nt_param_shift}) & ${(1 << nt_scratch_shift)-1};
 }
 
+%if node_params_buffer:
+// The offsets of the node parameters are stored in a per-node buffer instead
+// of the node code.  node_param_slot points to the entry of the current node.
+${device_func}  unsigned int decodeNodeParamIdx(unsigned int nodetype,
+    ${global_ptr} ${const_ptr} unsigned int *node_param_slot) {
+  return *node_param_slot;
+}
+%else:
 ${device_func}  unsigned int decodeNodeParamIdx(unsigned int nodetype) {
   return (nodetype >> ${nt_misc_shift}) & ${(1 << nt_param_shift)-1};
 }
+%endif
 
 %if dim == 2:
   ${device_func}  unsigned int getGlobalIdx(int gx, int gy) {
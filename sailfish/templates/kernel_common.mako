@@ -62,6 +62,13 @@
   %endif
 </%def>
 
+<%def name="node_params_if_required()" filter="trim">
+  %if node_params_buffer:
+    , ${global_ptr} ${const_ptr} float *__restrict__ node_params,
+    ${global_ptr} ${const_ptr} unsigned int *__restrict__ node_param_map
+  %endif
+</%def>
+
 <%def name="scalar_field_if_required(name, required)" filter="trim">
   %if required:
     , ${global_ptr} float *__restrict__ ${name}
@@ -520,7 +527,10 @@
   ${const_var} float ${name} = ${val}f;
 %endfor
 
-%if node_params:
+%if node_params_buffer:
+  // Additional geometry parameters (velocities, pressures, etc) are passed
+  // to the kernels in a global memory buffer.
+%elif node_params:
   // Additional geometry parameters (velocities, pressures, etc)
   ${const_var} float node_params[${len(node_params)}] = {
   %for param in node_params:
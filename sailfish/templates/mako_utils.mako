@@ -197,8 +197,13 @@ ${sym_codegen.cexpr(sim, incompressible, pointers, ex, rho=rho, vectors=vectors,
 </%def>
 
 ## Provides declarations of the arguments required for functions using
-## dynamically evaluated node parameters.
+## dynamically evaluated node parameters or node parameters stored in
+## a global memory buffer.
 <%def name="dynamic_val_args_decl()">
+  %if node_params_buffer:
+    , ${global_ptr} ${const_ptr} float *__restrict__ node_params,
+    ${global_ptr} ${const_ptr} unsigned int *__restrict__ node_param_slot
+  %endif
   %if time_dependence:
     , unsigned int iteration_number
   %endif
@@ -215,6 +220,9 @@ ${sym_codegen.cexpr(sim, incompressible, pointers, ex, rho=rho, vectors=vectors,
 ## Provides values of the arguments required for functions using dynamically
 ## evaluated node parameters.
 <%def name="dynamic_val_args()">
+  %if node_params_buffer:
+    , node_params, node_param_slot
+  %endif
   %if time_dependence:
     , iteration_number
   %endif
@@ -230,6 +238,9 @@ ${sym_codegen.cexpr(sim, incompressible, pointers, ex, rho=rho, vectors=vectors,
 ## evaluated node paramters. Takes care of calculating the node's logical
 ## global position.
 <%def name="dynamic_val_call_args()">
+  %if node_params_buffer:
+    , node_params, node_param_map + gi
+  %endif
   %if time_dependence:
     , iteration_number
   %endif
@@ -242,6 +253,14 @@ ${sym_codegen.cexpr(sim, incompressible, pointers, ex, rho=rho, vectors=vectors,
   %endif
 </%def>
 
+## Use to render the argument to decodeNodeParamIdx() pointing to the
+## entry of the current node in the node parameter offset buffer.
+<%def name="node_param_slot_arg_if_required()" filter="trim">
+  %if node_params_buffer:
+    , node_param_slot
+  %endif
+</%def>
+
 <%def name="ifdim3(val)" filter='trim'>
   %if dim == 3:
     val
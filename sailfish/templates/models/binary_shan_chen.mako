@@ -98,6 +98,7 @@ ${kernel} void ShanChenCollideAndPropagate${grid_idx}(
   ${kernel_args_1st_moment('ov', const=True)}
   int options
   ${scratch_space_if_required()}
+  ${node_params_if_required()}
   ${iteration_number_if_required()})
 {
   ${cond(barrier_needs_all_threads, 'bool alive = true;')}
@@ -264,6 +264,7 @@ ${kernel} void FreeEnergyCollideAndPropagateFluid(
   ${global_ptr} float *__restrict__ gg1laplacian,
   int options
   ${scratch_space_if_required()}
+  ${node_params_if_required()}
   ${iteration_number_if_required()})
 {
   ${local_indices_split()}
@@ -330,6 +331,7 @@ ${kernel} void FreeEnergyCollideAndPropagateOrderParam(
   ${global_ptr} ${const_ptr} float *__restrict__ gg1laplacian,
   int options
   ${scratch_space_if_required()}
+  ${node_params_if_required()}
   ${iteration_number_if_required()})
 {
   ${local_indices_split()}
@@ -167,6 +167,7 @@ ${kernel} void CollideAndPropagate(
   ${kernel_args_1st_moment('ov')}
   int options
   ${scratch_space_if_required()}
+  ${node_params_if_required()}
   ${scalar_field_if_required('alpha', alpha_output)}
   ${iteration_number_if_required()}
   ${force_field_if_required()}
@@ -159,7 +159,7 @@ ${device_func}  void BGK_relaxate${grid_idx}(${bgk_args_decl(grid_idx)},
   // FIXME: This should be moved to postcollision boundary conditions.
   %if nt.NTGuoDensity in node_types:
     if (isNTGuoDensity(node_type)) {
-      int node_param_idx = decodeNodeParamIdx(ncode);
+      int node_param_idx = decodeNodeParamIdx(ncode ${node_param_slot_arg_if_required()});
       float par_rho = node_params[node_param_idx];
       float par_phi = 1.0f;
       tau0 = tau_a;
@@ -6,6 +6,7 @@ __email__ = 'sailfish-cfd@googlegroups.com'
 __license__ = 'LGPL3'
 
 from collections import defaultdict, namedtuple
+from contextlib import contextmanager
 import gzip
 import logging
 import random
@@ -15,6 +16,11 @@ import sys
 import numpy as np
 from math import exp, log, ceil
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from sailfish import config
 from sailfish import sym
 
@@ -49,7 +55,7 @@ def span_to_direction(span):
     return 0
 
 
-def get_backends(backends=['cuda', 'opencl']):
+def get_backends(backends=['cuda', 'opencl', 'numpy']):
     for backend in backends:
         try:
             module = 'sailfish.backend_{0}'.format(backend)
@@ -217,6 +223,11 @@ def setup_logger(config):
     elif config.silent:
         logger.setLevel(logging.ERROR)
 
+    # Drop handlers installed by previous simulations run in the same
+    # process so that messages are not duplicated.
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
     if config.log:
         handler = logging.FileHandler(config.log)
         handler.setFormatter(formatter)
@@ -323,3 +334,257 @@ def load_array(fname):
         return np.load(gzip.GzipFile(fname))
     else:
         return np.load(fname)
+
+
+def open_array(fname):
+    """Opens an array stored in a file without reading all of it into
+    memory.
+
+    Uncompressed .npy files are memory-mapped and chunked containers (see
+    save_chunked_array) are returned as ChunkedArray objects.  In both
+    cases, only the parts of the array that are actually accessed are read
+    from the file.  Other files (including .npz files which are not chunked
+    containers) are loaded with load_array.
+    """
+    if fname.endswith('.npy'):
+        return np.load(fname, mmap_mode='r')
+    elif fname.endswith('.npz'):
+        npz = np.load(fname)
+        if CHUNKED_ARRAY_MARKER in npz.files:
+            return ChunkedArray(npz)
+        return npz
+    else:
+        return load_array(fname)
+
+
+#: Approximate number of array elements stored in a single chunk by
+#: save_chunked_array.
+CHUNKED_ARRAY_ELEMENTS = 1 << 22
+
+#: Name of the entry identifying an .npz file as a chunked container.
+CHUNKED_ARRAY_MARKER = 'sailfish_chunked_array'
+
+
+def save_chunked_array(fname, array, chunk_elements=CHUNKED_ARRAY_ELEMENTS):
+    """Saves an array as a chunked container: a compressed .npz file in
+    which consecutive chunks of the array along its first axis are stored
+    separately, so that parts of the array can be read without decompressing
+    all of it (see ChunkedArray).
+
+    :param fname: name of the file to save the array to
+    :param array: array to save (anything supporting slicing along the first
+        axis, e.g. a memory-mapped array)
+    :param chunk_elements: approximate number of elements in a chunk
+    """
+    chunks = chunk_slices(array.shape, chunk_elements)
+    data = dict(('chunk_{0}'.format(i), np.asarray(array[chunk]))
+                for i, chunk in enumerate(chunks))
+    data[CHUNKED_ARRAY_MARKER] = np.array(1)
+    np.savez_compressed(fname, shape=np.array(array.shape, dtype=np.int64),
+                        chunk_rows=chunks[0].stop - chunks[0].start,
+                        dtype=np.array(np.dtype(array.dtype).str), **data)
+
+
+class ChunkedArray(object):
+    """Read-only array stored in a chunked container (see
+    save_chunked_array).
+
+    Supports indexing with integers and slices (in the first axis; any
+    numpy index in the remaining ones).  Only the chunks covering the
+    selected part of the first axis are decompressed."""
+
+    def __init__(self, fname):
+        """
+        :param fname: name of the file to read, or an already opened .npz
+            file
+        """
+        if not hasattr(fname, 'files'):
+            fname = np.load(fname)
+        self._npz = fname
+        if CHUNKED_ARRAY_MARKER not in self._npz.files:
+            self._npz.close()
+            raise ValueError('Not a chunked array container.')
+        self.shape = tuple(int(x) for x in self._npz['shape'])
+        self.dtype = np.dtype(str(self._npz['dtype']))
+        self._chunk_rows = int(self._npz['chunk_rows'])
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _chunk(self, i):
+        return self._npz['chunk_{0}'.format(i)]
+
+    def __getitem__(self, key):
+        if type(key) is not tuple:
+            key = (key,)
+        first, rest = key[0], key[1:]
+
+        if isinstance(first, slice):
+            rows = np.arange(*first.indices(self.shape[0]))
+        else:
+            row = int(first)
+            if row < 0:
+                row += self.shape[0]
+            if not 0 <= row < self.shape[0]:
+                raise IndexError('index {0} is out of bounds for axis 0 with '
+                                 'size {1}'.format(first, self.shape[0]))
+            chunk = self._chunk(row // self._chunk_rows)
+            return chunk[(row % self._chunk_rows,) + rest]
+
+        rest = (slice(None),) + rest
+        if rows.size == 0:
+            return np.empty((0,) + self.shape[1:], dtype=self.dtype)[rest]
+
+        # Split the rows into groups belonging to the same chunk.
+        chunk_ids = rows // self._chunk_rows
+        splits = np.flatnonzero(np.diff(chunk_ids)) + 1
+        parts = []
+        for group in np.split(rows, splits):
+            chunk_id = group[0] // self._chunk_rows
+            chunk = self._chunk(chunk_id)
+            parts.append(chunk[group - chunk_id * self._chunk_rows][rest])
+        return np.concatenate(parts)
+
+    def __array__(self, dtype=None):
+        ret = self[:]
+        if dtype is not None:
+            ret = ret.astype(dtype)
+        return ret
+
+
+@contextmanager
+def file_lock(path):
+    """Holds an exclusive lock on the file at path (created if necessary)
+    for the duration of the context.  Used to serialize access to shared
+    on-disk state between processes.  No locking is done on platforms
+    without fcntl."""
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class PeriodicShift(object):
+    """Provides views of an array shifted along lattice vectors.
+
+    shifted(vec) is equivalent to applying np.roll(arr, -shift, axis) for
+    every nonzero component of vec, but all views are taken from a single
+    periodically padded copy of the array, so no data is copied per vector.
+    """
+
+    def __init__(self, arr, max_shift=1, rows=None, func=None):
+        """
+        :param arr: array to shift
+        :param max_shift: maximum absolute value of the vector components
+        :param rows: optional slice along the first axis of arr; if
+            specified, only these rows (and a periodic halo of max_shift
+            rows around them) are copied, and all shifted views refer to
+            this part of the array
+        :param func: optional function to apply to the copied parts of arr
+            (e.g. to build a boolean mask), so that it never has to be
+            applied to the whole array
+        """
+        if func is None:
+            func = lambda x: x
+        self._pad = max_shift
+        if rows is None:
+            self.shape = arr.shape
+            self._padded = np.pad(func(arr), max_shift, mode='wrap')
+            return
+
+        n = arr.shape[0]
+        start, stop, _ = rows.indices(n)
+        halo_low = np.arange(start - max_shift, start) % n
+        halo_high = np.arange(stop, stop + max_shift) % n
+        part = np.concatenate([func(arr[halo_low]), func(arr[start:stop]),
+                               func(arr[halo_high])])
+        self.shape = part[max_shift:max_shift + stop - start].shape
+        self._padded = np.pad(part, [(0, 0)] + [(max_shift, max_shift)] *
+                              (arr.ndim - 1), mode='wrap')
+
+    def shifted(self, vec, chunk=slice(None)):
+        """Returns a view of the array shifted by vec.
+
+        :param vec: shift vector, in natural (x, y, [z]) order
+        :param chunk: slice along the first (slowest-changing) axis of the
+            array, selecting the part of the shifted array to return
+        """
+        dim = len(self.shape)
+        start, stop, _ = chunk.indices(self.shape[0])
+        idx = []
+        for axis, size in enumerate(self.shape):
+            offset = self._pad + int(vec[dim - 1 - axis])
+            if axis == 0:
+                idx.append(slice(offset + start, offset + stop))
+            else:
+                idx.append(slice(offset, offset + size))
+        return self._padded[tuple(idx)]
+
+
+#: Approximate number of array elements processed at a time by map_chunks.
+CHUNK_ELEMENTS = 1 << 18
+
+
+def chunk_slices(shape, chunk_elements=None):
+    """Returns a list of slices dividing an array into consecutive chunks
+    along its first axis.
+
+    :param shape: shape of the array
+    :param chunk_elements: approximate number of elements in a chunk,
+        CHUNK_ELEMENTS if not specified
+    """
+    if chunk_elements is None:
+        chunk_elements = CHUNK_ELEMENTS
+    row_size = 1
+    for size in shape[1:]:
+        row_size *= size
+    rows = max(1, chunk_elements // max(row_size, 1))
+    return [slice(i, min(i + rows, shape[0]))
+            for i in range(0, shape[0], rows)]
+
+
+def map_chunks(func, shape, num_threads=1, chunk_elements=None):
+    """Calls func for consecutive chunks of an array along its first axis.
+
+    The chunks are small enough for the temporary arrays used while
+    processing them to fit in the CPU cache.
+
+    :param func: callable taking a slice along the first axis of the array
+    :param shape: shape of the array
+    :param num_threads: number of threads to process the chunks with
+    :param chunk_elements: approximate number of elements in a chunk,
+        CHUNK_ELEMENTS if not specified
+
+    :rvalue: list of values returned by func, in chunk order
+    """
+    chunks = chunk_slices(shape, chunk_elements)
+
+    if num_threads <= 1 or len(chunks) <= 1:
+        return [func(chunk) for chunk in chunks]
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(num_threads, len(chunks)))
+    try:
+        return pool.map(func, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def unique(arr, num_threads=1):
+    """Returns the sorted unique elements of an array.
+
+    Equivalent to np.unique(arr), but the array is processed in chunks,
+    so that no copy of the whole array is made."""
+    chunks = map_chunks(lambda chunk: np.unique(arr[chunk]), arr.shape,
+                        num_threads)
+    return np.unique(np.concatenate(chunks))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sailfish import autotune
+from sailfish.autotune import TuningDB
+from sailfish.config import LBConfig
+
+from dummy import DummyLogger
+
+
+class DummyBackend(object):
+    info = 'Dummy device'
+
+
+def make_config(db_path):
+    config = LBConfig()
+    config.backends = 'numpy'
+    config.grid = 'D2Q9'
+    config.model = 'bgk'
+    config.precision = 'double'
+    config.access_pattern = 'AB'
+    config.block_size = 64
+    config.mem_alignment = 32
+    config.autotune_iters = 10
+    config.tuning_db = db_path
+    config.quiet = True
+    config.logger = DummyLogger()
+    config._explicit_options = set()
+    return config
+
+
+class TestAutotune(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.directory, 'sub', 'tuning.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_db(self):
+        config = make_config(self.db_path)
+        db = TuningDB(self.db_path)
+        key = TuningDB.key('dev', config)
+        self.assertIsNone(db.get(key))
+        db.put(key, {'block_size': 128, 'mem_alignment': 16})
+        db.put(TuningDB.key('dev2', config), {'block_size': 32,
+                                              'mem_alignment': 8})
+        self.assertEqual(TuningDB(self.db_path).get(key),
+                         {'block_size': 128, 'mem_alignment': 16})
+
+        config.precision = 'single'
+        self.assertIsNone(db.get(TuningDB.key('dev', config)))
+
+    def test_apply(self):
+        config = make_config(self.db_path)
+        autotune.apply_tuned_params(config, DummyBackend())
+        self.assertEqual(config.block_size, 64)
+
+        TuningDB(self.db_path).put(TuningDB.key(DummyBackend.info, config),
+                                   {'block_size': 128, 'mem_alignment': 16})
+        autotune.apply_tuned_params(config, DummyBackend())
+        self.assertEqual(config.block_size, 128)
+        self.assertEqual(config.mem_alignment, 16)
+
+        # Empty path disables the database.
+        config = make_config('')
+        autotune.apply_tuned_params(config, DummyBackend())
+        self.assertEqual(config.block_size, 64)
+
+    def test_apply_explicit(self):
+        TuningDB(self.db_path).put(
+            TuningDB.key(DummyBackend.info, make_config(self.db_path)),
+            {'block_size': 128, 'mem_alignment': 16})
+
+        # Explicitly set values are never overridden.
+        config = make_config(self.db_path)
+        config._explicit_options = set(['block_size'])
+        autotune.apply_tuned_params(config, DummyBackend())
+        self.assertEqual(config.block_size, 64)
+        self.assertEqual(config.mem_alignment, 16)
+
+        # Configs not created from the command line are fully specified.
+        config = make_config(self.db_path)
+        del config._explicit_options
+        autotune.apply_tuned_params(config, DummyBackend())
+        self.assertEqual(config.block_size, 64)
+        self.assertEqual(config.mem_alignment, 32)
+
+    def test_autotune(self):
+        tried = []
+
+        def benchmark(sim_class, config, size, block_size, mem_alignment,
+                      iters):
+            tried.append((block_size, mem_alignment))
+            if block_size == 128:
+                raise RuntimeError('too many resources requested')
+            # Peak performance at block size 64 and alignment 16.
+            return 'Fake device', 100.0 - abs(block_size - 64) - mem_alignment
+
+        config = make_config(self.db_path)
+        orig_benchmark = autotune._benchmark
+        autotune._benchmark = benchmark
+        try:
+            best = autotune.autotune(config, 2, block_sizes=[32, 64, 128],
+                                     mem_alignments=[64, 16], size=(16, 16))
+        finally:
+            autotune._benchmark = orig_benchmark
+
+        # Alignment larger than the block size is not a valid candidate.
+        self.assertEqual(tried, [(32, 16), (64, 64), (64, 16), (128, 64),
+                                 (128, 16)])
+        self.assertEqual(best, {'block_size': 64, 'mem_alignment': 16,
+                                'mlups': 84.0})
+        self.assertEqual(config.block_size, 64)
+        self.assertEqual(config.mem_alignment, 16)
+
+        entries = TuningDB(self.db_path)._load()
+        self.assertEqual(entries, {TuningDB.key('Fake device', config): best})
+
+    def test_benchmark(self):
+        config = make_config(self.db_path)
+        device, mlups = autotune._benchmark(autotune._make_sim_class(2),
+                                            config, (16, 16), 32, 16, 10)
+        self.assertTrue(device.startswith('NumPy'))
+        self.assertGreater(mlups, 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Verifies the numpy backend against analytical results."""
+
+import unittest
+import numpy as np
+
+from sailfish.controller import LBSimulationController
+from sailfish.lb_single import LBFluidSim
+from sailfish.node_type import NTFullBBWall
+from sailfish.subdomain import Subdomain2D, Subdomain3D
+
+NX = 16
+NY = 32
+AMPLITUDE = 0.01
+VISC = 0.1
+ITERS = 200
+
+
+class ShearWaveSubdomain2D(Subdomain2D):
+    def boundary_conditions(self, hx, hy):
+        pass
+
+    def initial_conditions(self, sim, hx, hy):
+        sim.rho[:] = 1.0
+        sim.vx[:] = AMPLITUDE * np.sin(2.0 * np.pi * hy / self.gy)
+
+
+class ShearWaveSubdomain3D(Subdomain3D):
+    def boundary_conditions(self, hx, hy, hz):
+        pass
+
+    def initial_conditions(self, sim, hx, hy, hz):
+        sim.rho[:] = 1.0
+        sim.vx[:] = AMPLITUDE * np.sin(2.0 * np.pi * hz / self.gz)
+
+
+class ChannelSubdomain(Subdomain2D):
+    def boundary_conditions(self, hx, hy):
+        self.set_node((hy == 0) | (hy == self.gy - 1), NTFullBBWall)
+
+    def initial_conditions(self, sim, hx, hy):
+        sim.rho[:] = 1.0 + 0.01 * np.sin(2.0 * np.pi * hx / self.gx)
+        sim.vx[:] = 0.02
+
+
+class ShearWaveSim2D(LBFluidSim):
+    subdomain = ShearWaveSubdomain2D
+
+
+class ShearWaveSim3D(LBFluidSim):
+    subdomain = ShearWaveSubdomain3D
+
+
+class ChannelSim(LBFluidSim):
+    subdomain = ChannelSubdomain
+
+
+def run_sim(sim_class, **config):
+    settings = {
+        'debug_single_process': True,
+        'quiet': True,
+        'backends': 'numpy',
+        'precision': 'double',
+        'visc': VISC,
+        'max_iters': ITERS,
+        'lat_nx': NX,
+        'lat_ny': NY,
+    }
+    settings.update(config)
+    ctrl = LBSimulationController(sim_class, default_config=settings)
+    ctrl.run(ignore_cmdline=True)
+    return ctrl.master.sim
+
+
+class TestShearWave(unittest.TestCase):
+    def _check_decay(self, vx, length):
+        k = 2.0 * np.pi / length
+        expected = np.exp(-VISC * k**2 * ITERS)
+        self.assertAlmostEqual(np.max(vx) / AMPLITUDE, expected, delta=3e-3)
+
+    def test_2d(self):
+        for config in (dict(access_pattern='AB'), dict(access_pattern='AA'),
+                       dict(model='mrt')):
+            sim = run_sim(ShearWaveSim2D, periodic_x=True, periodic_y=True,
+                          **config)
+            self._check_decay(sim.vx[:, 0], NY)
+
+    def test_3d(self):
+        for config in (dict(grid='D3Q19'),
+                       dict(grid='D3Q15', access_pattern='AA'),
+                       dict(grid='D3Q19', model='mrt')):
+            sim = run_sim(ShearWaveSim3D, lat_nx=4, lat_ny=4, lat_nz=NY,
+                          periodic_x=True, periodic_y=True, periodic_z=True,
+                          **config)
+            self._check_decay(sim.vx[:, 0, 0], NY)
+
+
+class TestAccessPattern(unittest.TestCase):
+    def test_ab_aa_equivalence(self):
+        for model in ('bgk', 'mrt'):
+            sim_ab = run_sim(ChannelSim, periodic_x=True, model=model,
+                             access_pattern='AB')
+            sim_aa = run_sim(ChannelSim, periodic_x=True, model=model,
+                             access_pattern='AA')
+            np.testing.assert_allclose(sim_ab.rho, sim_aa.rho)
+            np.testing.assert_allclose(sim_ab.vx, sim_aa.vx)
+            np.testing.assert_allclose(sim_ab.vy, sim_aa.vy, atol=1e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()
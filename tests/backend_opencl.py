@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""Verifies ordering of commands in the OpenCL backend.  Uses any available
+OpenCL device, including CPUs."""
+
+import unittest
+import numpy as np
+
+from sailfish.config import LBConfig
+from dummy import DummyLogger
+
+try:
+    import pyopencl as cl
+    from sailfish.backend_opencl import OpenCLBackend
+    _devices = [d for p in cl.get_platforms() for d in p.get_devices()]
+except Exception:
+    _devices = []
+
+SOURCE = """
+__kernel void Increment(__global float *a, int n)
+{
+    int i = get_global_id(0);
+    if (i < n) {
+        for (int j = 0; j < 1000; j++) {
+            a[i] += 1.0f;
+        }
+    }
+}
+
+__kernel void Copy(__global float *a, __global float *b, int n)
+{
+    int i = get_global_id(0);
+    if (i < n) {
+        b[i] = a[i];
+    }
+}
+"""
+
+N = 1024
+BLOCK = 64
+
+
+@unittest.skipIf(not _devices, 'no OpenCL devices available')
+class TestOpenCLStreams(unittest.TestCase):
+    def setUp(self):
+        config = LBConfig()
+        config.opencl_interactive = False
+        config.opencl_device_type = 'all'
+        config.opencl_cpu_launch_tuning = False
+        config.precision = 'single'
+        config.mode = 'benchmark'
+        config.logger = DummyLogger()
+        self.backend = OpenCLBackend(config, 0)
+        self.prog = self.backend.build(SOURCE)
+        self.a = np.zeros(N, dtype=np.float32)
+        self.b = np.zeros(N, dtype=np.float32)
+        self.gpu_a = self.backend.alloc_buf(like=self.a)
+        self.gpu_b = self.backend.alloc_buf(like=self.b)
+
+    def _kernel(self, name, args):
+        return self.backend.get_kernel(self.prog, name, (BLOCK,),
+                                       args + [np.int32(N)], None)
+
+    def test_stream_routing(self):
+        stream = self.backend.make_stream()
+        inc = self._kernel('Increment', [self.gpu_a])
+        for _ in range(5):
+            self.backend.run_kernel(inc, (N // BLOCK,), stream)
+
+        # Kernels run in a stream are enqueued in the stream's queue.
+        timings = self.backend.collect_kernel_timings()
+        self.assertEqual([name for name, _ in timings], ['Increment'] * 5)
+        for _, duration in timings:
+            self.assertGreaterEqual(duration, 0.0)
+
+    def test_default_queue_ordering(self):
+        stream = self.backend.make_stream()
+        inc = self._kernel('Increment', [self.gpu_a])
+        copy = self._kernel('Copy', [self.gpu_a, self.gpu_b])
+        for _ in range(5):
+            self.backend.run_kernel(inc, (N // BLOCK,), stream)
+        # Runs in the default queue, and has to see the results of all
+        # kernels previously run in the stream.
+        self.backend.run_kernel(copy, (N // BLOCK,))
+        # Runs in the stream, and must not start before the copy is done.
+        self.backend.run_kernel(inc, (N // BLOCK,), stream)
+        self.backend.sync()
+        self.backend.from_buf(self.gpu_a)
+        self.backend.from_buf(self.gpu_b)
+        np.testing.assert_equal(self.b, 5000.0)
+        np.testing.assert_equal(self.a, 6000.0)
+
+    def test_event_timing(self):
+        stream = self.backend.make_stream()
+        inc = self._kernel('Increment', [self.gpu_a])
+        ev_start = self.backend.make_event(stream, timing=True)
+        self.backend.run_kernel(inc, (N // BLOCK,), stream)
+        ev_end = self.backend.make_event(stream, timing=True)
+        self.assertGreater(ev_end.time_since(ev_start), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
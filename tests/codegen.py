@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+from sailfish.backend_numpy import NumpyBackend
+from sailfish.codegen import context_key, _parametrize_context
+from sailfish.controller import LBSimulationController
+from sailfish.lb_base import LBForcedSim
+from sailfish.lb_binary import LBBinaryFluidShanChen
+from sailfish.lb_single import LBFluidSim
+from sailfish.node_type import DynamicValue, NTEquilibriumVelocity, multifield
+from sailfish.stats import KineticEnergyEnstrophyMixIn
+from sailfish.subdomain import Subdomain2D, SubdomainSpec2D
+from sailfish.subdomain_runner import SubdomainRunner
+from sailfish.sym import D2Q9, S
+
+
+def make_ctx(location, size, id_):
+    spec = SubdomainSpec2D(location, size, envelope_size=1, id_=id_)
+    spec.set_actual_size(1)
+    return {
+        'block': spec,
+        'grid': D2Q9,
+        'lat_nx': size[0] + 2,
+        'node_types': set([1, 2, 3]),
+        'x_local_device_to_global_offset': location[0] - 1,
+        'y_local_device_to_global_offset': location[1] - 1,
+    }
+
+
+class SimpleSubdomain(Subdomain2D):
+    def boundary_conditions(self, hx, hy):
+        pass
+
+    def initial_conditions(self, sim, hx, hy):
+        sim.rho[:] = 1.0
+
+
+class SimpleSim(LBFluidSim):
+    subdomain = SimpleSubdomain
+
+
+def runner_context_key(queue):
+    """Runs a simulation and puts the key of its code generation context
+    into queue."""
+    def build(self, ctx):
+        queue.put(context_key(ctx, 'numpy'))
+        return orig_build(self, ctx)
+
+    orig_build = NumpyBackend.build
+    NumpyBackend.build = build
+    # The default seed is based on the current time.  All runners of
+    # a simulation share the same value.
+    ctrl = LBSimulationController(SimpleSim, default_config={
+        'debug_single_process': True, 'quiet': True, 'silent': True,
+        'backends': 'numpy', 'max_iters': 1, 'lat_nx': 16, 'lat_ny': 16,
+        'seed': 0})
+    ctrl.run(ignore_cmdline=True)
+
+
+class ShanChenSubdomain(Subdomain2D):
+    def boundary_conditions(self, hx, hy):
+        pass
+
+    def initial_conditions(self, sim, hx, hy):
+        sim.rho[:] = 1.0
+        sim.phi[:] = 1.0
+
+
+class ShanChenSim(LBBinaryFluidShanChen):
+    subdomain = ShanChenSubdomain
+
+
+class DynamicValueSubdomain(Subdomain2D):
+    def boundary_conditions(self, hx, hy):
+        self.set_node(hx == 0, NTEquilibriumVelocity(
+            DynamicValue(0.01 * S.gy / self.gy, 0.0)))
+
+    def initial_conditions(self, sim, hx, hy):
+        sim.rho[:] = 1.0
+
+
+class DynamicValueSim(LBFluidSim, LBForcedSim):
+    subdomain = DynamicValueSubdomain
+
+    def __init__(self, config):
+        super(DynamicValueSim, self).__init__(config)
+        self.add_body_force(DynamicValue(1e-6 * S.gx, 0.0))
+
+
+class ProfileSubdomain(Subdomain2D):
+    def boundary_conditions(self, hx, hy):
+        inlet = (hx == 0) & (hy > 0) & (hy < self.gy - 1)
+        self.set_node(inlet, NTEquilibriumVelocity(
+            multifield((0.001 * hy, 0.0), inlet)))
+
+    def initial_conditions(self, sim, hx, hy):
+        sim.rho[:] = 1.0
+
+
+class ProfileStatsSim(LBFluidSim, KineticEnergyEnstrophyMixIn):
+    subdomain = ProfileSubdomain
+
+
+class _Rendered(Exception):
+    pass
+
+
+def render_shared_code(sim_class, codegen_dir, **settings):
+    """Renders the CUDA code for a subdomain of sim_class with code sharing
+    enabled and returns it."""
+    rendered = []
+
+    def update_compute_code(self):
+        self.config._codegen_dir = codegen_dir
+        rendered.append(self._bcg.get_code(self, 'cuda'))
+        raise _Rendered()
+
+    orig_update = SubdomainRunner._update_compute_code
+    SubdomainRunner._update_compute_code = update_compute_code
+    config = {
+        'debug_single_process': True, 'quiet': True, 'silent': True,
+        'backends': 'numpy', 'max_iters': 1, 'lat_nx': 16, 'lat_ny': 16}
+    config.update(settings)
+    try:
+        LBSimulationController(sim_class, default_config=config).run(
+            ignore_cmdline=True)
+    except _Rendered:
+        pass
+    finally:
+        SubdomainRunner._update_compute_code = orig_update
+    return rendered[0]
+
+
+class TestContextKey(unittest.TestCase):
+    def test_identical_subdomains(self):
+        ctx1 = make_ctx((0, 0), (64, 32), 0)
+        ctx2 = make_ctx((64, 0), (64, 32), 1)
+        spec2 = ctx2['block']
+        params1 = _parametrize_context(ctx1)
+        params2 = _parametrize_context(ctx2)
+        self.assertEqual(context_key(ctx1, 'cuda'), context_key(ctx2, 'cuda'))
+        self.assertNotEqual(context_key(ctx1, 'cuda'),
+                            context_key(ctx2, 'opencl'))
+
+        self.assertEqual(params1['__sailfish_block_id__'], 0)
+        self.assertEqual(params2['__sailfish_block_id__'], 1)
+        self.assertEqual(
+            params2['__sailfish_x_local_device_to_global_offset__'], 63)
+        self.assertEqual(ctx2['block'].id, '__sailfish_block_id__')
+        # The original spec is not modified.
+        self.assertEqual(spec2.id, 1)
+
+    def test_different_subdomains(self):
+        ctx1 = make_ctx((0, 0), (64, 32), 0)
+        ctx2 = make_ctx((64, 0), (32, 32), 1)
+        _parametrize_context(ctx1)
+        _parametrize_context(ctx2)
+        self.assertNotEqual(context_key(ctx1), context_key(ctx2))
+
+    def test_unparametrized_offsets(self):
+        ctx1 = make_ctx((0, 0), (64, 32), 0)
+        ctx2 = make_ctx((64, 0), (64, 32), 0)
+        self.assertNotEqual(context_key(ctx1), context_key(ctx2))
+
+    def test_unsupported_value(self):
+        ctx = make_ctx((0, 0), (64, 32), 0)
+        ctx['obj'] = object()
+        self.assertRaises(TypeError, context_key, ctx)
+
+    def test_runner_contexts(self):
+        keys = []
+        for i in range(2):
+            queue = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=runner_context_key,
+                                           args=(queue,))
+            proc.start()
+            keys.append(queue.get(timeout=60))
+            proc.join()
+            self.assertEqual(proc.exitcode, 0)
+        self.assertEqual(keys[0], keys[1])
+
+
+class TestSharedCode(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _check_shared(self, sim_class, **settings):
+        src = render_shared_code(sim_class, self.directory, **settings)
+        self.assertIn('CollideAndPropagate', src)
+        shared = [x for x in os.listdir(self.directory) if x.endswith('.src')]
+        self.assertEqual(len(shared), 1)
+
+    def test_shan_chen(self):
+        # The equilibria are functools.partial objects.
+        self._check_shared(ShanChenSim, G12=1.2, visc=1.0 / 6.0)
+
+    def test_dynamic_value(self):
+        # DynamicValues are used for the body force and the node params.
+        self._check_shared(DynamicValueSim)
+
+
+class TestNodeParamsBuffer(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stress_tensor_kernel(self):
+        # ComputeStressTensor is compiled together with the collision
+        # kernel, and passes the node parameter buffers to getMacro().
+        src = render_shared_code(ProfileStatsSim, self.directory,
+                                 max_const_node_params=4)
+        args = re.search(r'void ComputeStressTensor\(([^)]*)\)', src).group(1)
+        self.assertIn('node_params', args)
+        self.assertIn('node_param_map', args)
+        self.assertIn('node_params, node_param_map + gi', src)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -23,6 +23,10 @@ class TestCase2D(unittest.TestCase):
         config.periodic_x = False
         config.periodic_y = False
         config.use_link_tags = False
+        config.max_const_node_params = 4096
+        config.geometry_threads = 1
+        config.sparse_coordinates = False
+        config.geometry_slab_size = 0
         config.time_dependence = False
         config.space_dependence = False
         config.access_pattern = 'AB'
@@ -50,6 +54,10 @@ class TestCase3D(unittest.TestCase):
         config.periodic_y = False
         config.periodic_z = False
         config.use_link_tags = False
+        config.max_const_node_params = 4096
+        config.geometry_threads = 1
+        config.sparse_coordinates = False
+        config.geometry_slab_size = 0
         config.time_dependence = False
         config.space_dependence = False
         config.access_pattern = 'AB'
@@ -0,0 +1,219 @@
+import ctypes
+import os
+import unittest
+from multiprocessing import Event, Process
+
+import numpy as np
+import zmq
+
+from sailfish.connector import SHMSubdomainConnector, ZMQSubdomainConnector, \
+    AdaptiveCompressedZMQRemoteSubdomainConnector
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+
+def _echo(conn, num_messages):
+    conn.init_runner(None)
+    conn.close_unused()
+    data = np.zeros(16, dtype=np.float32)
+    for i in range(num_messages):
+        conn.recv(data, Event())
+        conn.send(data[:i + 1] * 2)
+    conn.close()
+
+
+class TestSHMConnector(unittest.TestCase):
+    def test_double_buffer(self):
+        c1, c2 = SHMSubdomainConnector.make_pair(ctypes.c_float, (16, 8),
+                                                 (0, 1))
+        c1.init_runner(None)
+        c2.init_runner(None)
+        quit_ev = Event()
+
+        # Two messages can be sent without waiting for the receiver.
+        c1.send(np.arange(16, dtype=np.float32))
+        c1.send(np.arange(4, dtype=np.float32) + 100)
+
+        view = c2.recv_view(quit_ev)
+        np.testing.assert_equal(view, np.arange(16))
+        c2.release()
+        data = np.zeros(4, dtype=np.float32)
+        self.assertTrue(c2.recv(data, quit_ev))
+        np.testing.assert_equal(data, np.arange(4) + 100)
+
+        # The other direction is independent.
+        c2.send(np.ones(8, dtype=np.float32))
+        data = np.zeros(8, dtype=np.float32)
+        self.assertTrue(c1.recv(data, quit_ev))
+        np.testing.assert_equal(data, 1)
+
+        # No data is available.
+        quit_ev.set()
+        self.assertEqual(c2.recv_view(quit_ev), None)
+        self.assertFalse(c1.recv(data, quit_ev))
+
+    def test_full_buffer_quit(self):
+        quit_ev = Event()
+        c1, c2 = SHMSubdomainConnector.make_pair(ctypes.c_float, (4, 4),
+                                                 (0, 1), quit_ev)
+        c1.init_runner(None)
+        c2.init_runner(None)
+        c1.send(np.zeros(4, dtype=np.float32))
+        c1.send(np.zeros(4, dtype=np.float32))
+        # Both slots are full, so the sender would block indefinitely.
+        quit_ev.set()
+        c1.send(np.ones(4, dtype=np.float32))
+
+    def test_processes(self):
+        num_messages = 10
+        c1, c2 = SHMSubdomainConnector.make_pair(ctypes.c_float, (16, 16),
+                                                 (0, 1))
+        p = Process(target=_echo, args=(c2, num_messages))
+        p.start()
+        c1.init_runner(None)
+        c1.close_unused()
+        quit_ev = Event()
+        for i in range(num_messages):
+            c1.send(np.arange(16, dtype=np.float32) + i)
+            view = c1.recv_view(quit_ev)
+            np.testing.assert_equal(view, (np.arange(i + 1) + i) * 2)
+            c1.release()
+        p.join()
+        c1.close()
+        self.assertEqual(p.exitcode, 0)
+
+    def test_close(self):
+        c1, c2 = SHMSubdomainConnector.make_pair(ctypes.c_float, (4, 4),
+                                                 (0, 1))
+        c1.init_runner(None)
+        # Only the pipe ends used by the connector itself are kept open.
+        c1.close_unused()
+        for fd in c2.fds:
+            self.assertRaises(OSError, os.fstat, fd)
+        for fd in c1.fds:
+            os.fstat(fd)
+
+        c1.close()
+        for fd in c1.fds:
+            self.assertRaises(OSError, os.fstat, fd)
+        c1.close()
+
+    def test_parts(self):
+        c1, c2 = SHMSubdomainConnector.make_pair(ctypes.c_float, (16, 16),
+                                                 (0, 1))
+        c1.init_runner(None)
+        c2.init_runner(None)
+        a = np.arange(6, dtype=np.float32).reshape((2, 3))
+        b = np.arange(4, dtype=np.float32) + 10
+        c1.send_parts([a, b])
+        a2 = np.zeros_like(a)
+        b2 = np.zeros_like(b)
+        self.assertTrue(c2.recv_parts([a2, b2], Event()))
+        np.testing.assert_equal(a2, a)
+        np.testing.assert_equal(b2, b)
+
+
+class TestZMQConnector(unittest.TestCase):
+    def setUp(self):
+        self.ctx = zmq.Context()
+
+    def tearDown(self):
+        self.ctx.destroy()
+
+    def test_parts(self):
+        c1, c2 = ZMQSubdomainConnector.make_ipc_pair(ctypes.c_float, (0, 0),
+                                                     (0, 1))
+        try:
+            c1.init_runner(self.ctx)
+            c2.init_runner(self.ctx)
+            a = np.arange(6, dtype=np.float32).reshape((2, 3))
+            b = np.arange(4, dtype=np.float32) + 10
+            for i in range(3):
+                c1.wait_sent()
+                a[:] += i
+                c1.send_parts([a, b])
+                a2 = np.zeros_like(a)
+                b2 = np.zeros_like(b)
+                self.assertTrue(c2.recv_parts([a2, b2], Event()))
+                np.testing.assert_equal(a2, a)
+                np.testing.assert_equal(b2, b)
+        finally:
+            os.unlink(c1.ipc_file)
+
+
+class TestAdaptiveCompressedConnector(unittest.TestCase):
+    def setUp(self):
+        self.ctx = zmq.Context()
+
+    def tearDown(self):
+        self.ctx.destroy()
+
+    def _make_pair(self, bandwidth, encodings=None):
+        cls = AdaptiveCompressedZMQRemoteSubdomainConnector
+        c1 = cls('tcp://127.0.0.1', bandwidth=bandwidth, probe_interval=2,
+                 encodings=encodings)
+        c2 = cls('tcp://127.0.0.1', receiver=True, bandwidth=bandwidth,
+                 probe_interval=2, encodings=encodings)
+        c1.init_runner(self.ctx)
+        c2.port = c1.port
+        c2.init_runner(self.ctx)
+        return c1, c2
+
+    def _exchange(self, c1, c2, num_messages):
+        a = np.zeros((64, 64), dtype=np.float32)
+        b = np.linspace(0.0, 1.0, 1000).astype(np.float64)
+        for i in range(num_messages):
+            c1.wait_sent()
+            a[:, i] = i
+            b[i] += 1.0
+            c1.send_parts([a, b])
+            a2 = np.zeros_like(a)
+            b2 = np.zeros_like(b)
+            self.assertTrue(c2.recv_parts([a2, b2], Event()))
+            np.testing.assert_equal(a2, a)
+            np.testing.assert_equal(b2, b)
+
+    def test_raw(self):
+        # Does not require blosc.
+        c1, c2 = self._make_pair(
+            bandwidth=1e-3,
+            encodings=[AdaptiveCompressedZMQRemoteSubdomainConnector.RAW])
+        self._exchange(c1, c2, 3)
+        stats = c1.stats()
+        self.assertEqual(stats['messages']['raw'], 3)
+        self.assertEqual(stats['raw_bytes'], 3 * (64 * 64 * 4 + 1000 * 8))
+        self.assertEqual(stats['sent_bytes'], stats['raw_bytes'])
+
+    @unittest.skipIf(blosc is None, 'blosc is not available')
+    def test_slow_link(self):
+        c1, c2 = self._make_pair(bandwidth=1e-3)
+        self._exchange(c1, c2, 6)
+        stats = c1.stats()
+        self.assertEqual(stats['messages']['raw'], 0)
+        self.assertEqual(sum(stats['messages'].values()), 6)
+        self.assertEqual(stats['raw_bytes'], 6 * (64 * 64 * 4 + 1000 * 8))
+        self.assertLess(stats['sent_bytes'], stats['raw_bytes'] / 2)
+
+    @unittest.skipIf(blosc is None, 'blosc is not available')
+    def test_fast_link(self):
+        c1, c2 = self._make_pair(bandwidth=1e9)
+        self._exchange(c1, c2, 6)
+        stats = c1.stats()
+        self.assertEqual(stats['messages']['raw'], 6)
+        self.assertEqual(stats['sent_bytes'], stats['raw_bytes'])
+
+    @unittest.skipIf(blosc is None, 'blosc is not available')
+    def test_encodings(self):
+        c1, c2 = self._make_pair(bandwidth=1.0)
+        for encoding in c1.encodings:
+            c1._encoding = c2._encoding = encoding
+            c1._sent_messages = 1
+            self._exchange(c1, c2, 1)
+        self.assertIsNone(ZMQSubdomainConnector('tcp://127.0.0.1').stats())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,16 @@
+import json
+import os
+import tempfile
 import unittest
 
-from sailfish.config import MachineSpec
-from sailfish import controller
-from sailfish.subdomain import SubdomainSpec2D
+import numpy as np
+
+from sailfish.config import LBConfig, LBConfigParser, MachineSpec
+from sailfish import controller, placement
+from sailfish.geo import EqualSubdomainsGeometry3D
+from sailfish.lb_single import LBFluidSim
+from sailfish.node_type import NTFullBBWall
+from sailfish.subdomain import Subdomain3D, SubdomainSpec2D
 
 class TestSubdomainDistribution(unittest.TestCase):
     def test_1_1_mapping(self):
@@ -73,5 +81,146 @@ class TestSubdomainDistribution(unittest.TestCase):
         self.assertEqual(assignments, [[subds[0], subds[1], subds[2]], [subds[3]]])
 
 
+class TestConfig(unittest.TestCase):
+    def test_explicit_options(self):
+        parser = LBConfigParser()
+        group = parser.add_group('test')
+        group.add_argument('--block_size', type=int, default=64)
+        group.add_argument('--mem_alignment', type=int, default=32)
+        group.add_argument('--precision', type=str, default='single')
+        parser.set_defaults({'precision': 'double'})
+        config = parser.parse(['--block_size', '64'])
+
+        # Specified on the command line, even if equal to the default.
+        self.assertTrue(config.is_explicit('block_size'))
+        self.assertFalse(config.is_explicit('mem_alignment'))
+        self.assertTrue(config.is_explicit('precision'))
+        self.assertEqual(config.mem_alignment, 32)
+
+        # Configs created directly are fully specified.
+        self.assertTrue(LBConfig().is_explicit('mem_alignment'))
+
+
+class TestGraphPlacement(unittest.TestCase):
+    def setUp(self):
+        config = LBConfig()
+        config.periodic_x = False
+        config.periodic_y = False
+        config.grid = 'D2Q9'
+        # 4 x 2 subdomains, numbered along the X axis first.
+        subds = [SubdomainSpec2D((x * 16, y * 16), (16, 16), envelope_size=1)
+                 for y in range(2) for x in range(4)]
+        self.subds = controller.LBGeometryProcessor(
+            subds, 2, (64, 32)).transform(config)
+        self.edges = placement.subdomain_graph(self.subds)
+
+    def _ids(self, parts):
+        return [[subd.id for subd in part] for part in parts]
+
+    def test_cut(self):
+        nodes = [
+                MachineSpec('a', 'a', gpus=[0, 1]),
+                MachineSpec('b', 'b', gpus=[0, 1])
+            ]
+        contiguous = controller.split_subdomains_between_nodes(nodes,
+                                                               self.subds)
+        parts = placement.partition_subdomains(self.subds, [2, 2])
+        self.assertEqual(self._ids(parts), [[0, 1, 4, 5], [2, 3, 6, 7]])
+        self.assertTrue(placement.cut_weight(parts, self.edges) <
+                        placement.cut_weight(contiguous, self.edges))
+
+    def test_load_balance(self):
+        for subd in self.subds:
+            subd.active_nodes = 100 if subd.id in (0, 4) else 10
+        parts = placement.partition_subdomains(self.subds, [1, 1], 0.1)
+        loads = [sum(subd.active_nodes for subd in part) for part in parts]
+        self.assertTrue(max(loads) <= 1.1 * sum(loads) / 2)
+
+    def test_more_gpus_than_subdomains(self):
+        parts = placement.partition_subdomains(self.subds, [1] * 10)
+        self.assertEqual(self._ids(parts),
+                         [[0], [1], [2], [3], [4], [5], [6], [7], [], []])
+
+
+class _DryRunSubdomain(Subdomain3D):
+    def boundary_conditions(self, hx, hy, hz):
+        self.set_node((hy == 0) | (hy == self.gy - 1), NTFullBBWall)
+
+    def initial_conditions(self, sim, hx, hy, hz):
+        sim.rho[:] = 1.0
+
+
+class _DryRunSim(LBFluidSim):
+    subdomain = _DryRunSubdomain
+
+
+class _SparseDryRunSubdomain(_DryRunSubdomain):
+    def load_active_node_map(self, hx, hy, hz):
+        self.active_node_mask = np.zeros(self.full_lat_shape, dtype=np.bool)
+        self.active_node_mask[:, :, :10] = True
+
+
+class _SparseDryRunSim(LBFluidSim):
+    subdomain = _SparseDryRunSubdomain
+
+
+class TestDryRun(unittest.TestCase):
+    def test_report(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        settings = {
+            'lat_nx': 64, 'lat_ny': 32, 'lat_nz': 16, 'grid': 'D3Q19',
+            'subdomains': 2, 'block_size': 64, 'mem_alignment': 32,
+            'dry_run': True, 'dry_run_report': path, 'quiet': True,
+            'log': os.devnull
+        }
+        try:
+            ctrl = controller.LBSimulationController(
+                _DryRunSim, EqualSubdomainsGeometry3D, settings)
+            report = ctrl.run(ignore_cmdline=True)
+            with open(path) as f:
+                self.assertEqual(json.load(f), report)
+        finally:
+            os.unlink(path)
+
+        self.assertEqual(report['access_pattern'], 'AB')
+        subdomains = report['subdomains']
+        self.assertEqual(len(subdomains), 2)
+        for subdomain in subdomains:
+            # 32 x 32 x 16 nodes with ghosts, X padded to 64 nodes.
+            self.assertEqual(subdomain['nodes'], 34 * 34 * 18)
+            self.assertEqual(subdomain['active_nodes'], 34 * 34 * 18)
+            self.assertEqual(subdomain['allocated_nodes'], 64 * 34 * 18)
+            self.assertEqual(subdomain['memory']['dists_ab'],
+                             2 * 19 * 4 * 64 * 34 * 18)
+            # 5 distributions cross the face.
+            traffic = subdomain['halo_bytes_per_step']
+            self.assertEqual(len(traffic), 1)
+            self.assertEqual(list(traffic.values())[0],
+                             {'sent': 5 * 32 * 16 * 4,
+                              'received': 5 * 32 * 16 * 4})
+
+    def test_report_indirect(self):
+        settings = {
+            'lat_nx': 64, 'lat_ny': 32, 'lat_nz': 16, 'grid': 'D3Q19',
+            'subdomains': 2, 'node_addressing': 'indirect', 'dry_run': True,
+            'quiet': True, 'log': os.devnull
+        }
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        settings['dry_run_report'] = path
+        try:
+            ctrl = controller.LBSimulationController(
+                _SparseDryRunSim, EqualSubdomainsGeometry3D, settings)
+            report = ctrl.run(ignore_cmdline=True)
+        finally:
+            os.unlink(path)
+
+        for subdomain in report['subdomains']:
+            self.assertEqual(subdomain['nodes'], 34 * 34 * 18)
+            self.assertEqual(subdomain['active_nodes'], 10 * 34 * 18)
+            self.assertEqual(subdomain['allocated_nodes'], 10 * 34 * 18)
+
+
 if __name__ == '__main__':
     unittest.main()
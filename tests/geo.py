@@ -0,0 +1,138 @@
+from __future__ import division
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from sailfish.config import LBConfig
+from sailfish.controller import GeometryError, LBGeometryProcessor
+from sailfish.geo import BisectedSubdomainsGeometry3D, \
+        SparseSubdomainsGeometry3D
+
+
+class TestDecomposition3D(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        config = LBConfig()
+        config.lat_nx, config.lat_ny, config.lat_nz = 64, 48, 40
+        config.periodic_x = False
+        config.periodic_y = False
+        config.periodic_z = False
+        config.subdomains = 1
+        config.conn_axis = 'x'
+        config.geometry_for_decomposition = ''
+        config.max_imbalance = 0.05
+        config.sparse_block_size = 8
+        config.subdomain_nodes = 0
+        config.min_block_fill = 0.5
+        config.grid = 'D3Q19'
+        self.config = config
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _check_coverage(self, specs):
+        covered = np.zeros((self.config.lat_nz, self.config.lat_ny,
+                            self.config.lat_nx), dtype=np.int32)
+        for spec in specs:
+            covered[spec.oz:spec.oz + spec.nz, spec.oy:spec.oy + spec.ny,
+                    spec.ox:spec.ox + spec.nx] += 1
+        np.testing.assert_equal(covered, 1)
+
+    def _active_nodes(self, geo, spec):
+        return np.sum(np.logical_not(
+            geo[spec.oz:spec.oz + spec.nz, spec.oy:spec.oy + spec.ny,
+                spec.ox:spec.ox + spec.nx]))
+
+    def test_uniform(self):
+        self.config.lat_nx, self.config.lat_ny, self.config.lat_nz = 64, 64, 64
+        self.config.subdomains = 8
+        specs = BisectedSubdomainsGeometry3D(self.config).subdomains()
+        self.assertEqual(len(specs), 8)
+        self._check_coverage(specs)
+        for spec in specs:
+            self.assertEqual(spec.size, (32, 32, 32))
+
+    def test_weighted(self):
+        # Cylinder along the X axis, with a solid block in the X_HIGH half.
+        hz, hy, hx = np.mgrid[0:40, 0:48, 0:64]
+        geo = ((hy - 24)**2 + (hz - 20)**2) >= 18**2
+        geo[:, :, 40:] |= (hy[:, :, 40:] < 24)
+        fname = os.path.join(self.directory, 'geo.npy')
+        np.save(fname, geo)
+        self.config.geometry_for_decomposition = fname
+
+        for n in (2, 5, 12):
+            self.config.subdomains = n
+            specs = BisectedSubdomainsGeometry3D(self.config).subdomains()
+            self.assertEqual(len(specs), n)
+            self._check_coverage(specs)
+            avg = np.sum(np.logical_not(geo)) / n
+            for spec in specs:
+                self.assertTrue(self._active_nodes(geo, spec) <= 1.05 * avg)
+
+        # The output can be processed into connected subdomains.
+        for spec in specs:
+            spec.envelope_size = 1
+        specs = LBGeometryProcessor(specs, 3, (64, 48, 40)).transform(
+            self.config)
+        for spec in specs:
+            self.assertTrue(spec.connecting_subdomains())
+
+    def test_too_many_subdomains(self):
+        self.config.lat_nx, self.config.lat_ny, self.config.lat_nz = 2, 2, 1
+        self.config.subdomains = 5
+        self.assertRaises(ValueError,
+                          BisectedSubdomainsGeometry3D(self.config).subdomains)
+
+    def test_sparse(self):
+        # Two disconnected tubes occupying a small part of the domain.
+        hz, hy, hx = np.mgrid[0:40, 0:48, 0:64]
+        tube1 = ((hy - 10)**2 + (hz - 10)**2) < 5**2
+        tube2 = ((hx - 50)**2 + (hy - 36)**2) < 4**2
+        geo = np.logical_not(tube1 | tube2)
+        fname = os.path.join(self.directory, 'geo.npy')
+        np.save(fname, geo)
+        self.config.geometry_for_decomposition = fname
+        self.config.subdomains = 4
+
+        specs = SparseSubdomainsGeometry3D(self.config).subdomains()
+        covered = np.zeros(geo.shape, dtype=np.int32)
+        for spec in specs:
+            covered[spec.oz:spec.oz + spec.nz, spec.oy:spec.oy + spec.ny,
+                    spec.ox:spec.ox + spec.nx] += 1
+            self.assertTrue(self._active_nodes(geo, spec) > 0)
+        self.assertTrue(np.all(covered <= 1))
+        # All active nodes and their neighbors are covered.
+        near_active = np.logical_not(geo)
+        for axis in range(3):
+            near_active = (near_active | np.roll(near_active, 1, axis) |
+                           np.roll(near_active, -1, axis))
+        np.testing.assert_equal(covered[near_active], 1)
+        self.assertTrue(np.sum(covered) < geo.size / 3)
+
+        for spec in specs:
+            spec.envelope_size = 1
+        specs = LBGeometryProcessor(specs, 3, (64, 48, 40), sparse=True
+                                    ).transform(self.config)
+        for spec in specs:
+            self.assertTrue(spec.connecting_subdomains())
+
+        # With a large target size, every tube is covered by a single
+        # subdomain, not connected to the other one.
+        self.config.subdomain_nodes = 100000
+        specs = SparseSubdomainsGeometry3D(self.config).subdomains()
+        self.assertEqual(len(specs), 2)
+        for spec in specs:
+            spec.envelope_size = 1
+        self.assertRaises(GeometryError, LBGeometryProcessor(
+            list(specs), 3, (64, 48, 40)).transform, self.config)
+        specs = LBGeometryProcessor(specs, 3, (64, 48, 40), sparse=True
+                                    ).transform(self.config)
+        for spec in specs:
+            self.assertFalse(spec.connecting_subdomains())
+
+if __name__ == '__main__':
+    unittest.main()
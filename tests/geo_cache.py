@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from sailfish.geo_cache import GeometryCache, get_geometry_cache
+from sailfish.node_type import NTEquilibriumDensity, NTEquilibriumVelocity, \
+        NTFullBBWall, NTGradFreeflow, DynamicValue, \
+        LinearlyInterpolatedTimeSeries, multifield, _NTFluid
+from sailfish.subdomain import Subdomain2D, SubdomainSpec2D
+from sailfish.subdomain_runner import SubdomainRunner
+from sailfish.sym import D2Q9, S
+from common import TestCase2D
+
+
+class _Subdomain2D(Subdomain2D):
+    def boundary_conditions(self, hx, hy):
+        wall = (hy == 0) | (hy == self.gy - 1)
+        self.set_node(wall, NTFullBBWall)
+        where = (hx == 0) & ~wall
+        self.set_node(where, NTEquilibriumVelocity(
+            multifield((0.01 * hy / self.gy, 0.0), where)))
+        self.set_node((hx == self.gx - 1) & ~wall, NTGradFreeflow)
+        self.set_node((hx == 5) & (hy == 7), NTEquilibriumDensity(
+            DynamicValue(0.1 * S.gx * LinearlyInterpolatedTimeSeries(
+                np.linspace(0, 50, 10), 40))))
+
+
+class TestGeometryCache(TestCase2D):
+    lattice_size = 32, 16
+
+    def setUp(self):
+        TestCase2D.setUp(self)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _make_subdomain(self):
+        spec = SubdomainSpec2D((0, 0), self.lattice_size, envelope_size=1,
+                               id_=0)
+        spec.runner = SubdomainRunner(self.sim, spec, output=None,
+                                      backend=self.backend, quit_event=None)
+        spec.runner._init_shape()
+        sub = _Subdomain2D(list(reversed(self.lattice_size)), spec, D2Q9)
+        sub.allocate()
+        return sub
+
+    def test_key(self):
+        sub = self._make_subdomain()
+        key = GeometryCache.make_key(sub)
+        self.assertEqual(key, GeometryCache.make_key(self._make_subdomain()))
+        self.config.geometry_version = 'v2'
+        self.assertNotEqual(key, GeometryCache.make_key(sub))
+        self.config.geometry_version = ''
+        self.config.use_link_tags = True
+        self.assertNotEqual(key, GeometryCache.make_key(sub))
+
+    def test_save_load(self):
+        cache = GeometryCache(self.directory)
+        sub = self._make_subdomain()
+        self.assertFalse(cache.load(sub))
+        sub.reset()
+        cache.save(sub)
+
+        self.config.time_dependence = False
+        self.config.space_dependence = False
+        cached = self._make_subdomain()
+        self.assertTrue(cache.load(cached))
+        self.assertTrue(self.config.time_dependence)
+        self.assertTrue(self.config.space_dependence)
+
+        np.testing.assert_equal(sub.encoded_map(), cached.encoded_map())
+        np.testing.assert_equal(sub.visualization_map(),
+                                cached.visualization_map())
+        self.assertEqual(sub.scratch_space_size, cached.scratch_space_size)
+        for y in range(1, 16):
+            self.assertEqual(sub._encoder.get_param((1, y), 2),
+                             cached._encoder.get_param((1, y), 2))
+
+        ctx, cached_ctx = {}, {}
+        sub.update_context(ctx)
+        cached.update_context(cached_ctx)
+        for name in ('node_params', 'type_id_remap', 'nt_misc_shift',
+                     'nt_param_shift', 'nt_scratch_shift', 'timeseries_data',
+                     'non_symbolic_idxs', 'scratch_space_base'):
+            self.assertEqual(ctx[name], cached_ctx[name])
+        self.assertEqual(sorted(ctx['symbol_idx_map']),
+                         sorted(cached_ctx['symbol_idx_map']))
+
+        # Updating nodes works with the cached geometry.
+        cached.update_node((slice(0, 1), slice(3, 4)), _NTFluid)
+        self.assertEqual(cached.visualization_map()[0, 3], _NTFluid.id)
+
+        self.config.geometry_version = 'v2'
+        self.assertFalse(cache.load(self._make_subdomain()))
+
+    def test_opt_out(self):
+        sub = self._make_subdomain()
+        self.config.geometry_cache_dir = ''
+        self.assertIsNone(get_geometry_cache(sub))
+        self.config.geometry_cache_dir = self.directory
+        self.assertIsInstance(get_geometry_cache(sub), GeometryCache)
+        sub.cache_geometry = False
+        self.assertIsNone(get_geometry_cache(sub))
+
+
+if __name__ == '__main__':
+    unittest.main()
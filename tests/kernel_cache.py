@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from sailfish.kernel_cache import KernelCache
+
+
+class TestKernelCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_key(self):
+        key = KernelCache.make_key('src', 'cuda', 'dev0', ['-O3'])
+        self.assertEqual(key, KernelCache.make_key('src', 'cuda', 'dev0', ['-O3']))
+        self.assertNotEqual(key, KernelCache.make_key('src2', 'cuda', 'dev0', ['-O3']))
+        self.assertNotEqual(key, KernelCache.make_key('src', 'opencl', 'dev0', ['-O3']))
+        self.assertNotEqual(key, KernelCache.make_key('src', 'cuda', 'dev1', ['-O3']))
+        self.assertNotEqual(key, KernelCache.make_key('src', 'cuda', 'dev0', []))
+
+    def test_get_put(self):
+        cache = KernelCache(self.directory, 1024)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', b'binary')
+        self.assertEqual(cache.get('a'), b'binary')
+        # The entry is visible to other instances using the same directory.
+        self.assertEqual(KernelCache(self.directory, 1024).get('a'), b'binary')
+        # No temporary files are left behind.
+        self.assertFalse([name for name in os.listdir(self.directory)
+                          if name.startswith('.tmp-')])
+
+    def test_lru_eviction(self):
+        cache = KernelCache(self.directory, 250)
+        now = time.time()
+        cache.put('a', b'a' * 100)
+        cache.put('b', b'b' * 100)
+        os.utime(cache._path('a'), (now - 20, now - 20))
+        os.utime(cache._path('b'), (now - 10, now - 10))
+        # Reading 'a' makes 'b' the least recently used entry.
+        cache.get('a')
+        cache.put('c', b'c' * 100)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'a' * 100)
+        self.assertEqual(cache.get('c'), b'c' * 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
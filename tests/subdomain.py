@@ -1,9 +1,14 @@
 from __future__ import division
 import numpy as np
 import operator
+import os
+import shutil
+import tempfile
 import unittest
+from sailfish import util
 from sailfish.controller import LBGeometryProcessor
-from sailfish.node_type import NTEquilibriumDensity, NTEquilibriumVelocity, multifield, NTFullBBWall, _NTUnused, _NTPropagationOnly, NTHalfBBWall, DynamicValue, LinearlyInterpolatedTimeSeries
+from sailfish.geo_encoder import GeoEncoderBuffer, GeoEncoderConst
+from sailfish.node_type import NTEquilibriumDensity, NTEquilibriumVelocity, multifield, NTFullBBWall, NTGradFreeflow, _NTUnused, _NTPropagationOnly, NTHalfBBWall, DynamicValue, LinearlyInterpolatedTimeSeries
 from sailfish.subdomain import Subdomain2D, Subdomain3D, SubdomainSpec2D, SubdomainSpec3D, SubdomainPair
 from sailfish.subdomain_runner import SubdomainRunner
 from sailfish.sym import D2Q9, D3Q19, S
@@ -62,6 +67,110 @@ class TestNodeTypeSetting2D(TestCase2D):
         self.assertTrue(sub.config.time_dependence)
         self.assertTrue(sub.config.space_dependence)
 
+    def test_scratch_space(self):
+        spec = SubdomainSpec2D((0, 0), self.lattice_size, envelope_size=1, id_=0)
+        spec.runner = SubdomainRunner(self.sim, spec, output=None,
+                                      backend=self.backend, quit_event=None)
+        spec.runner._init_shape()
+
+        class _Subdomain2D(Subdomain2D):
+            def boundary_conditions(self, hx, hy):
+                self.set_node((hx == self.gx - 1) & (hy > 0) & (hy < 10),
+                              NTGradFreeflow)
+                self.set_node((hy == 0) | (hy == self.gy - 1), NTFullBBWall)
+
+        sub = _Subdomain2D(list(reversed(self.lattice_size)), spec, D2Q9)
+        sub.allocate()
+        sub.reset(encode=False)
+
+        encoder = sub._encoder
+        where = sub._type_map_base == NTGradFreeflow.id
+        # Scratch space IDs are consecutive, in C order.
+        np.testing.assert_equal(encoder._scratch_map[where], np.arange(9))
+        np.testing.assert_equal(encoder._scratch_map[~where], 0)
+        self.assertEqual(encoder.scratch_space_size,
+                         9 * NTGradFreeflow.scratch_space_size(2))
+
+    def test_param_buffer(self):
+        spec = SubdomainSpec2D((0, 0), self.lattice_size, envelope_size=1, id_=0)
+        spec.runner = SubdomainRunner(self.sim, spec, output=None,
+                                      backend=self.backend, quit_event=None)
+        spec.runner._init_shape()
+
+        class _Subdomain2D(Subdomain2D):
+            def boundary_conditions(self, hx, hy):
+                for y in range(1, self.gy - 1):
+                    self.set_node((hx == 0) & (hy == y),
+                                  NTEquilibriumVelocity((0.001 * y, 0.0)))
+                self.set_node((hy == 0) | (hy == self.gy - 1), NTFullBBWall)
+
+        # 62 distinct velocity vectors fit in const memory.
+        sub = _Subdomain2D(list(reversed(self.lattice_size)), spec, D2Q9)
+        sub.allocate()
+        sub.reset(encode=False)
+        self.assertIs(type(sub._encoder), GeoEncoderConst)
+        self.assertIsNone(sub.node_params)
+        ctx = {}
+        sub._encoder.update_context(ctx)
+        self.assertFalse(ctx['node_params_buffer'])
+        self.assertEqual(len(ctx['node_params']), 62 * 2)
+        self.assertIsNone(sub.node_param_map())
+
+        # The param index is a field of the 32-bit node code.
+        sub._encoder._bits_param = 32 - sub._encoder._bits_type
+        self.assertRaises(ValueError, sub._encoder.encode,
+                          sub._orientation_base)
+
+        self.config.max_const_node_params = 100
+        sub = _Subdomain2D(list(reversed(self.lattice_size)), spec, D2Q9)
+        sub.allocate()
+        sub.reset(encode=False)
+        self.assertIs(type(sub._encoder), GeoEncoderBuffer)
+        self.assertEqual(len(sub.node_params), 62 * 2)
+        ctx = {}
+        sub._encoder.update_context(ctx)
+        self.assertTrue(ctx['node_params_buffer'])
+        self.assertEqual(ctx['node_params'], [])
+        self.assertEqual(ctx['nt_param_shift'], 0)
+
+        # The param index is stored in a separate per-node map, and not in
+        # the node code.
+        sub.encoded_map()
+        param_map = sub.node_param_map()
+        self.assertEqual(param_map.dtype, np.uint32)
+        self.assertEqual(param_map.shape, sub.encoded_map().shape)
+
+        for y in range(1, 63):
+            np.testing.assert_array_almost_equal(
+                    np.float64([0.001 * y, 0.0]),
+                    np.float64(sub._encoder.get_param((1, y + 1), 2)))
+            idx = param_map[y + 1, 1]
+            np.testing.assert_array_almost_equal(
+                    np.float64([0.001 * y, 0.0]),
+                    np.float64(sub.node_params[idx:idx + 2]))
+
+    def test_param_map_dtype(self):
+        spec = SubdomainSpec2D((0, 0), self.lattice_size, envelope_size=1, id_=0)
+        spec.runner = SubdomainRunner(self.sim, spec, output=None,
+                                      backend=self.backend, quit_event=None)
+        spec.runner._init_shape()
+
+        class _Subdomain2D(Subdomain2D):
+            def boundary_conditions(self, hx, hy):
+                for i in range(300):
+                    self.set_node((hx == i % self.gx) & (hy == i // self.gx),
+                                  NTEquilibriumDensity(1.0 + i * 1e-4))
+
+        sub = _Subdomain2D(list(reversed(self.lattice_size)), spec, D2Q9)
+        sub.allocate()
+        self.assertEqual(sub._param_map_base.dtype, np.uint8)
+        sub.reset(encode=False)
+        # The map is widened once more than 255 keys are used.
+        self.assertEqual(sub._param_map_base.dtype, np.uint16)
+        self.assertEqual(sub._param_map[0, 0], 1)
+        self.assertEqual(sub._param_map[3, 63], 256)
+        self.assertEqual(sub._param_map[4, 43], 300)
+
     def test_solid_interior_nodes(self):
         """Verifies that interior solid nodes in a 2D cube are correctly
         rewritten as unused/propagation only."""
@@ -94,6 +203,27 @@ class TestNodeTypeSetting2D(TestCase2D):
         # Core of unused nodes.
         np.testing.assert_equal(sub._type_map[7:9, 7:9], _NTUnused.id)
 
+    def test_active_node_map_from_wall_map(self):
+        spec = SubdomainSpec2D((0, 0), self.lattice_size, envelope_size=1, id_=0)
+        spec.runner = SubdomainRunner(self.sim, spec, output=None,
+                                      backend=self.backend, quit_event=None)
+        spec.runner._init_shape()
+        sub = self._SubdomainTest2D(list(reversed(self.lattice_size)), spec, D2Q9)
+
+        wall_map = np.ones((66, 66), dtype=np.bool)
+        wall_map[20:40, 10:30] = False
+        # Active nodes are connected through periodic boundaries.
+        wall_map[0, 50] = False
+
+        for threads in (1, 3):
+            self.sim.config.geometry_threads = threads
+            sub.set_active_node_map_from_wall_map(wall_map)
+            expected = np.zeros_like(wall_map)
+            expected[19:41, 9:31] = True
+            expected[-1:, 49:52] = True
+            expected[0:2, 49:52] = True
+            np.testing.assert_equal(sub.active_node_mask, expected)
+
 
 class TestNodeTypeSetting3D(TestCase3D):
     class _SubdomainTest3D(Subdomain3D):
@@ -127,6 +257,83 @@ class TestNodeTypeSetting3D(TestCase3D):
         np.testing.assert_equal(sub._type_map[1:5, 1:2, 13:-1], _NTUnused.id)
         np.testing.assert_equal(sub._type_map[5, 3, 12:-1], _NTPropagationOnly.id)
 
+    def test_sparse_coordinates(self):
+        subs = []
+        for sparse in (False, True):
+            self.sim.config.sparse_coordinates = sparse
+            spec = SubdomainSpec3D((0, 0, 0), self.lattice_size,
+                                   envelope_size=1, id_=0)
+            spec.runner = SubdomainRunner(self.sim, spec, output=None,
+                                          backend=self.backend, quit_event=None)
+            spec.runner._init_shape()
+            sub = self._SubdomainTest3D(list(reversed(self.lattice_size)),
+                                        spec, D3Q19)
+            sub.allocate()
+            sub.reset()
+            subs.append(sub)
+
+        dense, sparse = subs
+        self.assertEqual(sparse._param_map_base.dtype, np.uint8)
+        np.testing.assert_equal(dense._type_map_base, sparse._type_map_base)
+        np.testing.assert_equal(dense._param_map_base, sparse._param_map_base)
+        np.testing.assert_equal(dense._encoder._geo_params,
+                                sparse._encoder._geo_params)
+
+    def test_select_subdomain(self):
+        es = 1
+        nz, ny, nx = reversed(self.lattice_size)
+        full = np.random.RandomState(0).random_sample(
+            (nz + 2 * es, ny + 2 * es, nx + 2 * es))
+        directory = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(directory, 'geo.npz')
+            util.save_chunked_array(fname, full, chunk_elements=1000)
+            chunked = util.open_array(fname)
+
+            for sparse in (False, True):
+                self.sim.config.sparse_coordinates = sparse
+                spec = SubdomainSpec3D((4, 8, 2), (10, 12, 6),
+                                       envelope_size=es, id_=0)
+                spec.runner = SubdomainRunner(self.sim, spec, output=None,
+                                              backend=self.backend,
+                                              quit_event=None)
+                spec.runner._init_shape()
+                sub = self._SubdomainTest3D(
+                    list(reversed(self.lattice_size)), spec, D3Q19)
+                hx, hy, hz = sub._get_mgrid_base(self.sim.config)
+                expected = np.broadcast_to(full[hz + es, hy + es, hx + es],
+                                           (8, 14, 12))
+                np.testing.assert_array_equal(
+                    sub.select_subdomain(full, hx, hy, hz), expected)
+                np.testing.assert_array_equal(
+                    sub.select_subdomain(chunked, hx, hy, hz), expected)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_slab_processing(self):
+        subs = []
+        for slab_size in (0, 3):
+            self.sim.config.geometry_slab_size = slab_size
+            spec = SubdomainSpec3D((0, 0, 0), self.lattice_size,
+                                   envelope_size=1, id_=0)
+            spec.runner = SubdomainRunner(self.sim, spec, output=None,
+                                          backend=self.backend, quit_event=None)
+            spec.runner._init_shape()
+            sub = self._SubdomainTest3D(list(reversed(self.lattice_size)),
+                                        spec, D3Q19)
+            sub.allocate()
+            sub.reset(encode=False)
+            subs.append(sub)
+
+        full, slabs = subs
+        np.testing.assert_equal(full._type_map_base, slabs._type_map_base)
+        np.testing.assert_equal(full._orientation_base,
+                                slabs._orientation_base)
+        np.testing.assert_equal(full._type_vis_map, slabs._type_vis_map)
+        for y in range(1, 17):
+            np.testing.assert_equal(full._encoder.get_param((y, y, y), 3),
+                                    slabs._encoder.get_param((y, y, y), 3))
+
     def test_boundary_nodes(self):
         """Verifies that boundary (density) nodes do not get mistakenly
         rewritten as unused/propagation-only."""
@@ -366,6 +573,49 @@ class TestLinkTagging3D(TestCase3D):
         TestCase3D.setUp(self)
         self.sim.config.use_link_tags = True
 
+    def test_param_buffer(self):
+        spec = SubdomainSpec3D((0, 0, 0), (32, 64, 64), envelope_size=1, id_=0)
+        spec.runner = SubdomainRunner(self.sim, spec, output=None,
+                                      backend=self.backend, quit_event=None)
+        spec.runner._init_shape()
+
+        class _InletSubdomain3D(Subdomain3D):
+            def boundary_conditions(self, hx, hy, hz):
+                self.set_node((hy == 0) | (hy == self.gy - 1) |
+                              (hz == 0) | (hz == self.gz - 1), NTHalfBBWall)
+                inlet = ((hx == 0) & (hy > 0) & (hy < self.gy - 1) &
+                         (hz > 0) & (hz < self.gz - 1))
+                self.set_node(inlet, NTEquilibriumVelocity(
+                    multifield((1e-6 * (hy * self.gz + hz), 0.0, 0.0),
+                               inlet)))
+
+        # 62 * 62 distinct velocity vectors do not fit in const memory.
+        # The offsets within the parameter buffer would not fit in the bits
+        # left over in the node code by the link tags.
+        sub = _InletSubdomain3D([64, 64, 32], spec, D3Q19)
+        sub.allocate()
+        sub.reset()
+        self.assertIs(type(sub._encoder), GeoEncoderBuffer)
+        self.assertEqual(len(sub.node_params), 62 * 62 * 3)
+        self.assertTrue(sub._encoder._have_link_tags)
+
+        encoded = sub.encoded_map()
+        param_map = sub.node_param_map()
+        ctx = {}
+        sub._encoder.update_context(ctx)
+        velocity_type = ctx['type_id_remap'][NTEquilibriumVelocity.id]
+        for y in range(1, 63):
+            for z in range(1, 63):
+                expected = np.float64([1e-6 * (y * 64 + z), 0.0, 0.0])
+                np.testing.assert_array_almost_equal(
+                        expected, np.float64(
+                            sub._encoder.get_param((1, y + 1, z + 1), 3)))
+                idx = param_map[z + 1, y + 1, 1]
+                np.testing.assert_array_almost_equal(
+                        expected, np.float64(sub.node_params[idx:idx + 3]))
+                self.assertEqual(encoded[z + 1, y + 1, 1] &
+                                 ctx['nt_type_mask'], velocity_type)
+
     def test_periodic_yz(self):
         self.sim.config.periodic_y = True
         self.sim.config.periodic_z = True
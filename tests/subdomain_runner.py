@@ -1,15 +1,20 @@
 import ctypes
 import operator
 import os
+import sys
+import threading
+import traceback
 import unittest
 import numpy as np
 import zmq
 
 from sailfish.config import LBConfig
-from sailfish.connector import ZMQSubdomainConnector
+from sailfish.connector import ZMQSubdomainConnector, SHMSubdomainConnector
 from sailfish.lb_base import LBSim
 from sailfish.lb_binary import LBBinaryFluidShanChen
+from sailfish.lb_single import LBFluidSim
 from sailfish.backend_dummy import DummyBackend
+from sailfish.comm_thread import CommThread
 from sailfish.subdomain_runner import SubdomainRunner, NNSubdomainRunner
 from sailfish.subdomain import SubdomainSpec2D, SubdomainSpec3D, SubdomainPair
 from sailfish.io import LBOutput
@@ -107,9 +112,7 @@ class NNSubdomainRunnerTest(unittest.TestCase):
         except AttributeError:
             pass
 
-    def test_macro_transfer_2d(self):
-        """Verifies that macroscopic fields are correctly exchanged between two
-        2D subddomains."""
+    def _make_connected_runners(self, make_pair):
         b1 = SubdomainSpec2D((0, 0), (40, 40), id_=0)
         b2 = SubdomainSpec2D((0, 40), (40, 40), id_=1)
         b1.set_actual_size(envelope_size=1)
@@ -121,7 +124,7 @@ class NNSubdomainRunnerTest(unittest.TestCase):
         cpair = b1.get_connection(*b1.connecting_subdomains()[0])
         size1 = cpair.src.elements
         size2 = cpair.dst.elements
-        c1, c2 = ZMQSubdomainConnector.make_ipc_pair(ctypes.c_float, (size1, size2), (b1.id, b2.id))
+        c1, c2 = make_pair(ctypes.c_float, (size1, size2), (b1.id, b2.id))
         b1.add_connector(b2.id, c1)
         b2.add_connector(b1.id, c2)
 
@@ -147,6 +150,13 @@ class NNSubdomainRunnerTest(unittest.TestCase):
         # Initialize a local IPC connection between the subdomains.
         c1.init_runner(self.ctx)
         c2.init_runner(self.ctx)
+        return br1, br2, c1, c2
+
+    def test_macro_transfer_2d(self):
+        """Verifies that macroscopic fields are correctly exchanged between two
+        2D subddomains."""
+        br1, br2, c1, c2 = self._make_connected_runners(
+            ZMQSubdomainConnector.make_ipc_pair)
 
         # Verify transfer of the macroscopic fields.
         rho_cbuf, phi_cbuf = br1._block_to_macrobuf[1]
@@ -178,5 +188,305 @@ class NNSubdomainRunnerTest(unittest.TestCase):
 
         os.unlink(c1.ipc_file)
 
+    def test_comm_thread_transfer_2d(self):
+        """Verifies that data is correctly exchanged between two 2D subdomains
+        in background threads."""
+        br1, br2, c1, c2 = self._make_connected_runners(
+            ZMQSubdomainConnector.make_ipc_pair)
+        for br in br1, br2:
+            br._comm_thread = CommThread(self.backend)
+            br._comm_thread.start()
+
+        try:
+            rho_cbuf, phi_cbuf = br1._block_to_macrobuf[1]
+            rho = rho_cbuf.coll_buf.host
+            phi = phi_cbuf.coll_buf.host
+            rho[:] = np.mgrid[0:len(rho)]
+            phi[:] = np.mgrid[100:100 + len(phi)]
+
+            # Both runners send before any of them receives.
+            br1._send_macro()
+            br2._send_macro()
+            br2._recv_macro()
+            br1._recv_macro()
+            self.assertEqual(br2._pending_exchange, None)
+
+            rho_recv, phi_recv = br2._block_to_macrobuf[0]
+            np.testing.assert_equal(rho_recv.recv_buf.host, rho)
+            np.testing.assert_equal(phi_recv.recv_buf.host, phi)
+
+            f_cbuf, g_cbuf = br1._block_to_connbuf[1]
+            fdist = f_cbuf.coll_buf.host
+            gdist = g_cbuf.coll_buf.host
+            fdist.flat = np.mgrid[0:len(fdist)]
+            gdist.flat = np.mgrid[500:500 + len(gdist)]
+
+            br1._send_dists()
+            br2._send_dists()
+            br2._recv_dists()
+            br1._recv_dists()
+
+            f_recv, g_recv = br2._block_to_connbuf[0]
+            np.testing.assert_equal(f_recv.recv_buf, fdist)
+            np.testing.assert_equal(g_recv.recv_buf, gdist)
+        finally:
+            for br in br1, br2:
+                br._comm_thread.stop()
+            os.unlink(c1.ipc_file)
+
+    def test_shm_transfer_2d(self):
+        """Verifies that data is correctly exchanged between two 2D subdomains
+        connected via shared memory."""
+        # Room for two distribution sets of the binary fluid model.
+        br1, br2, c1, c2 = self._make_connected_runners(
+            lambda ctype, sizes, ids: SHMSubdomainConnector.make_pair(
+                ctype, (2 * sizes[0], 2 * sizes[1]), ids))
+
+        rho_cbuf, phi_cbuf = br1._block_to_macrobuf[1]
+        rho = rho_cbuf.coll_buf.host
+        phi = phi_cbuf.coll_buf.host
+        rho[:] = np.mgrid[0:len(rho)]
+        phi[:] = np.mgrid[100:100 + len(phi)]
+
+        br1._send_macro()
+        br2._recv_macro()
+
+        rho_recv, phi_recv = br2._block_to_macrobuf[0]
+        np.testing.assert_equal(rho_recv.recv_buf.host, rho)
+        np.testing.assert_equal(phi_recv.recv_buf.host, phi)
+
+        # The distributions are distributed directly from shared memory,
+        # without going through the receive buffers.
+        f_cbuf, g_cbuf = br1._block_to_connbuf[1]
+        fdist = f_cbuf.coll_buf.host
+        gdist = g_cbuf.coll_buf.host
+        fdist.flat = np.mgrid[0:len(fdist)]
+        gdist.flat = np.mgrid[500:500 + len(gdist)]
+
+        br1._send_dists()
+        br2._recv_dists()
+
+        def staged(cbuf):
+            return [np.copy(buf.host) for buf in (cbuf.dist_partial_buf,
+                                                  cbuf.dist_full_buf)
+                    if buf is not None]
+
+        f_recv, g_recv = br2._block_to_connbuf[0]
+        received = staged(f_recv) + staged(g_recv)
+        f_recv.distribute(self.backend, None, fdist.reshape(f_recv.recv_buf.shape))
+        g_recv.distribute(self.backend, None, gdist.reshape(g_recv.recv_buf.shape))
+        expected = staged(f_recv) + staged(g_recv)
+        self.assertEqual(len(received), len(expected))
+        for r, e in zip(received, expected):
+            np.testing.assert_equal(r, e)
+
+    def test_shm_comm_thread_transfer_2d(self):
+        """Verifies that data received in background threads via shared
+        memory is distributed directly from shared memory."""
+        br1, br2, c1, c2 = self._make_connected_runners(
+            lambda ctype, sizes, ids: SHMSubdomainConnector.make_pair(
+                ctype, (2 * sizes[0], 2 * sizes[1]), ids))
+        for br in br1, br2:
+            br._comm_thread = CommThread(self.backend)
+            br._comm_thread.start()
+
+        def staged(cbuf):
+            return [np.copy(buf.host) for buf in (cbuf.dist_partial_buf,
+                                                  cbuf.dist_full_buf)
+                    if buf is not None]
+
+        try:
+            f_cbuf, g_cbuf = br1._block_to_connbuf[1]
+            fdist = f_cbuf.coll_buf.host
+            gdist = g_cbuf.coll_buf.host
+            f_recv, g_recv = br2._block_to_connbuf[0]
+            for it in range(3):
+                fdist.flat = np.mgrid[it:it + fdist.size]
+                gdist.flat = np.mgrid[500 + it:500 + it + gdist.size]
+                f_recv.recv_buf[:] = -1.0
+
+                br1._send_dists()
+                br2._send_dists()
+                br2._recv_dists()
+                br1._recv_dists()
+
+                # The receive buffers are bypassed.
+                self.assertTrue(np.all(f_recv.recv_buf == -1.0))
+                received = staged(f_recv) + staged(g_recv)
+                f_recv.distribute(self.backend, None,
+                                  fdist.reshape(f_recv.recv_buf.shape))
+                g_recv.distribute(self.backend, None,
+                                  gdist.reshape(g_recv.recv_buf.shape))
+                expected = staged(f_recv) + staged(g_recv)
+                self.assertEqual(len(received), len(expected))
+                for r, e in zip(received, expected):
+                    np.testing.assert_equal(r, e)
+        finally:
+            for br in br1, br2:
+                br._comm_thread.stop()
+
+
+class FailingConnector(object):
+    zero_copy = False
+
+    def recv_parts(self, parts, quit_ev):
+        raise IOError('connection lost')
+
+
+class CommThreadTest(unittest.TestCase):
+    def test_error(self):
+        thread = CommThread(DummyBackend())
+        thread.start()
+        try:
+            ex = thread.exchange(None, [], [(FailingConnector(), [])],
+                                 DummyEvent())
+            try:
+                ex.wait()
+            except IOError:
+                # The traceback points to where the error was raised.
+                tb = traceback.extract_tb(sys.exc_info()[2])
+                self.assertEqual(tb[-1][2], 'recv_parts')
+            else:
+                self.fail('IOError not raised')
+        finally:
+            thread.stop()
+
+
+class ActiveNodes(object):
+    """Minimal subdomain used to set up indirect node addressing."""
+    def __init__(self, active_node_mask):
+        self.active_node_mask = active_node_mask
+        self.active_nodes = int(np.sum(active_node_mask))
+
+
+class SparseHaloTest(unittest.TestCase):
+    nx, ny = 40, 24
+
+    def setUp(self):
+        self.backend = DummyBackend()
+        # Porous medium covering the global domain, including the ghost
+        # nodes around it.
+        rng = np.random.RandomState(1234)
+        self.active = rng.uniform(size=(self.ny + 2, 2 * self.nx + 2)) < 0.4
+
+    def _make_config(self, sparse_halo):
+        config = LBConfig()
+        config.seed = 0
+        config.init_iters = 0
+        config.access_pattern = 'AB'
+        config.node_addressing = 'indirect'
+        config.precision = 'single'
+        config.block_size = 8
+        config.mem_alignment = 1
+        config.mode = 'batch'
+        config.lat_nx, config.lat_ny = 2 * self.nx, self.ny
+        config.logger = DummyLogger()
+        config.grid = 'D2Q9'
+        config.output = ''
+        config.benchmark_sample_from = 0
+        config.benchmark_minibatch = 1
+        config.bulk_boundary_split = False
+        config.sparse_halo = sparse_halo
+        return config
+
+    def _make_connected_runners(self, sparse_halo):
+        config = self._make_config(sparse_halo)
+        b1 = SubdomainSpec2D((0, 0), (self.nx, self.ny), id_=0)
+        b2 = SubdomainSpec2D((self.nx, 0), (self.nx, self.ny), id_=1)
+        b1.set_actual_size(envelope_size=1)
+        b2.set_actual_size(envelope_size=1)
+        self.assertTrue(b1.connect(b2, grid=D2Q9))
+        cpair = b1.get_connection(*b1.connecting_subdomains()[0])
+        c1, c2 = SHMSubdomainConnector.make_pair(
+            ctypes.c_float, (cpair.src.elements, cpair.dst.elements),
+            (b1.id, b2.id))
+        b1.add_connector(b2.id, c1)
+        b2.add_connector(b1.id, c2)
+        c1.init_runner(None)
+        c2.init_runner(None)
+
+        runners = []
+        for spec in b1, b2:
+            sim = LBFluidSim(config)
+            runner = SubdomainRunner(sim, spec, output=LBOutput(config, spec.id),
+                                     backend=self.backend,
+                                     quit_event=DummyEvent())
+            runner._init_shape()
+            x0 = spec.ox
+            active = self.active[:, x0:x0 + self.nx + 2].copy()
+            if spec.id == 0:
+                # Some nodes active in the second subdomain are seen as
+                # inactive ghost nodes in the first one.
+                active[::3, -1] = False
+            runner._subdomain = ActiveNodes(active)
+            sim.init_fields(runner)
+            runner._build_indirect_address_map()
+            runner._init_streams()
+            runners.append(runner)
+
+        # The runners exchange data while initializing the buffers.
+        threads = [threading.Thread(target=r._init_buffers) for r in runners]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return runners
+
+    def _exchange(self, runners, dists):
+        """Runs the collection, exchange and distribution of data between
+        the subdomains, emulating the sparse kernels on the host."""
+        dists = [np.copy(x) for x in dists]
+        for runner, dist in zip(runners, dists):
+            for cbuf in runner._block_to_connbuf[1 - runner._spec.id]:
+                idx = cbuf.coll_idx.host.ravel()
+                valid = idx != SubdomainRunner.INVALID_NODE
+                buf = cbuf.coll_buf.host.reshape(idx.shape)
+                # Data collected from inactive nodes is undefined.
+                buf[:] = np.nan
+                buf[valid] = dist[idx[valid]]
+
+        for runner in runners:
+            runner._send_dists()
+        for runner, dist in zip(runners, dists):
+            runner._recv_dists()
+            for cbuf in runner._recv_block_to_connbuf[1 - runner._spec.id]:
+                for buf, idx in ((cbuf.dist_partial_buf, cbuf.dist_partial_idx),
+                                 (cbuf.dist_full_buf, cbuf.dist_full_idx)):
+                    if idx.host is None:
+                        continue
+                    idx = idx.host.ravel()
+                    valid = idx != SubdomainRunner.INVALID_NODE
+                    dist[idx[valid]] = buf.host.ravel()[valid]
+        return dists
+
+    def test_sparse_vs_dense(self):
+        dense = self._make_connected_runners(False)
+        sparse = self._make_connected_runners(True)
+
+        for d, s in zip(dense, sparse):
+            cbuf_d = d._block_to_connbuf[1 - d._spec.id][0]
+            cbuf_s = s._block_to_connbuf[1 - s._spec.id][0]
+            self.assertTrue(cbuf_s.sparse_halo)
+            self.assertLess(cbuf_s.coll_buf.host.size,
+                            cbuf_d.coll_buf.host.size // 2)
+
+        rng = np.random.RandomState(0)
+        dists = [rng.uniform(size=r.num_active_nodes * 9).astype(np.float32)
+                 for r in dense]
+        dense_out = self._exchange(dense, dists)
+        sparse_out = self._exchange(sparse, dists)
+
+        # The first subdomain collects undefined data from the nodes it sees
+        # as inactive.
+        self.assertTrue(np.any(np.isnan(dense_out[1])))
+        for orig, d, s in zip(dists, dense_out, sparse_out):
+            # The sparse exchange updates all nodes updated with valid data
+            # in the dense exchange, and leaves the remaining nodes intact.
+            self.assertFalse(np.all(d == orig))
+            undefined = np.isnan(d)
+            np.testing.assert_equal(s[~undefined], d[~undefined])
+            np.testing.assert_equal(s[undefined], orig[undefined])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+
+from sailfish.config import LBConfig
+from sailfish.profile import TimeProfile
+from dummy import DummyLogger
+
+
+class FakeEvent(object):
+    def __init__(self, t):
+        self.t = t
+
+    def time_since(self, other):
+        return (self.t - other.t) * 1e3
+
+
+class FakeBackend(object):
+    """Backend with a fixed event clock and per-kernel timings."""
+    def __init__(self):
+        self.clock = 0.0
+        self.kernel_timings = []
+
+    def make_event(self, stream, timing=False):
+        return FakeEvent(self.clock)
+
+    def collect_kernel_timings(self):
+        ret = self.kernel_timings
+        self.kernel_timings = []
+        return ret
+
+
+class FakeSim(object):
+    iteration = 0
+
+
+class FakeSpec(object):
+    id = 0
+
+
+class FakeRunner(object):
+    def __init__(self, config, backend):
+        self.config = config
+        self.backend = backend
+        self._sim = FakeSim()
+        self._spec = FakeSpec()
+        self.summary = None
+
+    def send_summary_info(self, ti, min_ti, max_ti):
+        self.summary = ti, min_ti, max_ti
+
+
+class TestTimeProfile(unittest.TestCase):
+    def setUp(self):
+        config = LBConfig()
+        config.mode = 'benchmark'
+        config.max_iters = 4
+        config.benchmark_sample_from = 2
+        config.benchmark_minibatch = 2
+        config.logger = DummyLogger()
+        self.backend = FakeBackend()
+        self.runner = FakeRunner(config, self.backend)
+        self.profile = TimeProfile(self.runner)
+
+    def _step(self, bulk_time, kernels):
+        self.profile.start_step()
+        self.profile.record_gpu_start(TimeProfile.BULK, None)
+        self.backend.clock += bulk_time
+        self.profile.record_gpu_end(TimeProfile.BULK, None)
+        self.backend.kernel_timings = kernels
+        self.profile.end_step()
+        self.runner._sim.iteration += 1
+
+    def test_timings(self):
+        # Not sampled.
+        self._step(1.0, [('A', 1.0)])
+        self._step(1.0, [('A', 1.0)])
+        # Sampled.
+        self._step(0.5, [('A', 0.25), ('B', 0.125)])
+        self._step(1.5, [('A', 0.75)])
+
+        self.assertEqual(dict(self.profile.kernel_timings),
+                         {'A': 1.0, 'B': 0.125})
+        self.assertEqual(dict(self.profile.kernel_calls), {'A': 2, 'B': 1})
+
+        self.profile.record_end()
+        ti, min_ti, max_ti = self.runner.summary
+        self.assertAlmostEqual(ti.bulk, 2.0 / 2)
+        self.assertAlmostEqual(min_ti.bulk, 0.5)
+        self.assertAlmostEqual(max_ti.bulk, 1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
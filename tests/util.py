@@ -1,5 +1,6 @@
 import os
 import random
+import shutil
 import unittest
 import tempfile
 import numpy as np
@@ -61,6 +62,57 @@ class TestMiscUtils(unittest.TestCase):
         np.testing.assert_array_equal(
                 util.in_anyd(a, b), util.in_anyd_fast(a, b))
 
+    def test_periodic_shift(self):
+        a = np.arange(7 * 5 * 4).reshape((7, 5, 4))
+        shift = util.PeriodicShift(a)
+        for vec in [(1, 0, 0), (0, -1, 1), (1, 1, -1), (-1, -1, -1)]:
+            expected = a
+            for j, s in enumerate(vec):
+                expected = np.roll(expected, -s, axis=2 - j)
+            np.testing.assert_array_equal(shift.shifted(vec), expected)
+            np.testing.assert_array_equal(shift.shifted(vec, slice(2, 5)),
+                                          expected[2:5])
+
+    def test_map_chunks(self):
+        ret = util.map_chunks(lambda chunk: (chunk.start, chunk.stop),
+                              (10, 4, 5), chunk_elements=60)
+        self.assertEqual(ret, [(0, 3), (3, 6), (6, 9), (9, 10)])
+        ret = util.map_chunks(lambda chunk: (chunk.start, chunk.stop),
+                              (10, 4, 5), num_threads=3, chunk_elements=60)
+        self.assertEqual(ret, [(0, 3), (3, 6), (6, 9), (9, 10)])
+
+    def test_chunked_array(self):
+        a = np.arange(11 * 4 * 3).reshape((11, 4, 3))
+        directory = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(directory, 'a.npz')
+            util.save_chunked_array(fname, a, chunk_elements=36)
+            b = util.open_array(fname)
+            self.assertEqual(b.shape, a.shape)
+            self.assertEqual(b.dtype, a.dtype)
+            for key in [slice(None), slice(2, 9), slice(8, 1, -3),
+                        (slice(3, 7), 2), (slice(1, 10, 2), slice(1, 3), 1),
+                        5, -1, (4, 3, 2), slice(20, 30)]:
+                np.testing.assert_array_equal(b[key], a[key])
+            np.testing.assert_array_equal(np.asarray(b), a)
+
+            fname = os.path.join(directory, 'a.npy')
+            np.save(fname, a)
+            b = util.open_array(fname)
+            self.assertTrue(isinstance(b, np.memmap))
+            np.testing.assert_array_equal(b, a)
+            del b
+
+            # Regular .npz files are loaded with numpy.
+            fname = os.path.join(directory, 'plain.npz')
+            np.savez(fname, shape=np.array([1]), a=a)
+            b = util.open_array(fname)
+            np.testing.assert_array_equal(b['a'], a)
+            b.close()
+            self.assertRaises(ValueError, util.ChunkedArray, fname)
+        finally:
+            shutil.rmtree(directory)
+
 
 if __name__ == '__main__':
     unittest.main()
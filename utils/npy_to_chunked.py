@@ -0,0 +1,16 @@
+#!/usr/bin/python
+
+"""Converts .npy (optionally gzipped) files into chunked containers.
+
+Parts of arrays stored in chunked containers can be read without
+decompressing the whole array (see sailfish.util.open_array), which makes
+them suitable for large geometry files used by multiple subdomains."""
+
+import sys
+from sailfish import util
+
+for fn in sys.argv[1:]:
+    base = fn[:-3] if fn.endswith('.gz') else fn
+    if base.endswith('.npy'):
+        base = base[:-4]
+    util.save_chunked_array(base + '.npz', util.open_array(fn))